@@ -36,7 +36,6 @@ import stat
 import sys
 import time
 import apt_pkg
-import apt_inst
 
 from daklib.dbconn import *
 from daklib import utils
@@ -48,8 +47,6 @@ from daklib.dak_exceptions import InvalidDscError, ChangesUnicodeError, CantOpen
 db_files = {}                  #: Cache of filenames as known by the database
 waste = 0.0                    #: How many bytes are "wasted" by files not referenced in database
 excluded = {}                  #: List of files which are excluded from files check
-current_file = None
-future_files = {}
 current_time = time.time()     #: now()
 
 ################################################################################
@@ -60,6 +57,20 @@ Run various sanity checks of the archive and/or database.
 
   -h, --help                show this help and exit.
 
+Options for the checksums, files and timestamps modes:
+  -j, --jobs=N              check files in N processes (default: number of CPUs)
+
+Options for the checksums mode:
+  -b, --bandwidth=MB        read at most MB megabytes per second in total
+  -c, --checkpoint=FILE     record checked files in FILE and skip the files
+                            recorded there by an interrupted run
+  -p, --prefix=PREFIX       only check pool files starting with PREFIX
+                            (below the component, e.g. "libf")
+  -s, --shard=N/M           only check the Nth of M parts of the pool (0 <= N < M)
+
+Options for the files mode:
+  -t, --timestamps          also check .deb files for future timestamps
+
 The following MODEs are available:
 
   checksums          - validate the checksums stored in the database
@@ -104,10 +115,10 @@ def process_dir (unused, dirname, filenames):
 
 ################################################################################
 
-def check_files():
+def check_files(Options):
     """
-    Prepare the dictionary of existing filenames, then walk through the archive
-    pool/ directory to compare it.
+    Report files missing from the archives, then compare the pool/ directory
+    of each archive with the files the database expects there.
     """
     cnf = Config()
     session = DBConn().session()
@@ -143,27 +154,7 @@ def check_files():
     for row in session.execute(query):
         print "MISSING-ARCHIVE-FILE {0} {1} {2}".vformat(row)
 
-    archive_files = session.query(ArchiveFile) \
-        .join(ArchiveFile.archive).join(ArchiveFile.file) \
-        .order_by(Archive.archive_name, PoolFile.filename)
-
-    expected_files = set()
-    for af in archive_files:
-        path = af.path
-        expected_files.add(af.path)
-        if not os.path.exists(path):
-            print "MISSING-FILE {0} {1} {2}".format(af.archive.archive_name, af.file.filename, path)
-
-    archives = session.query(Archive).order_by(Archive.archive_name)
-
-    for a in archives:
-        top = os.path.join(a.path, 'pool')
-        for dirpath, dirnames, filenames in os.walk(top):
-            for fn in filenames:
-                path = os.path.join(dirpath, fn)
-                if path in expected_files:
-                    continue
-                print "UNEXPECTED-FILE {0} {1}".format(a.archive_name, path)
+    scan_pool(session, Options, report_files=True, timestamps=bool(Options["Timestamps"]))
 
 ################################################################################
 
@@ -312,78 +303,213 @@ def fix_checksums():
 ################################################################################
 #
 
-def check_checksums():
+_checksums_query = """
+SELECT f.id, a.path, c.name, f.filename, f.size, f.md5sum, f.sha1sum, f.sha256sum
+  FROM (SELECT DISTINCT ON (af.file_id) af.file_id, af.archive_id, af.component_id
+          FROM files_archive_map af JOIN archive a ON a.id = af.archive_id
+         ORDER BY af.file_id, a.tainted DESC) af
+  JOIN files f ON f.id = af.file_id
+  JOIN archive a ON a.id = af.archive_id
+  JOIN component c ON c.id = af.component_id
+ WHERE f.filename LIKE :prefix
+ ORDER BY f.filename
+"""
+
+def verify_helper(files, rate):
     """
-    Validate all files
+    Verifies a batch of pool files. This function runs in a subprocess.
     """
-    print "Getting file information from database..."
-    q = DBConn().session().query(PoolFile)
+    from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
+    from daklib.poolverify import verify_files
+    return (PROC_STATUS_SUCCESS, verify_files(files, rate))
 
-    print "Checking file checksums & sizes..."
-    for f in q:
-        filename = f.fullpath
-
-        try:
-            fi = utils.open_file(filename)
-        except:
-            utils.warn("can't open '%s'." % (filename))
-            continue
+def check_checksums(Options):
+    """
+    Validate all files
 
-        size = os.stat(filename)[stat.ST_SIZE]
-        if size != f.filesize:
-            utils.warn("**WARNING** size mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, size, f.filesize))
+    Every file is read once for all checksums, by several processes
+    (Check-Archive::Options::Jobs) limited to a total read rate of
+    Check-Archive::Options::Bandwidth MB/s. With a checkpoint file, files
+    verified by an interrupted run are skipped. Prefix and Shard select a
+    part of the pool.
+    """
+    from multiprocessing import cpu_count
+    from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
+    from daklib.poolverify import Checkpoint, parse_shard, shard_of
 
-        md5sum = apt_pkg.md5sum(fi)
-        if md5sum != f.md5sum:
-            utils.warn("**WARNING** md5sum mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, md5sum, f.md5sum))
+    cnf = Config()
+    jobs = int(Options["Jobs"] or cnf.find_i("Check-Archive::Checksums::Jobs", cpu_count()))
+    bandwidth = float(Options["Bandwidth"] or cnf.find("Check-Archive::Checksums::Bandwidth", "0"))
+    rate = int(bandwidth * 1024 * 1024 / jobs)
+    per_task = cnf.find_i("Check-Archive::Checksums::FilesPerTask", 100)
+    shard = None
+    if Options["Shard"]:
+        try:
+            shard = parse_shard(Options["Shard"])
+        except ValueError as e:
+            utils.fubar(str(e))
+    prefix = Options["Prefix"].replace('%', r'\%').replace('_', r'\_') + '%'
+
+    checkpoint = None
+    done = set()
+    if Options["Checkpoint"]:
+        checkpoint = Checkpoint(Options["Checkpoint"])
+        done = checkpoint.load()
+        if done:
+            print "Resuming, skipping %d files already checked..." % (len(done))
 
-        fi.seek(0)
-        sha1sum = apt_pkg.sha1sum(fi)
-        if sha1sum != f.sha1sum:
-            utils.warn("**WARNING** sha1sum mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, sha1sum, f.sha1sum))
+    print "Getting file information from database..."
+    session = DBConn().session()
 
-        fi.seek(0)
-        sha256sum = apt_pkg.sha256sum(fi)
-        if sha256sum != f.sha256sum:
-            utils.warn("**WARNING** sha256sum mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, sha256sum, f.sha256sum))
+    def batches():
+        batch = []
+        for rows in stream_query(session, _checksums_query, {'prefix': prefix}):
+            for file_id, archive_path, component, filename, size, md5sum, sha1sum, sha256sum in rows:
+                if file_id in done:
+                    continue
+                if shard is not None and shard_of(filename, shard[1]) != shard[0]:
+                    continue
+                path = os.path.join(archive_path, 'pool', component, filename)
+                batch.append((file_id, path, size, md5sum, sha1sum, sha256sum))
+                if len(batch) >= per_task:
+                    yield (batch, rate)
+                    batch = []
+        if batch:
+            yield (batch, rate)
 
+    print "Checking file checksums & sizes..."
+    pool = DakProcessPool(jobs)
+    start = time.time()
+    files = total = 0
+    failed = False
+    for status, result in pool.imap_bounded(verify_helper, batches(), 2 * jobs):
+        if status != PROC_STATUS_SUCCESS:
+            utils.warn("checking a batch of files failed: %s" % (result,))
+            failed = True
+            continue
+        file_ids, problems, size = result
+        for problem in problems:
+            utils.warn(problem)
+        if checkpoint is not None:
+            checkpoint.record(file_ids)
+        files += len(file_ids)
+        total += size
+    pool.close()
+    pool.join()
+    session.close()
+
+    seconds = max(time.time() - start, 0.001)
+    print "Checked %d files, %.1f MB in %.0fs (%.1f MB/s)." % \
+        (files, total / 1048576.0, seconds, total / 1048576.0 / seconds)
+    if checkpoint is not None and not failed:
+        checkpoint.remove()
     print "Done."
 
 ################################################################################
 #
 
-def Ent(Kind,Name,Link,Mode,UID,GID,Size,MTime,Major,Minor):
-    global future_files
-
-    if MTime > current_time:
-        future_files[current_file] = MTime
-        print "%s: %s '%s','%s',%u,%u,%u,%u,%u,%u,%u" % (current_file, Kind,Name,Link,Mode,UID,GID,Size, MTime, Major, Minor)
+_pool_query = """
+SELECT DISTINCT (c.name || '/' || f.filename) COLLATE "C" AS path, f.filename
+  FROM files_archive_map af
+  JOIN files f ON f.id = af.file_id
+  JOIN component c ON c.id = af.component_id
+ WHERE af.archive_id = :archive_id
+ ORDER BY path
+"""
 
-def check_timestamps():
+def timestamps_helper(archive_name, paths, now):
     """
-    Check all files for timestamps in the future; common from hardware
-    (e.g. alpha) which have far-future dates as their default dates.
+    Looks for future timestamps in a batch of .deb files. This function
+    runs in a subprocess.
     """
+    from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
+    from daklib.poolscan import future_timestamps
+    lines = []
+    for path in paths:
+        try:
+            for tarball, name, mtime in future_timestamps(path, now):
+                lines.append("FUTURE-TIMESTAMP {0} {1} {2} {3} {4}".format(
+                    archive_name, path, tarball, name, mtime))
+        except Exception as e:
+            lines.append("UNREADABLE-DEB {0} {1} {2}".format(archive_name, path, e))
+    return (PROC_STATUS_SUCCESS, (len(paths), lines))
 
-    global current_file
-
-    q = DBConn().session().query(PoolFile).filter(PoolFile.filename.like('.deb$'))
+def scan_pool(session, Options, report_files, timestamps):
+    """
+    Walks the pool/ directory of each archive once and merge-joins it with
+    the sorted list of files the database expects there, so neither side
+    is held in memory. Prints machine-readable lines:
 
-    db_files.clear()
-    count = 0
+      MISSING-FILE archive filename path
+      UNEXPECTED-FILE archive path
+      FUTURE-TIMESTAMP archive path tarball member mtime
+      UNREADABLE-DEB archive path error
 
-    for pf in q.all():
-        filename = os.path.abspath(os.path.join(pf.location.path, pf.filename))
-        if os.access(filename, os.R_OK):
-            f = utils.open_file(filename)
-            current_file = filename
-            sys.stderr.write("Processing %s.\n" % (filename))
-            apt_inst.debExtract(f, Ent, "control.tar.gz")
-            f.seek(0)
-            apt_inst.debExtract(f, Ent, "data.tar.gz")
-            count += 1
+    With timestamps, the .deb files found are checked for members with
+    future timestamps by Check-Archive::Options::Jobs processes.
+    """
+    from multiprocessing import cpu_count
+    from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
+    from daklib.poolscan import sorted_files, merge_join
 
-    print "Checked %d files (out of %d)." % (count, len(db_files.keys()))
+    cnf = Config()
+    jobs = int(Options["Jobs"] or cnf.find_i("Check-Archive::Timestamps::Jobs", cpu_count()))
+    per_task = cnf.find_i("Check-Archive::Timestamps::FilesPerTask", 50)
+    now = time.time()
+    counts = dict(expected=0, missing=0, unexpected=0, debs=0)
+
+    def batches():
+        for archive in session.query(Archive).order_by(Archive.archive_name):
+            top = os.path.join(archive.path, 'pool')
+            expected = (row for rows in stream_query(session, _pool_query,
+                {'archive_id': archive.archive_id}) for row in rows)
+            found = ((path, ) for path in sorted_files(top))
+            debs = []
+            for path, in_db, on_disk in merge_join(expected, found):
+                fullpath = os.path.join(top, path)
+                if in_db is not None:
+                    counts['expected'] += 1
+                if on_disk is None:
+                    counts['missing'] += 1
+                    if report_files:
+                        print "MISSING-FILE {0} {1} {2}".format(archive.archive_name, in_db[1], fullpath)
+                    continue
+                if in_db is None:
+                    counts['unexpected'] += 1
+                    if report_files:
+                        print "UNEXPECTED-FILE {0} {1}".format(archive.archive_name, fullpath)
+                if timestamps and path.endswith('.deb'):
+                    debs.append(fullpath)
+                    if len(debs) >= per_task:
+                        yield (archive.archive_name, debs, now)
+                        debs = []
+            if debs:
+                yield (archive.archive_name, debs, now)
+
+    if not timestamps:
+        for batch in batches():
+            pass
+    else:
+        pool = DakProcessPool(jobs)
+        for status, result in pool.imap_bounded(timestamps_helper, batches(), 2 * jobs):
+            if status != PROC_STATUS_SUCCESS:
+                utils.warn("checking a batch of .deb files failed: %s" % (result,))
+                continue
+            checked, lines = result
+            counts['debs'] += checked
+            for line in lines:
+                print line
+        pool.close()
+        pool.join()
+
+    print "SUMMARY expected={expected} missing={missing} unexpected={unexpected} debs={debs}".format(**counts)
+
+def check_timestamps(Options):
+    """
+    Check all .deb files for timestamps in the future; common from hardware
+    (e.g. alpha) which have far-future dates as their default dates.
+    """
+    scan_pool(DBConn().session(), Options, report_files=False, timestamps=True)
 
 ################################################################################
 
@@ -598,8 +724,14 @@ def main ():
 
     cnf = Config()
 
-    Arguments = [('h',"help","Check-Archive::Options::Help")]
-    for i in [ "help" ]:
+    Arguments = [('h',"help","Check-Archive::Options::Help"),
+                 ('j',"jobs","Check-Archive::Options::Jobs","HasArg"),
+                 ('b',"bandwidth","Check-Archive::Options::Bandwidth","HasArg"),
+                 ('c',"checkpoint","Check-Archive::Options::Checkpoint","HasArg"),
+                 ('p',"prefix","Check-Archive::Options::Prefix","HasArg"),
+                 ('s',"shard","Check-Archive::Options::Shard","HasArg"),
+                 ('t',"timestamps","Check-Archive::Options::Timestamps")]
+    for i in [ "help", "jobs", "bandwidth", "checkpoint", "prefix", "shard", "timestamps" ]:
         if not cnf.has_key("Check-Archive::Options::%s" % (i)):
             cnf["Check-Archive::Options::%s" % (i)] = ""
 
@@ -621,9 +753,9 @@ def main ():
     DBConn()
 
     if mode == "checksums":
-        check_checksums()
+        check_checksums(Options)
     elif mode == "files":
-        check_files()
+        check_files(Options)
     elif mode == "dsc-syntax":
         check_dscs()
     elif mode == "missing-overrides":
@@ -631,7 +763,7 @@ def main ():
     elif mode == "source-in-one-dir":
         check_source_in_one_dir()
     elif mode == "timestamps":
-        check_timestamps()
+        check_timestamps(Options)
     elif mode == "files-in-dsc":
         check_files_in_dsc()
     elif mode == "validate-indices":
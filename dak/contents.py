@@ -79,6 +79,10 @@ OPTIONS for generate
      -f, --force
         write Contents files for suites marked as untouchable, too
 
+     -i, --incremental
+        only recompute the lines of files whose packages changed since the
+        last incremental run, keeping the lines in the database
+
 OPTIONS for scan-source and scan-binary
      -l, --limit=NUMBER
         maximum number of packages to scan
@@ -87,9 +91,9 @@ OPTIONS for scan-source and scan-binary
 
 ################################################################################
 
-def write_all(cnf, archive_names = [], suite_names = [], component_names = [], force = None):
+def write_all(cnf, archive_names = [], suite_names = [], component_names = [], force = None, incremental = False):
     Logger = daklog.Logger('contents generate')
-    ContentsWriter.write_all(Logger, archive_names, suite_names, component_names, force)
+    ContentsWriter.write_all(Logger, archive_names, suite_names, component_names, force, incremental)
     Logger.close()
 
 ################################################################################
@@ -99,7 +103,9 @@ def binary_scan_all(cnf, limit):
     result = BinaryContentsScanner.scan_all(limit)
     processed = '%(processed)d packages processed' % result
     remaining = '%(remaining)d packages remaining' % result
-    Logger.log([processed, remaining])
+    throughput = '%d paths loaded in %.1fs (%.0f paths/s)' % \
+        (result['files'], result['seconds'], result['files'] / max(result['seconds'], 0.001))
+    Logger.log([processed, remaining, throughput])
     Logger.close()
 
 ################################################################################
@@ -121,12 +127,14 @@ def main():
     cnf['Contents::Options::Component'] = ''
     cnf['Contents::Options::Limit'] = ''
     cnf['Contents::Options::Force'] = ''
+    cnf['Contents::Options::Incremental'] = ''
     arguments = [('h', "help",      'Contents::Options::Help'),
                  ('a', 'archive',   'Contents::Options::Archive',   'HasArg'),
                  ('s', "suite",     'Contents::Options::Suite',     "HasArg"),
                  ('c', "component", 'Contents::Options::Component', "HasArg"),
                  ('l', "limit",     'Contents::Options::Limit',     "HasArg"),
                  ('f', "force",     'Contents::Options::Force'),
+                 ('i', "incremental", 'Contents::Options::Incremental'),
                 ]
     args = apt_pkg.parse_commandline(cnf.Cnf, arguments, sys.argv)
     options = cnf.subtree('Contents::Options')
@@ -151,9 +159,10 @@ def main():
     component_names = utils.split_args(options['Component'])
 
     force = bool(options['Force'])
+    incremental = bool(options['Incremental'])
 
     if args[0] == 'generate':
-        write_all(cnf, archive_names, suite_names, component_names, force)
+        write_all(cnf, archive_names, suite_names, component_names, force, incremental)
         return
 
     usage()
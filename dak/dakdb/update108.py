@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""
+Add contents_cache tables for incremental Contents generation
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import psycopg2
+from daklib.dak_exceptions import DBUpdateError
+from daklib.config import Config
+
+statements = [
+"""
+CREATE TABLE contents_cache_binaries (
+    suite INTEGER NOT NULL REFERENCES suite(id) ON DELETE CASCADE,
+    component INTEGER NOT NULL REFERENCES component(id) ON DELETE CASCADE,
+    architecture INTEGER NOT NULL REFERENCES architecture(id) ON DELETE CASCADE,
+    type INTEGER NOT NULL REFERENCES override_type(id) ON DELETE CASCADE,
+    binary_id INTEGER NOT NULL,
+    package TEXT NOT NULL,
+    section TEXT NOT NULL,
+    PRIMARY KEY (suite, component, architecture, type, binary_id)
+)
+""",
+"""
+COMMENT ON TABLE contents_cache_binaries IS
+  'Binaries (with their section) contents_cache was last built from'
+""",
+"""
+CREATE TABLE contents_cache (
+    suite INTEGER NOT NULL REFERENCES suite(id) ON DELETE CASCADE,
+    component INTEGER NOT NULL REFERENCES component(id) ON DELETE CASCADE,
+    architecture INTEGER NOT NULL REFERENCES architecture(id) ON DELETE CASCADE,
+    type INTEGER NOT NULL REFERENCES override_type(id) ON DELETE CASCADE,
+    file TEXT NOT NULL,
+    pkglist TEXT NOT NULL,
+    PRIMARY KEY (suite, component, architecture, type, file)
+)
+""",
+"""
+COMMENT ON TABLE contents_cache IS
+  'Lines of the Contents files, maintained incrementally by dak contents generate --incremental'
+""",
+]
+
+################################################################################
+def do_update(self):
+    print __doc__
+    try:
+        cnf = Config()
+
+        c = self.db.cursor()
+
+        for stmt in statements:
+            c.execute(stmt)
+
+        c.execute("UPDATE config SET value = '108' WHERE name = 'db_revision'")
+        self.db.commit()
+
+    except psycopg2.ProgrammingError as msg:
+        self.db.rollback()
+        raise DBUpdateError('Unable to apply sick update 108, rollback issued. Error message: {0}'.format(msg))
@@ -34,10 +34,11 @@ Finds icons for packages with missing icons.
 
 import os
 import glob
+import mmap
 from shutil import rmtree
 from daklib.dbconn import *
 from daklib.config import Config
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
 
@@ -67,7 +68,7 @@ class MetaInfoFinder:
         with
         req_data as
         ( select distinct on(b.package) f.filename, c.name, b.id,
-        a.arch_string, b.package
+        a.arch_string, b.package, f.sha256sum
         from
         binaries b, bin_associations ba, suite s, files f, override o,
         component c, architecture a
@@ -76,7 +77,8 @@ class MetaInfoFinder:
         and ba.suite = s.id and s.suite_name = :suitename and
         b.architecture = a.id order by b.package, b.version desc)
 
-        select bc.file,rd.filename,rd.name,rd.id,rd.arch_string,rd.package
+        select bc.file,rd.filename,rd.name,rd.id,rd.arch_string,rd.package,
+        rd.sha256sum
         from bin_contents bc,req_data rd
         where (bc.file like 'usr/share/appdata/%.xml' or
         bc.file like 'usr/share/applications/%.desktop')
@@ -86,7 +88,7 @@ class MetaInfoFinder:
 
         # FIXME: We get only one hit for one arch for some reason...
         result = self._session.query("file", "filename", "name", "id",
-                                     "arch_string", "package")\
+                                     "arch_string", "package", "sha256sum")\
                               .from_statement(sql).params(params)
 
         # create a dict with packagename:[.desktop and/or .xml files]
@@ -104,6 +106,7 @@ class MetaInfoFinder:
 
             pkg[arch_name]['filename'] = fname
             pkg[arch_name]['binid'] = r[3]
+            pkg[arch_name]['sha256'] = r[6]
             if not pkg[arch_name].get('files'):
                 pkg[arch_name]['files'] = list()
             ifiles = pkg[arch_name]['files']
@@ -115,55 +118,145 @@ class MetaInfoFinder:
 ###########################################################################
 
 
-class IconFinder():
+icon_extensions = ('.png', '.svg', '.ico', '.xcf', '.gif', '.svgz')
+
+def icon_stem(name):
     '''
-    To be used when icon is not found through regular method.This class
-    searches icons of similar packages. Ignores the package with binid.
+    Returns the name an icon is looked up by: its basename without a known
+    image file extension.
     '''
-    def __init__(self, package, icon, binid):
-        self._params = {
-            'package': '%' + package + '%',
-            'icon1': 'usr/share/icons/%' + icon + '%',
-            'icon2': 'usr/share/pixmaps/%' + icon + '%',
-            'id': binid
-        }
-        self._session = DBConn().session()
-        self._icon = icon
-
-    def query_icon(self):
-        '''
-        function to query icon files from similar packages.
-        Returns path of the icon
-        '''
-        sql = """ select bc.file, f.filename
-        from binaries b, bin_contents bc, files f
-        where b.file = f.id and b.package like :package
-        and (bc.file like :icon1 or bc.file like :icon2) and
-        (bc.file not like '%.xpm' and bc.file not like '%.tiff')
-        and b.id <> :id and b.id = bc.binary_id"""
+    name = os.path.basename(name)
+    for ext in icon_extensions:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
 
-        result = self._session.execute(sql, self._params)
-        rows = result.fetchall()
+def icon_rank(path):
+    '''
+    Sort key for icon candidates, lower is better. We cache 64x64 icons, so
+    prefer exactly that size, then scalable ones, then bigger ones which can
+    be scaled down, then smaller ones. Within a size hicolor wins over other
+    themes, and usr/share/pixmaps is the last resort.
+    '''
+    parts = path.split('/')
+    # usr/share/icons/<theme>/<size>/<context>/<name>
+    if parts[2] != 'icons' or len(parts) < 6:
+        return (4, 0, 1)
+    theme_rank = 0 if parts[3] == 'hicolor' else 1
+    size = parts[4]
+    if size == '64x64':
+        return (0, 0, theme_rank)
+    if size == 'scalable':
+        return (1, 0, theme_rank)
+    try:
+        pixels = int(size.split('x')[0])
+    except ValueError:
+        return (3, 0, theme_rank)
+    if pixels > 64:
+        return (2, pixels, theme_rank)
+    return (3, -pixels, theme_rank)
+
+
+class IconIndex():
+    '''
+    Index of all icon files under usr/share/icons and usr/share/pixmaps in
+    a suite, used when a package references an icon it does not ship.
 
-        for r in rows:
-            path = str(r[0])
-            filename = str(r[1])
-            if path.endswith(self._icon+'.png')\
-               or path.endswith(self._icon+'.svg')\
-               or path.endswith(self._icon+'.ico')\
-               or path.endswith(self._icon+'.xcf')\
-               or path.endswith(self._icon+'.gif')\
-               or path.endswith(self._icon+'.svgz'):
-                # Write the logic to sekect the best icon of all
-                return [path, filename]
+    The index is built once per suite with a single query and written to a
+    sorted, tab-separated file, which the extraction workers mmap and
+    binary-search. This way all workers share one copy of it.
+    '''
 
-        return False
+    def __init__(self, filename):
+        '''
+        Opens an index written by IconIndex.build
+        '''
+        self._file = open(filename, 'rb')
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = ''
+
+    @staticmethod
+    def build(session, suitename, filename):
+        '''
+        Writes the index of all icons of a suite to filename. The rows come
+        sorted by icon name from the database and are streamed to the file.
+        '''
+        # the icon name is computed like icon_stem does, the bytewise order
+        # matches the comparisons in _lookup
+        sql = """
+        select regexp_replace(bc.file, '^.*/|[.](png|svg|ico|xcf|gif|svgz)$', '', 'g') as stem,
+               bc.file as path, c.name || '/' || f.filename as poolpath,
+               b.package as package, b.id as binid
+        from bin_contents bc
+        join binaries b on b.id = bc.binary_id
+        join bin_associations ba on ba.bin = b.id
+        join suite s on s.id = ba.suite
+        join files f on f.id = b.file
+        join files_archive_map af on af.file_id = f.id and af.archive_id = s.archive_id
+        join component c on c.id = af.component_id
+        where s.suite_name = :suitename
+        and (bc.file like 'usr/share/icons/%' or bc.file like 'usr/share/pixmaps/%')
+        and bc.file ~ '[.](png|svg|ico|xcf|gif|svgz)$'
+        order by stem collate "C"
+        """
+        query = session.query("stem", "path", "poolpath", "package", "binid"). \
+            from_statement(sql).params({'suitename': suitename})
+        count = 0
+        with open(filename, 'wb') as f:
+            for stem, path, poolpath, package, binid in query.yield_per(1000):
+                f.write("%s\t%s\t%s\t%s\t%d\n" % (stem, path, poolpath, package, binid))
+                count += 1
+        return count
+
+    def _lookup(self, stem):
+        '''
+        Returns all (path, poolpath, package, binid) entries for an icon name.
+        '''
+        data = self._map
+        lo, hi = 0, len(data)
+        # find the first line with a key >= stem
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind('\n', 0, mid) + 1
+            end = data.find('\n', start)
+            if data[start:data.find('\t', start)] < stem:
+                lo = end + 1
+            else:
+                hi = start
+
+        entries = list()
+        while lo < len(data):
+            end = data.find('\n', lo)
+            fields = data[lo:end].split('\t')
+            if fields[0] != stem:
+                break
+            entries.append((fields[1], fields[2], fields[3], int(fields[4])))
+            lo = end + 1
+        return entries
+
+    def find(self, icon, package, binid):
+        '''
+        Returns (path, poolpath) of the best matching icon file for the
+        icon name, or None. Like the old IconFinder, only packages whose
+        name contains the name of package are searched, the package with
+        binid itself is ignored.
+        '''
+        candidates = [e for e in self._lookup(icon_stem(icon))
+                      if e[3] != binid and package in e[2]]
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda e: (icon_rank(e[0]), e[0]))
+        return (best[0], best[1])
 
     def close(self):
-        """
-        Closes the session
-        """
-        self._session.close()
+        '''
+        Unmaps the index
+        '''
+        if self._map:
+            self._map.close()
+        self._file.close()
 
 
 class BinDEP11Data():
@@ -171,14 +264,14 @@ class BinDEP11Data():
         self._params = params
         self._session = DBConn().session()
 
-    def fetch_docs(self):
+    def _query(self, columns, architecture):
         '''
-        Fetches the YAML docs if the ignore field is false
-        Per arch per component per suite basis
+        Runs the query for the not ignored docs of one architecture, ordered
+        by binary id, on a server-side cursor so the rows are streamed
+        instead of loaded all at once.
         '''
-        # SQL to fetch metadata
         sql = """
-        select bd.metadata
+        select %s
         from
         bin_dep11 bd, binaries b, bin_associations ba, suite s,
         override o, component c, architecture a
@@ -186,11 +279,33 @@ class BinDEP11Data():
         and o.component = c.id and c.name = :component and b.id = ba.bin
         and ba.suite = s.id and s.suite_name = :suite and
         b.architecture = a.id and a.arch_string = :architecture
-        """
+        order by bd.binary_id, bd.id
+        """ % (columns)
+
+        params = dict(self._params)
+        params['architecture'] = architecture
+        conn = self._session.connection().execution_options(stream_results=True)
+        return conn.execute(text(sql), params)
+
+    def fetch_docs(self, architecture=None):
+        '''
+        Yields the YAML docs if the ignore field is false
+        Per arch per component per suite basis
+        '''
+        if architecture is None:
+            architecture = self._params['architecture']
+        for row in self._query("bd.metadata", architecture):
+            yield row[0]
 
-        result = self._session.execute(sql, self._params)
-        rows = result.fetchall()
-        return rows
+    def fetch_index(self, architecture=None):
+        '''
+        Returns the (binary_id, md5 of metadata) pairs of the docs
+        fetch_docs would return, without transferring the docs themselves.
+        '''
+        if architecture is None:
+            architecture = self._params['architecture']
+        return [tuple(row) for row in
+                self._query("bd.binary_id, md5(bd.metadata)", architecture)]
 
     def close(self):
         """
@@ -36,17 +36,19 @@ import apt_pkg
 import yaml
 import re
 import sys
-import urllib
 import glob
 import sha
+import hashlib
+import Queue
+import threading
 import tarfile
 import shutil
 import datetime
 import os
+import tempfile
 import os.path
 import lxml.etree as et
 from apt_inst import DebFile
-from PIL import Image
 from subprocess import CalledProcessError
 from find_metainfo import *
 
@@ -55,10 +57,12 @@ from daklib.daksubprocess import call, check_call
 from daklib.filewriter import DEP11DataFileWriter
 from daklib.config import Config
 from daklib.dbconn import *
+from daklib.screenshots import MediaCache, ScreenshotFetcher
 from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS, PROC_STATUS_SIGNALRAISED
 
 ###########################################################################
 DEP11_VERSION = "0.6"
+screenshot_sizes = ['752x423', '624x351', '112x63']
 time_str = str(datetime.date.today())
 dep11_header = {
     "File": "DEP-11",
@@ -70,23 +74,186 @@ dep11_header = {
 # TODO: Move to dbconn.py
 class DEP11Metadata():
 
-    def __init__(self, session):
+    def __init__(self, session, table='bin_dep11'):
         self._session = session
+        self._table = table
 
     def insertdata(self, binid, yamldoc,flag):
         d = {"bin_id": binid, "yaml_data": yamldoc, "ignore":flag}
-        sql = """insert into bin_dep11(binary_id,metadata,ignore)
-        VALUES (:bin_id, :yaml_data, :ignore)"""
+        sql = """insert into %s(binary_id,metadata,ignore)
+        VALUES (:bin_id, :yaml_data, :ignore)""" % (self._table)
         self._session.execute(sql, d)
 
+    def insertmany(self, rows, batch_size=10000):
+        '''
+        Loads an iterable of (binid, yamldoc, flag) tuples with COPY
+        '''
+        return copy_rows(self._session, self._table,
+                         ('binary_id', 'metadata', 'ignore'), rows, batch_size)
+
+    def replacemany(self, rows, batch_size=10000):
+        '''
+        Replaces all rows of the binaries occuring in rows, an iterable of
+        (binid, yamldoc, flag) tuples, using set-based statements only.
+        '''
+        self._session.execute("""create temp table bin_dep11_new
+        (binary_id integer not null, metadata text not null, ignore boolean not null)""")
+        count = copy_rows(self._session, 'bin_dep11_new',
+                          ('binary_id', 'metadata', 'ignore'), rows, batch_size)
+        self._session.execute("""delete from %s bd using
+        (select distinct binary_id from bin_dep11_new) n
+        where bd.binary_id = n.binary_id""" % (self._table))
+        self._session.execute("""insert into %s(binary_id,metadata,ignore)
+        select binary_id, metadata, ignore from bin_dep11_new""" % (self._table))
+        self._session.execute("drop table bin_dep11_new")
+        return count
+
     def removedata(self, suitename):
-        sql = """delete from bin_dep11 where binary_id in
-        (select distinct(b.id) from binaries b,override o,suite s
-        where b.package = o.package and o.suite = s.id
-        and s.suite_name= :suitename)"""
+        sql = """delete from %s bd using binaries b, override o, suite s
+        where bd.binary_id = b.id and b.package = o.package
+        and o.suite = s.id and s.suite_name = :suitename""" % (self._table)
         self._session.execute(sql, {"suitename": suitename})
         self._session.commit()
 
+
+class DEP11Cache():
+    '''
+    Cache of extracted DEP-11 data, keyed on the sha256sum of the .deb.
+    The YAML documents live in the dep11_cache table, icons and screenshots
+    are hardlinked into Dir::MetaInfo/cache/. As the key is the file's
+    checksum, the cache is shared between all suites and components and
+    survives expiry of bin_dep11. Data which depends on the suite (icons
+    looked up in the IconIndex) or is incomplete (screenshots which could
+    not be fetched) is not stored.
+    '''
+
+    def __init__(self, session):
+        self._session = session
+        self._cachedir = os.path.join(Config()["Dir::MetaInfo"], "cache")
+
+    def _media_dir(self, sha256sum):
+        '''
+        Returns the directory holding the cached media of a .deb
+        '''
+        return os.path.join(self._cachedir, sha256sum[0:2], sha256sum)
+
+    def lookup(self, sha256sum):
+        '''
+        Returns the list of cached (export_path, metadata, ignore) rows for
+        a .deb, an empty list if it was not processed yet.
+        '''
+        sql = """select export_path, metadata, ignore from dep11_cache
+        where sha256sum = :sha256sum order by id"""
+        return self._session.execute(sql, {"sha256sum": sha256sum}).fetchall()
+
+    def restore(self, sha256sum, export_path):
+        '''
+        Fills the export path of a binary from the cache and returns its
+        [metadata, ignore] docs for bin_dep11, or None if there is no
+        cached data for sha256sum.
+        '''
+        if not sha256sum:
+            return None
+        rows = self.lookup(sha256sum)
+        if not rows:
+            return None
+
+        docs = list()
+        new_path = os.path.relpath(export_path, Config()["Dir::MetaInfo"])
+        for old_path, metadata, ignore in rows:
+            # screenshot urls point into the export path of the binary the
+            # data was extracted from
+            docs.append([metadata.replace(old_path, new_path), ignore])
+        link_tree(self._media_dir(sha256sum), export_path)
+        return docs
+
+    def store(self, sha256sum, export_path, docs):
+        '''
+        Stores the (metadata, ignore) docs and the media extracted for a
+        .deb. The caller is responsible for committing the session.
+        '''
+        if not sha256sum:
+            return
+        self._session.execute("delete from dep11_cache where sha256sum = :sha256sum",
+                              {"sha256sum": sha256sum})
+        params = {
+            "sha256sum": sha256sum,
+            "export_path": os.path.relpath(export_path, Config()["Dir::MetaInfo"]),
+        }
+        sql = """insert into dep11_cache(sha256sum, export_path, metadata, ignore)
+        VALUES (:sha256sum, :export_path, :metadata, :ignore)"""
+        for metadata, ignore in docs:
+            params["metadata"] = metadata
+            params["ignore"] = ignore
+            self._session.execute(sql, params)
+        link_tree(export_path, self._media_dir(sha256sum))
+
+    def expire(self):
+        '''
+        Drops cache entries for .debs which are no longer in the pool.
+        '''
+        sql = """delete from dep11_cache where sha256sum not in
+        (select sha256sum from files where sha256sum is not null)
+        returning sha256sum"""
+        gone = set([r[0] for r in self._session.execute(sql)])
+        self._session.commit()
+        for sha256sum in gone:
+            media_dir = self._media_dir(sha256sum)
+            if os.path.isdir(media_dir):
+                print("Removing DEP-11 cache directory: %s" % (media_dir))
+                rmtree(media_dir)
+
+def export_path_for(suite_name, component, pkgname, binid):
+    '''
+    Returns the directory icons and screenshots of a binary are stored in.
+    '''
+    return "%s/%s/%s/%s-%s" % (Config()["Dir::MetaInfo"], suite_name,
+                               component, pkgname, str(binid))
+
+def make_url(path):
+    '''
+    Returns the URL of a file below Dir::MetaInfo. DEP11::Url is the base
+    URL Dir::MetaInfo is published under; without it the URL is relative.
+    '''
+    relpath = os.path.relpath(path, Config()["Dir::MetaInfo"])
+    base_url = Config().find("DEP11::Url")
+    if base_url:
+        return "%s/%s" % (base_url.rstrip('/'), relpath)
+    return relpath
+
+def link_file(src, dst):
+    '''
+    Hardlinks (or copies, across filesystems) src to dst, replacing dst.
+    '''
+    if not os.path.isdir(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    if os.path.exists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def link_tree(src, dst):
+    '''
+    Hardlinks all files below src into dst, copying them if src and dst are
+    on different filesystems. Existing files in dst are kept.
+    '''
+    if not os.path.isdir(src):
+        return
+    for root, dirs, files in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for name in files:
+            target = os.path.join(target_dir, name)
+            if os.path.exists(target):
+                continue
+            try:
+                os.link(os.path.join(root, name), target)
+            except OSError:
+                shutil.copy2(os.path.join(root, name), target)
+
 def usage():
     print("""Usage: dak generate_metadata -s <suitename> [OPTION]
 Extract DEP-11 metadata for the specified suite.
@@ -120,6 +287,16 @@ class DEP11YAMLDumper(yaml.Dumper):
         return super(DEP11YAMLDumper, self).increase_indent(flow, False)
 
 
+def dump_component(dic):
+    '''
+    Returns a serialized component as YAML document
+    '''
+    return yaml.dump(dic, Dumper=DEP11YAMLDumper,
+                     default_flow_style=False, explicit_start=True,
+                     explicit_end=False, width=100, indent=2,
+                     allow_unicode=True)
+
+
 class ProvidedItemType(object):
     '''
     Types supported as publicly provided interfaces. Used as keys in
@@ -365,16 +542,118 @@ class ComponentData:
             dic['CompulsoryForDesktops'] = self.compulsory_for_desktop
         return dic
 
+    def serialize_to_yaml(self):
+        '''
+        Return the properties as YAML document
+        '''
+        return dump_component(self.serialize_to_dic())
+
+
+class DebDataReader:
+    '''
+    Reads everything DEP-11 extraction needs from the data.tar member of a
+    .deb in a single pass: the file list, the contents of the wanted
+    metainfo files, the symlinks and the contents of the icons referenced
+    by the metainfo files plus the first icon candidate as a fallback.
+
+    Icons which come before the file referencing them in data.tar are not
+    collected; they have to be extracted from the .deb again.
+    '''
+
+    def __init__(self, deb, wanted_files, icon_references=None):
+        '''
+        Takes an apt_inst.DebFile and the list of metainfo files to collect.
+        icon_references is called with the path and the contents of each
+        metainfo file and returns the paths of the icons it references.
+        '''
+        self._deb = deb
+        self._wanted = set(wanted_files)
+        self._icon_references = icon_references
+        self._wanted_icons = set()
+        self.filelist = None
+        self.files = dict()
+        self.icons = dict()
+        self.links = dict()
+        self.fallback_icon = None
+
+    def _is_icon_candidate(self, path):
+        '''
+        Checks whether a path might be an icon we want to cache later.
+        '''
+        if not path.endswith(icon_extensions):
+            return False
+        return 'pixmaps' in path or 'icons' in path
+
+    def _link_target(self, member):
+        '''
+        Returns the path of the member a symlink or hardlink points to, in
+        the same form as the member names.
+        '''
+        prefix = './' if member.name.startswith('./') else ''
+        target = member.linkname
+        if member.issym() and not target.startswith('/'):
+            target = os.path.join(os.path.dirname(member.name), target)
+        return prefix + os.path.normpath(target).lstrip('/')
+
+    def resolve(self, path):
+        '''
+        Follows the links seen so far, returns the path of the file a path
+        finally points to.
+        '''
+        seen = set()
+        while path in self.links and path not in seen:
+            seen.add(path)
+            path = self.links[path]
+        return path
+
+    def _collect(self, member, data):
+        '''
+        Callback for TarFile.go(), called once per member of data.tar.
+        '''
+        name = member.name
+        self.filelist.append(name)
+        if self.fallback_icon is None and self._is_icon_candidate(name):
+            self.fallback_icon = name
+            self._wanted_icons.add(name)
+        if member.issym() or member.islnk():
+            self.links[name] = self._link_target(member)
+            if name in self._wanted_icons:
+                self._wanted_icons.add(self.resolve(name))
+            return
+        if not member.isfile():
+            return
+        if name in self._wanted:
+            self.files[name] = data
+            if self._icon_references:
+                for path in self._icon_references(name, data):
+                    self._wanted_icons.add(self.resolve(path))
+        elif name in self._wanted_icons:
+            self.icons[name] = data
+
+    def read(self):
+        '''
+        Decompresses data.tar once and collects all interesting data.
+        Returns False if the data.tar member could not be read.
+        '''
+        self.filelist = list()
+        try:
+            self._deb.data.go(self._collect)
+        except SystemError:
+            self.filelist = None
+            return False
+        return True
+
 
 class MetadataExtractor:
     '''
     Takes a deb file and extracts component metadata from it.
     '''
 
-    def __init__(self, suite_name, component, pkgname, metainfo_files, binid, pkg_fname):
+    def __init__(self, suite_name, component, pkgname, metainfo_files, binid, pkg_fname, icon_index=None):
         '''
         Initialize the object with List of files.
         '''
+        self._icon_index = icon_index
         self._filename = pkg_fname
         self._deb = None
         try:
@@ -388,166 +667,115 @@ class MetadataExtractor:
         self._mfiles = metainfo_files
         self._binid = binid
 
-        self._export_path = "%s/%s/%s/%s-%s" % (Config()["Dir::MetaInfo"],
-                                self._suite_name, self._component,
-                                self._pkgname, str(self._binid))
-
-    def _deb_filelist(self):
-        '''
-        Returns a list of all files in a deb package
-        '''
-        files = list()
-        if not self._deb:
-            return files
-        try:
-            self._deb.data.go(lambda item, data: files.append(item.name))
-        except SystemError:
-            print ("ERROR: List of files for '%s' could not be read" % (self._filename))
-            return None
-
-        return files
-
-    def _scale_screenshots(self, imgsrc, path):
-        '''
-        scale images in three sets of two-dimensions
-        (752x423 624x351 and 112x63)
-        '''
-        thumbnails = []
-        name = imgsrc.split('/').pop()
-        sizes = ['752x423', '624x351', '112x63']
-        for size in sizes:
-            wd, ht = size.split('x')
-            img = Image.open(imgsrc)
-            newimg = img.resize((int(wd), int(ht)), Image.ANTIALIAS)
-            newpath = path+size+"/"
-            if not os.path.exists(newpath):
-                os.makedirs(os.path.dirname(newpath))
-            newimg.save(newpath+name)
-            url = self.make_url(newpath+name)
-            thumbnails.append({'url': url, 'height': int(ht),
-                               'width': int(wd)})
-
-        return thumbnails
+        self._export_path = export_path_for(self._suite_name, self._component,
+                                            self._pkgname, self._binid)
+        # False once the result depends on the suite, it must not be stored
+        # in the DEP11Cache then
+        self.cacheable = True
 
-    def _fetch_screenshots(self, cpt):
+    def _store_icon(self, cpt, icon, icon_data=None, filepath=None, member=None):
         '''
-        Fetches screenshots from the given url and
-        stores it in png format.
-        '''
-        if cpt.screenshots:
-            success = True
-            shots = list()
-            cnt = 1
-            for shot in cpt.screenshots:
-                origin_url = shot['source-image']['url']
-                try:
-                    image = urllib.urlopen(origin_url).read()
-                    path = "%s/screenshots/" % (self._export_path)
-                    if not os.path.exists(path):
-                        os.makedirs(os.path.dirname(path + "source/"))
-                    f = open('%ssource/screenshot-%s.png' % (path, str(cnt)), 'wb')
-                    f.write(image)
-                    f.close()
-                except Exception as e:
-                    print("Error while downloading screenshot from '%s' for component '%s': %s" % (origin_url, cpt.ID, str(e)))
-                    success = False
-                    continue
-
-                try:
-                    img = Image.open('%ssource/screenshot-%s.png' % (path, str(cnt)))
-                    wd, ht = img.size
-                    shot['source-image']['width'] = wd
-                    shot['source-image']['height'] = ht
-                    shot['source-image']['url'] = self.make_url(
-                        '%ssource/screenshot-%s.png' % (path, str(cnt)))
-                    img.close()
-                except Exception as e:
-                    print("Error while reading screenshot data for 'screenshot-%s.png' of component '%s': %s" % (str(cnt), cpt.ID, str(e)))
-                    success = False
-                    continue
-
-                # scale_screenshots will return a list of
-                # dicts with {height,width,url}
-                shot['thumbnails'] = self._scale_screenshots(
-                    '%ssource/screenshot-%s.png' % (path, str(cnt)), path)
-                shots.append(shot)
-                print("New screenshot cached from %s" % (origin_url))
-                cnt = cnt + 1
-
-            cpt.screenshots = shots
-            return success
-
-        # don't ignore metadata if screenshots itself is not present
-        return True
-
-    def _store_icon(self, cpt, icon, filepath):
-        '''
-        Extracts the icon from the deb package and stores it in the cache.
+        Stores the icon in the cache. The icon data was either collected
+        while reading this package, or member (default: icon) is extracted
+        from the .deb at filepath. cpt.icon is only set if that worked.
         '''
         path = "%s/icons/" % (self._export_path)
         icon_name = "%s_%s" % (self._pkgname, os.path.basename(icon))
-        cpt.icon = icon_name
 
         icon_store_location = "{0}/{1}".format(path, icon_name)
         if os.path.exists(icon_store_location):
             # we already extracted that icon, skip this step
+            cpt.icon = icon_name
             return True
 
         # filepath is checked because icon can reside in another binary
         # eg amarok's icon is in amarok-data
-        if os.path.exists(filepath):
+        if icon_data is None and filepath and os.path.exists(filepath):
             try:
-                icon_data = DebFile(filepath).data.extractdata(icon)
+                icon_data = DebFile(filepath).data.extractdata(member or icon)
             except Exception as e:
                 print("Error while extracting icon '%s': %s" % (filepath, e))
+                cpt.icon = None
                 return False
 
-            if icon_data:
-                if not os.path.exists(path):
-                    os.makedirs(os.path.dirname(path))
-                f = open(icon_store_location, "wb")
-                f.write(icon_data)
-                f.close()
-                #! print("Saved icon %s." % (icon_name))
-                return True
+        if icon_data:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path))
+            f = open(icon_store_location, "wb")
+            f.write(icon_data)
+            f.close()
+            #! print("Saved icon %s." % (icon_name))
+            cpt.icon = icon_name
+            return True
+        cpt.icon = None
         return False
 
-    def _fetch_icon(self, cpt, filelist):
+    def _store_own_icon(self, cpt, icon, reader):
+        '''
+        Stores an icon of this package. Symlinks are followed, and the
+        icon is extracted from the .deb again if the reader did not
+        collect its data.
+        '''
+        member = reader.resolve(icon)
+        return self._store_icon(cpt, icon, reader.icons.get(member),
+                                filepath=self._filename, member=member)
+
+    def _icon_path(self, icon):
+        '''
+        Returns the file name an Icon value refers to. Without a file
+        extension, the referenced icon is likely a stock icon, and we
+        assume .png
+        '''
+        if not "." in os.path.basename(icon):
+            icon = icon + ".png"
+        return icon
+
+    def _icon_references(self, meta_file, dcontent):
+        '''
+        Returns the data.tar paths of the icons a .desktop file references,
+        so the DebDataReader can collect them while reading the package.
+        '''
+        paths = list()
+        if not meta_file.endswith('.desktop'):
+            return paths
+        for line in dcontent.splitlines():
+            line = self._strip_comment(line)
+            if not line or not "=" in line:
+                continue
+            key, value = line.split("=", 1)
+            if key.strip() == 'Icon' and value.strip():
+                paths.append(self._icon_path(value.strip())[1:])
+        return paths
+
+    def _fetch_icon(self, cpt, reader):
         '''
         Searches for icon if absolute path to an icon
         is not given. Component with invalid icons are ignored
         '''
+        filelist = reader.filelist
         if cpt.icon:
-            icon = cpt.icon
-            cpt.icon = os.path.basename (icon)
-
-            # check if there is some kind of file-extension.
-            # if there is none, the referenced icon is likely a stock icon, and we assume .png
-            if not "." in cpt.icon:
-                icon = icon + ".png"
+            icon = self._icon_path(cpt.icon)
+            cpt.icon = os.path.basename (cpt.icon)
 
-            if not icon.endswith(('.png', '.svg', '.ico', '.xcf', '.gif', '.svgz')):
+            if not icon.endswith(icon_extensions):
                 cpt.ignore_reason = "Icon file '%s' uses an unsupported image file format." % (cpt.icon)
                 return False
 
             if icon[1:] in filelist:
-                return self._store_icon(cpt, icon[1:], self._filename)
+                return self._store_own_icon(cpt, icon[1:], reader)
             else:
-                ext_allowed = ('.png', '.svg', '.ico', '.xcf', '.gif', '.svgz')
-                for path in filelist:
-                    if path.endswith(ext_allowed):
-                        if 'pixmaps' in path or 'icons' in path:
-                            return self._store_icon(cpt, path, self._filename)
-
-                # the IconFinder runs it's own, new session, since we run multiprocess here
-                ficon = IconFinder(self._pkgname, icon, self._binid)
-                flist = ficon.query_icon()
-                ficon.close()
-
-                if flist:
-                    filepath = (Config()["Dir::Pool"] +
-                                cpt._component + '/' + flist[1])
-                    return self._store_icon(cpt, flist[0], filepath)
+                if reader.fallback_icon is not None:
+                    return self._store_own_icon(cpt, reader.fallback_icon, reader)
+
+                # look for the icon in other packages of the suite
+                self.cacheable = False
+                match = None
+                if self._icon_index:
+                    match = self._icon_index.find(icon, self._pkgname, self._binid)
+
+                if match:
+                    filepath = os.path.join(Config()["Dir::Pool"], match[1])
+                    return self._store_icon(cpt, match[0], filepath=filepath)
 
                 cpt.ignore_reason = "Icon '%s' was not found in the archive." % (cpt.icon)
                 return False
@@ -853,8 +1081,11 @@ class MetadataExtractor:
         if not self._deb:
             return list()
         suitename = self._suite_name
-        filelist = self._deb_filelist()
-        component_dict = dict()
+        # decompress data.tar only once, collecting everything we need later
+        reader = DebDataReader(self._deb, self._mfiles, self._icon_references)
+        if not reader.read():
+            print ("ERROR: List of files for '%s' could not be read" % (self._filename))
+        filelist = reader.filelist
 
         if not filelist:
             compdata = ComponentData(suitename, self._component, self._binid, self._pkgname)
@@ -868,12 +1099,11 @@ class MetadataExtractor:
                 xml_content = None
                 compdata = ComponentData(suitename, self._component, self._binid, self._pkgname)
 
-                try:
-                    xml_content = str(self._deb.data.extractdata(meta_file))
-                except Exception as e:
+                if meta_file not in reader.files:
                     # inability to read an AppStream XML file is a valid ignore reason, skip this package.
-                    compdata.ignore_reason = "Could not extract file '%s' from package '%s'. Error: %s" % (meta_file, self._filename, str(e))
+                    compdata.ignore_reason = "Could not extract file '%s' from package '%s'. Error: not a regular file in data.tar" % (meta_file, self._filename)
                     return [compdata]
+                xml_content = str(reader.files[meta_file])
                 if xml_content:
                     self._read_xml(xml_content, compdata)
                     # Reads the desktop files associated with the xml file
@@ -885,11 +1115,10 @@ class MetadataExtractor:
             else:
                 # We have a .desktop file
                 dcontent = None
-                try:
-                    dcontent = str(self._deb.data.extractdata(meta_file))
-                except Exception as e:
-                    print("Could not extract file '%s' from package '%s'. Error: %s" % (meta_file, self._filename, str(e)))
+                if meta_file not in reader.files:
+                    print("Could not extract file '%s' from package '%s'. Error: not a regular file in data.tar" % (meta_file, self._filename))
                     continue
+                dcontent = str(reader.files[meta_file])
                 if not dcontent:
                     continue
                 cpt_id = os.path.basename(meta_file)
@@ -902,60 +1131,225 @@ class MetadataExtractor:
                 if not compdata.ignore_reason:
                     component_dict[cpt_id] = compdata
 
+        # screenshots are fetched later, by the ScreenshotStage
         for cpt in component_dict.values():
-            self._fetch_icon(cpt, filelist)
+            self._fetch_icon(cpt, reader)
             if cpt.kind == 'desktop-app' and not cpt.icon:
                 if not cpt.ignore_reason:
                     cpt.ignore_reason = "GUI application, but no valid icon found."
-            else:
-                self._fetch_screenshots(cpt)
 
         return component_dict.values()
 
+class ScreenshotStage:
+    '''
+    Fetches and scales the screenshots of components in background threads
+    of the parent process, while the workers go on extracting packages.
+    Downloads are cached by URL and revalidated using their ETag, see
+    daklib.screenshots.
+    '''
+
+    def __init__(self):
+        cnf = Config()
+        cache = MediaCache(os.path.join(cnf["Dir::MetaInfo"], "media-cache"),
+                           max_age=cnf.find_i("DEP11::ScreenshotMaxAge", 86400))
+        self._fetcher = ScreenshotFetcher(cache, screenshot_sizes,
+                                          threads=cnf.find_i("DEP11::ScreenshotThreads", 8),
+                                          per_host=cnf.find_i("DEP11::ScreenshotsPerHost", 2),
+                                          timeout=cnf.find_i("DEP11::ScreenshotTimeout", 30))
+        # (token, yamldoc, complete) of finished components
+        self.done = Queue.Queue()
+
+    def submit(self, dic, export_path, token):
+        '''
+        Fetches the screenshots of the serialized component dic. Once all
+        of them are handled, (token, yamldoc, complete) is put into
+        self.done, complete is False if some screenshot could not be stored.
+        '''
+        shots = dic['Screenshots']
+        results = [None] * len(shots)
+        left = [len(shots)]
+        lock = threading.Lock()
+
+        def make_callback(index):
+            def callback(url, result, error):
+                if error:
+                    print("Error while fetching screenshot from '%s' for component '%s': %s" % (url, dic.get('ID'), str(error)))
+                with lock:
+                    results[index] = result
+                    left[0] -= 1
+                    finished = left[0] == 0
+                if finished:
+                    self._finish(dic, export_path, results, token)
+            return callback
+
+        for index, shot in enumerate(shots):
+            self._fetcher.submit(shot['source-image']['url'], make_callback(index))
+
+    def _finish(self, dic, export_path, results, token):
+        '''
+        Links the cached screenshots of a component into its export path
+        and queues its YAML document.
+        '''
+        complete = all(results)
+        try:
+            path = "%s/screenshots/" % (export_path)
+            shots = list()
+            for shot, result in zip(dic['Screenshots'], results):
+                if not result:
+                    continue
+                name = "screenshot-%d.png" % (len(shots) + 1)
+                link_file(result['source'], path + "source/" + name)
+                shot['source-image'] = {'url': make_url(path + "source/" + name),
+                                        'width': result['width'],
+                                        'height': result['height']}
+                shot['thumbnails'] = list()
+                for size, thumbnail in result['thumbnails']:
+                    wd, ht = size.split('x')
+                    link_file(thumbnail, path + size + "/" + name)
+                    shot['thumbnails'].append({'url': make_url(path + size + "/" + name),
+                                               'height': int(ht), 'width': int(wd)})
+                shots.append(shot)
+            if shots:
+                dic['Screenshots'] = shots
+            else:
+                del dic['Screenshots']
+        except Exception as e:
+            print("Error while storing screenshots for component '%s': %s" % (dic.get('ID'), str(e)))
+            dic.pop('Screenshots', None)
+            complete = False
+        self.done.put((token, dump_component(dic), complete))
+
+    def close(self):
+        '''
+        Stops the fetcher threads.
+        '''
+        self._fetcher.close()
+
+
 class MetadataPool:
     '''
-    Keeps a pool of component metadata per arch per component
+    Collects the serialized component metadata of one suite/component and
+    writes it to the database in batches, so memory use does not depend on
+    the size of the component.
     '''
 
-    def __init__(self, values):
+    def __init__(self, values, session, batch_size=1000, screenshots=None, max_waiting=200):
         '''
-        Sets the archname of the metadata pool.
+        Sets the suite/component of the metadata pool. At most max_waiting
+        components wait for their screenshots at a time, append_cptdata
+        blocks until the ScreenshotStage catches up otherwise.
         '''
         self._values = values
-        self._mcpts = dict()
-
-    def append_cptdata(self, arch, compdatalist):
+        self._session = session
+        self._batch_size = batch_size
+        self._screenshots = screenshots
+        self._max_waiting = max_waiting
+        # token -> [package entry, components still waiting for screenshots,
+        # whether all screenshots could be stored]
+        self._waiting = dict()
+        self._waiting_count = 0
+        self._next_token = 0
+        self._dep11 = DEP11Metadata(session)
+        self._cache = DEP11Cache(session)
+        # component IDs seen so far, per arch
+        self._seen = dict()
+        self._pending = list()
+        self._pending_count = 0
+
+    def append_cptdata(self, arch, cpts, sha256sum=None):
         '''
-        makes a list of all the componentdata objects in a arch pool
+        Queues the (ID, binid, pkgname, metadata, ignore) tuples extracted
+        from one package for insertion, flushing every batch_size components.
+        metadata is either a YAML document or, for components whose
+        screenshots still need to be fetched, the serialized dict. Without
+        sha256sum the data is not stored in the DEP11Cache.
         '''
-        cpts = self._mcpts.get(arch)
-        if not cpts:
-            self._mcpts[arch] = dict()
-            cpts = self._mcpts[arch]
-        for c in compdatalist:
-            if cpts.get(c.ID):
-                print("WARNING: Duplicate ID detected: %s" % (c.ID))
+        seen = self._seen.setdefault(arch, set())
+        docs = list()
+        for cpt_id, binid, pkgname, metadata, ignore in cpts:
+            if cpt_id in seen:
+                print("WARNING: Duplicate ID detected: %s" % (cpt_id))
                 continue
-            cpts[c.ID] = c
-
-    def export(self, session):
-        """
-        Saves metadata in db (serialized to YAML)
-        """
-        for arch, cpts in self._mcpts.items():
-            values = self._values
-            values['architecture'] = arch
-            dep11 = DEP11Metadata(session)
-            for cdata in cpts.values():
-                # get the metadata in YAML format
-                metadata = yaml.dump(cdata.serialize_to_dic(), Dumper=DEP11YAMLDumper,
-                            default_flow_style=False, explicit_start=True,
-                            explicit_end=False, width=100, indent=2,
-                            allow_unicode=True)
-                # store metadata in database
-                dep11.insertdata(cdata._binid, metadata, cdata.ignore_reason != None)
-        # commit all changes
-        session.commit()
+            seen.add(cpt_id)
+            docs.append([metadata, ignore])
+        if docs:
+            export_path = export_path_for(self._values['suite'], self._values['component'],
+                                          pkgname, binid)
+            entry = (sha256sum, binid, export_path, docs)
+            shots = [i for i, doc in enumerate(docs) if isinstance(doc[0], dict)]
+            if shots:
+                # keep the memory of the parent bounded if the fetcher is slow
+                self._collect(block=True, limit=max(0, self._max_waiting - len(shots)))
+                self._waiting_count += len(shots)
+                token = self._next_token
+                self._next_token += 1
+                self._waiting[token] = [entry, len(shots), True]
+                for i in shots:
+                    self._screenshots.submit(docs[i][0], export_path, (token, i))
+            else:
+                self._queue(entry)
+        self._collect(block=False)
+
+    def append_restored(self, binid, export_path, docs):
+        '''
+        Queues the docs of a package restored from the DEP11Cache.
+        '''
+        self._queue((None, binid, export_path, docs))
+
+    def _queue(self, entry):
+        '''
+        Queues the docs of a package for the next flush
+        '''
+        self._pending.append(entry)
+        self._pending_count += len(entry[3])
+        if self._pending_count >= self._batch_size:
+            self.flush()
+
+    def _collect(self, block, limit=0):
+        '''
+        Picks up components whose screenshots are done. If block is True,
+        waits until at most limit components are left waiting.
+        '''
+        while self._waiting_count > limit:
+            try:
+                (token, index), metadata, complete = self._screenshots.done.get(block)
+            except Queue.Empty:
+                return
+            entry = self._waiting[token]
+            entry[0][3][index][0] = metadata
+            entry[1] -= 1
+            self._waiting_count -= 1
+            entry[2] = entry[2] and complete
+            if entry[1] == 0:
+                del self._waiting[token]
+                if not entry[2]:
+                    # failed fetches are retried next run, don't cache them
+                    entry[0] = (None, ) + entry[0][1:]
+                self._queue(entry[0])
+
+    def finish(self):
+        '''
+        Waits for outstanding screenshots and saves everything left.
+        '''
+        self._collect(block=True)
+        self.flush()
+
+    def flush(self):
+        '''
+        Saves the queued metadata in db, replacing any older rows of the
+        same binaries, and remembers it per .deb, so other suites can
+        reuse it.
+        '''
+        rows = list()
+        for sha256sum, binid, export_path, docs in self._pending:
+            rows.extend([(binid, metadata, ignore) for metadata, ignore in docs])
+            # restored and suite specific entries come without sha256sum
+            if sha256sum is not None:
+                self._cache.store(sha256sum, export_path, docs)
+        self._dep11.replacemany(rows)
+        self._session.commit()
+        self._pending = list()
+        self._pending_count = 0
 
 ##############################################################################
 
@@ -977,13 +1371,32 @@ def make_icon_tar(suitename, component):
 
     tar.close()
 
-def extract_metadata(sn, c, pkgname, metainfo_files, binid, package_fname, arch):
-    mde = MetadataExtractor(sn, c, pkgname, metainfo_files, binid, package_fname)
-    cpt_list = mde.get_cptdata()
+# icon indexes opened by this (worker) process, by filename
+_icon_indexes = dict()
+
+def extract_metadata(sn, c, pkgname, metainfo_files, binid, package_fname, arch, sha256sum=None, icon_index_fname=None):
+    icon_index = None
+    if icon_index_fname:
+        icon_index = _icon_indexes.get(icon_index_fname)
+        if not icon_index:
+            icon_index = _icon_indexes[icon_index_fname] = IconIndex(icon_index_fname)
+    mde = MetadataExtractor(sn, c, pkgname, metainfo_files, binid, package_fname, icon_index)
+    # serialize here, so only small strings travel back to the parent
+    # components with screenshots are finished by the ScreenshotStage
+    cpt_list = list()
+    for cpt in mde.get_cptdata():
+        if cpt.screenshots and not cpt.ignore_reason:
+            metadata = cpt.serialize_to_dic()
+        else:
+            metadata = cpt.serialize_to_yaml()
+        cpt_list.append((cpt.ID, cpt._binid, cpt._pkg, metadata,
+                         cpt.ignore_reason != None))
 
     data = dict()
     data['arch'] = arch
     data['cpts'] = cpt_list
+    data['sha256'] = sha256sum
+    data['cacheable'] = mde.cacheable
     data['message'] = "Processed package: %s (%s/%s)" % (pkgname, sn, arch)
     return (PROC_STATUS_SUCCESS, data)
 
@@ -991,90 +1404,158 @@ def process_suite(session, suite, logger, force=False):
     '''
     Run by main to loop for different component and architecture.
     '''
-    path = Config()["Dir::Pool"]
+    cnf = Config()
 
     if suite.untouchable and not force:
         import daklib.utils
         daklib.utils.fubar("Refusing to touch %s (untouchable and not forced)" % suite.suite_name)
         return
 
-    for component in [ c.component_name for c in suite.components ]:
-        mif = MetaInfoFinder(session)
-        pkglist = mif.find_meta_files(component=component, suitename=suite.suite_name)
+    # index of all icons in the suite, shared by all workers via mmap
+    fd, icon_index_fname = tempfile.mkstemp(prefix='dep11-icons.', dir=cnf["Dir::TempPath"])
+    os.close(fd)
+    icon_count = IconIndex.build(session, suite.suite_name, icon_index_fname)
+    logger.log(["Indexed %d icons in suite %s" % (icon_count, suite.suite_name)])
 
-        values = {
-            'archive': suite.archive.path,
-            'suite': suite.suite_name,
-            'component': component,
-        }
+    # fork the workers before the screenshot threads are started
+    pool = DakProcessPool()
+    screenshots = ScreenshotStage()
+    try:
+        for component in [ c.component_name for c in suite.components ]:
+            process_component(session, suite, component, logger, pool, icon_index_fname, screenshots)
+    finally:
+        screenshots.close()
+        pool.close()
+        pool.join()
+        os.unlink(icon_index_fname)
 
-        pool = DakProcessPool()
-        dpool = MetadataPool(values)
-
-        def parse_results(message):
-            # Split out into (code, msg)
-            code, msg = message
-            if code == PROC_STATUS_SUCCESS:
-                # we abuse the message return value here...
-                logger.log([msg['message']])
-                dpool.append_cptdata(msg['arch'], msg['cpts'])
-            elif code == PROC_STATUS_SIGNALRAISED:
-                logger.log(['E: Subprocess recieved signal ', msg])
-            else:
-                logger.log(['E: ', msg])
+def process_component(session, suite, component, logger, pool, icon_index_fname, screenshots):
+    '''
+    Extracts the metadata of all new packages of one component of a suite.
+    '''
+    cnf = Config()
+    path = cnf["Dir::Pool"]
+    mif = MetaInfoFinder(session)
+    pkglist = mif.find_meta_files(component=component, suitename=suite.suite_name)
 
+    values = {
+        'archive': suite.archive.path,
+        'suite': suite.suite_name,
+        'component': component,
+    }
 
+    dpool = MetadataPool(values, session, cnf.find_i("DEP11::BatchSize", 1000), screenshots,
+                         cnf.find_i("DEP11::MaxScreenshotComponents", 200))
+    cache = DEP11Cache(session)
+
+    def jobs():
         for pkgname, pkg in pkglist.items():
             for arch, data in pkg.items():
                 package_fname = os.path.join (path, data['filename'])
                 if not os.path.exists(package_fname):
                     print('Package not found: %s' % (package_fname))
                     continue
-                pool.apply_async(extract_metadata,
-                            (suite.suite_name, component, pkgname, data['files'], data['binid'], package_fname, arch), callback=parse_results)
-        pool.close()
-        pool.join()
-
-        # Save metadata of all binaries of the Components-arch
-        # This would require a lock
-        dpool.export(session)
-        make_icon_tar(suite.suite_name, component)
-
-        logger.log(["Completed metadata extraction for suite %s/%s" % (suite.suite_name, component)])
+                # this very .deb may have been processed for another suite before
+                export_path = export_path_for(suite.suite_name, component, pkgname, data['binid'])
+                docs = cache.restore(data['sha256'], export_path)
+                if docs:
+                    dpool.append_restored(data['binid'], export_path, docs)
+                    logger.log(["Restored cached metadata: %s (%s/%s)" % (pkgname, suite.suite_name, arch)])
+                    continue
+                yield (suite.suite_name, component, pkgname, data['files'], data['binid'], package_fname, arch, data['sha256'], icon_index_fname)
+
+    # results are consumed while the workers are still busy; a bounded
+    # number of them is in flight, so they never pile up in the parent
+    max_pending = cnf.find_i("DEP11::MaxPending", 200)
+    for code, msg in pool.imap_bounded(extract_metadata, jobs(), max_pending):
+        if code == PROC_STATUS_SUCCESS:
+            # we abuse the message return value here...
+            logger.log([msg['message']])
+            # data found through the icon index is only valid for this suite
+            sha256sum = msg['sha256'] if msg['cacheable'] else None
+            dpool.append_cptdata(msg['arch'], msg['cpts'], sha256sum)
+        elif code == PROC_STATUS_SIGNALRAISED:
+            logger.log(['E: Subprocess recieved signal ', msg])
+        else:
+            logger.log(['E: ', msg])
+
+    # Save the remaining metadata of all binaries of the Components-arch
+    dpool.finish()
+    make_icon_tar(suite.suite_name, component)
+
+    logger.log(["Completed metadata extraction for suite %s/%s" % (suite.suite_name, component)])
+
+def component_signature(head_string, index):
+    '''
+    Returns a digest of the header and the (binary_id, metadata hash) pairs
+    a Components-<arch> file is generated from.
+    '''
+    h = hashlib.sha1(head_string)
+    for binid, digest in index:
+        h.update("%d %s\n" % (binid, digest))
+    return h.hexdigest()
 
 def write_component_files(suite):
     '''
     Writes the metadata into Component-<arch>.xz
     Ignores if ignore is True in the db
+
+    Every file contains the documents of its own architecture only; the
+    arch:all documents go to Components-all. A file is left alone if the
+    documents it would contain are the same as the last time it was
+    written, which is tracked in Dir::MetaInfo/state/<suite>/<component>/.
     '''
     print("Writing DEP-11 files for %s" % (suite.suite_name))
     for component in [ c.component_name for c in suite.components ]:
-        # writing per <arch>
-        for arch in [ a.arch_string for a in suite.architectures ]:
-            if arch == "source":
-                continue
+        head_dict = dep11_header
+        head_dict['Origin'] = "%s-%s" % (suite.suite_name, component)
+        head_string = yaml.dump(head_dict, Dumper=DEP11YAMLDumper,
+                                default_flow_style=False, explicit_start=True,
+                                explicit_end=False, width=200, indent=2)
+        statedir = os.path.join(Config()["Dir::MetaInfo"], "state",
+                                suite.suite_name, component)
+        if not os.path.isdir(statedir):
+            os.makedirs(statedir)
+
+        dep11_data = BinDEP11Data({
+            'suite' : suite.suite_name,
+            'component' : component,
+        })
+        try:
+            # writing per <arch>
+            for arch in [ a.arch_string for a in suite.architectures ]:
+                if arch == "source":
+                    continue
+
+                values = {
+                    'archive' : suite.archive.path,
+                    'suite' : suite.suite_name,
+                    'component' : component,
+                    'architecture' : arch
+                }
+                writer = DEP11DataFileWriter(**values)
+                state_file = os.path.join(statedir, "Components-%s" % (arch))
+
+                signature = component_signature(head_string, dep11_data.fetch_index(arch))
+                try:
+                    with open(state_file) as fh:
+                        unchanged = fh.read().strip() == signature
+                except IOError:
+                    unchanged = False
+                if unchanged and os.path.exists(writer.path + ".xz"):
+                    continue
+
+                ofile = writer.open()
+                ofile.write(head_string)
+                for doc in dep11_data.fetch_docs(arch):
+                    ofile.write(doc)
+                writer.close()
 
-            head_dict = dep11_header
-            head_dict['Origin'] = "%s-%s" % (suite.suite_name, component)
-            head_string = yaml.dump(head_dict, Dumper=DEP11YAMLDumper,
-                                    default_flow_style=False, explicit_start=True,
-                                    explicit_end=False, width=200, indent=2)
-            values = {
-                'archive' : suite.archive.path,
-                'suite' : suite.suite_name,
-                'component' : component,
-                'architecture' : arch
-            }
-
-            writer = DEP11DataFileWriter(**values)
-            ofile = writer.open()
-            ofile.write(head_string)
-            dep11_data = BinDEP11Data(values)
-            res = dep11_data.fetch_docs()
-            for doc in res:
-                ofile.write(doc[0])
+                with open(state_file + ".new", 'w') as fh:
+                    fh.write(signature + "\n")
+                os.rename(state_file + ".new", state_file)
+        finally:
             dep11_data.close()
-            writer.close()
 
 def expire_dep11_data_cache(session, suitename):
     '''
@@ -1102,6 +1583,7 @@ def expire_dep11_data_cache(session, suitename):
             print("Removing DEP-11 cache directory: %s" % (fname))
             rmtree(fname)
 
+    DEP11Cache(session).expire()
     print("Cache pruned.")
 
 def main():
@@ -48,6 +48,16 @@ SUITE can be a space seperated list, e.g.
 
 #############################################################################
 
+def fetch_size():
+    """
+    Returns the number of rows fetched per round trip from the server-side
+    cursors the generate functions read their stanzas from.
+    """
+    from daklib.config import Config
+    return Config().find_i('Generate-Packages-Sources::FetchSize', 1000)
+
+#############################################################################
+
 # Here be dragons.
 _sources_query = R"""
 SELECT
@@ -104,10 +114,10 @@ s.source, s.version
 def generate_sources(suite_id, component_id):
     global _sources_query
     from daklib.filewriter import SourcesFileWriter
-    from daklib.dbconn import Component, DBConn, OverrideType, Suite
-    from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
+    from daklib.dbconn import Component, OverrideType, Suite, stream_query
+    from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS, worker_session
 
-    session = DBConn().session()
+    session = worker_session()
     dsc_type = session.query(OverrideType).filter_by(overridetype='dsc').one().overridetype_id
 
     suite = session.query(Suite).get(suite_id)
@@ -126,10 +136,9 @@ def generate_sources(suite_id, component_id):
     output = writer.open()
 
     # run query and write Sources
-    r = session.execute(_sources_query, {"suite": suite_id, "component": component_id, "component_name": component.component_name, "dsc_type": dsc_type, "overridesuite": overridesuite_id})
-    for (stanza,) in r:
-        print >>output, stanza
-        print >>output, ""
+    r = stream_query(session, _sources_query, {"suite": suite_id, "component": component_id, "component_name": component.component_name, "dsc_type": dsc_type, "overridesuite": overridesuite_id}, fetch_size())
+    for rows in r:
+        output.write("".join([stanza + "\n\n" for (stanza,) in rows]))
 
     writer.close()
 
@@ -223,10 +232,10 @@ ORDER BY tmp.source, tmp.package, tmp.version
 def generate_packages(suite_id, component_id, architecture_id, type_name):
     global _packages_query
     from daklib.filewriter import PackagesFileWriter
-    from daklib.dbconn import Architecture, Component, DBConn, OverrideType, Suite
-    from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
+    from daklib.dbconn import Architecture, Component, OverrideType, Suite, stream_query
+    from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS, worker_session
 
-    session = DBConn().session()
+    session = worker_session()
     arch_all_id = session.query(Architecture).filter_by(arch_string='all').one().arch_id
     type_id = session.query(OverrideType).filter_by(overridetype=type_name).one().overridetype_id
 
@@ -257,14 +266,14 @@ def generate_packages(suite_id, component_id, architecture_id, type_name):
     writer = PackagesFileWriter(**writer_args)
     output = writer.open()
 
-    r = session.execute(_packages_query, {"archive_id": suite.archive.archive_id,
+    r = stream_query(session, _packages_query, {"archive_id": suite.archive.archive_id,
         "suite": suite_id, "component": component_id, 'component_name': component.component_name,
         "arch": architecture_id, "type_id": type_id, "type_name": type_name, "arch_all": arch_all_id,
         "overridesuite": overridesuite_id, "metadata_skip": metadata_skip,
-        "include_long_description": 'true' if include_long_description else 'false'})
-    for (stanza,) in r:
-        print >>output, stanza
-        print >>output, ""
+        "include_long_description": 'true' if include_long_description else 'false'},
+        fetch_size())
+    for rows in r:
+        output.write("".join([stanza + "\n\n" for (stanza,) in rows]))
 
     writer.close()
 
@@ -308,10 +317,10 @@ ORDER BY MIN(s.source), b.package, bm_description_md5.value
 def generate_translations(suite_id, component_id):
     global _translations_query
     from daklib.filewriter import TranslationFileWriter
-    from daklib.dbconn import DBConn, Suite, Component
-    from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
+    from daklib.dbconn import Suite, Component, stream_query
+    from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS, worker_session
 
-    session = DBConn().session()
+    session = worker_session()
     suite = session.query(Suite).get(suite_id)
     component = session.query(Component).get(component_id)
 
@@ -326,9 +335,9 @@ def generate_translations(suite_id, component_id):
     writer = TranslationFileWriter(**writer_args)
     output = writer.open()
 
-    r = session.execute(_translations_query, {"suite": suite_id, "component": component_id})
-    for (stanza,) in r:
-        print >>output, stanza
+    r = stream_query(session, _translations_query, {"suite": suite_id, "component": component_id}, fetch_size())
+    for rows in r:
+        output.write("".join([stanza + "\n" for (stanza,) in rows]))
 
     writer.close()
 
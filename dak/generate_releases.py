@@ -37,6 +37,8 @@ import stat
 import time
 import gzip
 import bz2
+import hashlib
+import random
 import apt_pkg
 import subprocess
 from tempfile import mkstemp, mkdtemp
@@ -47,8 +49,9 @@ from daklib import utils, daklog
 from daklib.regexes import re_gensubrelease, re_includeinrelease
 from daklib.dak_exceptions import *
 from daklib.dbconn import *
+from daklib.checksumcache import ChecksumCache
 from daklib.config import Config
-from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
+from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS, worker_session
 import daklib.daksubprocess
 
 ################################################################################
@@ -67,6 +70,9 @@ Generate the Release files
                              Default: All suites not marked 'untouchable'
   -f, --force                Allow processing of untouchable suites
                              CAREFUL: Only to be used at (point) release time!
+  -V, --verify               Re-hash a sample (Generate-Releases::VerifyFraction,
+                             default 0.1) of the files found in the checksum
+                             cache and report mismatches
   -h, --help                 show this help and exit
   -q, --quiet                Don't output progress
 
@@ -109,16 +115,69 @@ def sign_release_dir(suite, dirname):
 class XzFile(object):
     def __init__(self, filename, mode='r'):
         self.filename = filename
-    def read(self):
-        cmd = ("xz", "-d")
-        with open(self.filename, 'r') as stdin:
-            process = daklib.daksubprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE)
-            (stdout, stderr) = process.communicate()
-            return stdout
+        self.stdin = open(self.filename, 'r')
+        self.process = daklib.daksubprocess.Popen(("xz", "-d"), stdin=self.stdin, stdout=subprocess.PIPE)
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+    def close(self):
+        self.process.stdout.close()
+        self.stdin.close()
+        if self.process.wait() != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, "xz -d")
+
+def hash_stream(fh, hashfuncs, chunk_size=1024 * 1024):
+    """
+    Computes the size and all checksums of the data read from fh in a single
+    pass, reading chunk_size bytes at a time.
+
+    @type hashfuncs: dict
+    @param hashfuncs: maps field names to hashlib constructors
+
+    @rtype: tuple
+    @return: (size, dict mapping the field names to hex digests)
+    """
+    hashes = dict([(name, func()) for name, func in hashfuncs.items()])
+    size = 0
+    while True:
+        chunk = fh.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        for h in hashes.values():
+            h.update(chunk)
+    return size, dict([(name, h.hexdigest()) for name, h in hashes.items()])
 
 class ReleaseWriter(object):
-    def __init__(self, suite):
+    def __init__(self, suite, verify=0.0):
+        """
+        @type verify: float
+        @param verify: fraction of the checksums found in the cache that
+                       are computed again and compared
+        """
         self.suite = suite
+        self.verify = verify
+
+    def checksum(self, cache, filename, opener, hashfuncs, stat_path=None):
+        """
+        Returns (size, checksums) of the data read from opener(), taken from
+        the checksum cache if the file did not change.
+        """
+        path = os.path.realpath(filename)
+        cached = cache.lookup(path)
+        if cached is not None and random.random() >= self.verify:
+            return cached
+
+        fh = opener()
+        try:
+            size, digests = hash_stream(fh, hashfuncs)
+        finally:
+            fh.close()
+        if cached is not None and cached != (size, digests):
+            print "W: checksum cache entry for %s is wrong, replacing it" % (path)
+        if stat_path is not None:
+            stat_path = os.path.realpath(stat_path)
+        cache.store(path, size, digests, stat_path)
+        return (size, digests)
 
     def generate_release_files(self):
         """
@@ -226,14 +285,17 @@ class ReleaseWriter(object):
 
         os.chdir(os.path.join(suite.archive.path, "dists", suite.suite_name, suite_suffix))
 
-        hashfuncs = { 'MD5Sum' : apt_pkg.md5sum,
-                      'SHA1' : apt_pkg.sha1sum,
-                      'SHA256' : apt_pkg.sha256sum }
+        hashfuncs = { 'MD5Sum' : hashlib.md5,
+                      'SHA1' : hashlib.sha1,
+                      'SHA256' : hashlib.sha256 }
 
         fileinfo = {}
 
         uncompnotseen = {}
 
+        cache = ChecksumCache(session)
+        cache.load(os.path.realpath(os.getcwd()))
+
         for dirpath, dirnames, filenames in os.walk(".", followlinks=True, topdown=True):
             for entry in filenames:
                 # Skip things we don't want to include
@@ -244,8 +306,6 @@ class ReleaseWriter(object):
                     continue
 
                 filename = os.path.join(dirpath.lstrip('./'), entry)
-                fileinfo[filename] = {}
-                contents = open(filename, 'r').read()
 
                 # If we find a file for which we have a compressed version and
                 # haven't yet seen the uncompressed one, store the possibility
@@ -257,10 +317,10 @@ class ReleaseWriter(object):
                 elif entry.endswith(".xz") and entry[:-3] not in uncompnotseen.keys():
                     uncompnotseen[filename[:-3]] = (XzFile, filename)
 
-                fileinfo[filename]['len'] = len(contents)
-
-                for hf, func in hashfuncs.items():
-                    fileinfo[filename][hf] = func(contents)
+                size, digests = self.checksum(cache, filename,
+                    lambda: open(filename, 'r'), hashfuncs)
+                fileinfo[filename] = dict(digests)
+                fileinfo[filename]['len'] = size
 
         for filename, comp in uncompnotseen.items():
             # If we've already seen the uncompressed file, we don't
@@ -273,16 +333,14 @@ class ReleaseWriter(object):
             if os.path.basename(filename).startswith("Contents"):
                 continue
 
-            fileinfo[filename] = {}
-
             # File handler is comp[0], filename of compressed file is comp[1]
-            contents = comp[0](comp[1], 'r').read()
-
-            fileinfo[filename]['len'] = len(contents)
-
-            for hf, func in hashfuncs.items():
-                fileinfo[filename][hf] = func(contents)
+            size, digests = self.checksum(cache, filename,
+                lambda: comp[0](comp[1], 'r'), hashfuncs, stat_path=comp[1])
+            fileinfo[filename] = dict(digests)
+            fileinfo[filename]['len'] = size
 
+        cache.expire(os.path.realpath(os.getcwd()), set([os.path.realpath(f) for f in fileinfo]))
+        cache.commit()
 
         for h in sorted(hashfuncs.keys()):
             out.write('%s:\n' % h)
@@ -304,7 +362,7 @@ def main ():
 
     cnf = Config()
 
-    for i in ["Help", "Suite", "Force", "Quiet"]:
+    for i in ["Help", "Suite", "Force", "Quiet", "Verify"]:
         if not cnf.has_key("Generate-Releases::Options::%s" % (i)):
             cnf["Generate-Releases::Options::%s" % (i)] = ""
 
@@ -313,6 +371,7 @@ def main ():
                  ('s',"suite","Generate-Releases::Options::Suite"),
                  ('f',"force","Generate-Releases::Options::Force"),
                  ('q',"quiet","Generate-Releases::Options::Quiet"),
+                 ('V',"verify","Generate-Releases::Options::Verify"),
                  ('o','option','','ArbItem')]
 
     suite_names = apt_pkg.parse_commandline(cnf.Cnf, Arguments, sys.argv)
@@ -343,6 +402,10 @@ def main ():
 
     broken=[]
 
+    verify = 0.0
+    if Options["Verify"]:
+        verify = float(cnf.find("Generate-Releases::VerifyFraction", "0.1"))
+
     for s in suites:
         # Setup a multiprocessing Pool. As many workers as we have CPU cores.
         if s.untouchable and not Options["Force"]:
@@ -352,7 +415,7 @@ def main ():
         if not Options["Quiet"]:
             print "Processing %s" % s.suite_name
         Logger.log(['Processing release file for Suite: %s' % (s.suite_name)])
-        pool.apply_async(generate_helper, (s.suite_id, ))
+        pool.apply_async(generate_helper, (s.suite_id, verify))
 
     # No more work will be added to our pool, close it and then wait for all to finish
     pool.close()
@@ -368,15 +431,15 @@ def main ():
 
     sys.exit(retcode)
 
-def generate_helper(suite_id):
+def generate_helper(suite_id, verify=0.0):
     '''
     This function is called in a new subprocess.
     '''
-    session = DBConn().session()
+    session = worker_session()
     suite = Suite.get(suite_id, session)
 
     # We allow the process handler to catch and deal with any exceptions
-    rw = ReleaseWriter(suite)
+    rw = ReleaseWriter(suite, verify)
     rw.generate_release_files()
 
     return (PROC_STATUS_SUCCESS, 'Release file written for %s' % suite.suite_name)
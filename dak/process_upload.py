@@ -163,6 +163,7 @@ import datetime
 import errno
 from errno import EACCES, EAGAIN
 import fcntl
+import itertools
 import os
 import sys
 import traceback
@@ -175,6 +176,7 @@ from daklib.dbconn import *
 from daklib.urgencylog import UrgencyLog
 from daklib.summarystats import SummaryStats
 from daklib.config import Config
+from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
 import daklib.utils as utils
 from daklib.regexes import *
 
@@ -195,6 +197,8 @@ def usage (exit_code=0):
   -a, --automatic           automatic run
   -d, --directory <DIR>     process uploads in <DIR>
   -h, --help                show this help and exit.
+  -j, --jobs=N              check up to N uploads in parallel, installing
+                            them one by one in the usual order
   -n, --no-action           don't do anything
   -p, --no-lock             don't check lockfile !! for cron.daily only !!
   -s, --no-mail             don't send any mail
@@ -356,7 +360,7 @@ def real_reject(directory, upload, reason=None, notify=True):
 
 ###############################################################################
 
-def action(directory, upload):
+def action(directory, upload, prechecked=False):
     changes = upload.changes
     processed = True
 
@@ -364,7 +368,7 @@ def action(directory, upload):
 
     cnf = Config()
 
-    okay = upload.check()
+    okay = upload.check(prechecked=prechecked)
 
     summary = changes.changes.get('Changes', '')
 
@@ -454,14 +458,63 @@ def unlink_if_exists(path):
         if e.errno != errno.ENOENT:
             raise
 
-def process_it(directory, changes, keyrings, session):
+def precheck_it(directory, filename, keyrings, sha1):
+    """
+    Runs the checks of an upload that only look at its files. This function
+    runs in a subprocess and does not change anything.
+
+    Returns C{True} if the checks passed for the .changes file whose
+    signed contents have the given SHA1, i.e. the one the main process
+    loaded, and C{False} if they failed or could not be run; the
+    upload is then fully checked again when it is processed.
+    """
+    try:
+        changes = daklib.upload.Changes(directory, filename, keyrings)
+        if not changes.valid_signature or changes.contents_sha1() != sha1:
+            return (PROC_STATUS_SUCCESS, False)
+        with daklib.archive.ArchiveUpload(directory, changes, keyrings) as upload:
+            return (PROC_STATUS_SUCCESS, upload.precheck())
+    except Exception as e:
+        # not fatal, but if every precheck fails (database, keyrings) we
+        # want to know why we are doing all the work twice
+        utils.warn("Precheck of {0} failed, it will be checked in full: {1}: {2}".format(
+            filename, type(e).__name__, e))
+        return (PROC_STATUS_SUCCESS, False)
+
+def prechecked_uploads(changes, keyring_files, jobs):
+    """
+    Yields C{(directory, changes, prechecked)} for the sorted list of
+    C{[directory, changes]} pairs. With more than one job, the uploads are
+    prechecked by L{precheck_it} in a L{DakProcessPool} ahead of time, and
+    C{prechecked} tells whether that passed; otherwise it is always
+    C{False}.
+    """
+    if jobs <= 1 or len(changes) <= 1:
+        for directory, c in changes:
+            yield (directory, c, False)
+        return
+
+    pool = DakProcessPool(jobs)
+    try:
+        args = ((directory, c.filename, keyring_files, c.contents_sha1()) for directory, c in changes)
+        results = pool.imap_bounded(precheck_it, args, 2 * jobs)
+        for (directory, c), (status, prechecked) in itertools.izip(changes, results):
+            if status != PROC_STATUS_SUCCESS:
+                utils.warn("Precheck of {0} failed, it will be checked in full: {1}".format(
+                    c.filename, prechecked))
+            yield (directory, c, status == PROC_STATUS_SUCCESS and prechecked is True)
+    finally:
+        pool.close()
+        pool.join()
+
+def process_it(directory, changes, keyrings, session, prechecked=False):
     global Logger
 
     print "\n{0}\n".format(changes.filename)
     Logger.log(["Processing changes file", changes.filename])
 
     with daklib.archive.ArchiveUpload(directory, changes, keyrings) as upload:
-        processed = action(directory, upload)
+        processed = action(directory, upload, prechecked)
         if processed and not Options['No-Action']:
             session = DBConn().session()
             history = SignatureHistory.from_signed_file(upload.changes)
@@ -492,8 +545,12 @@ def process_changes(changes_filenames):
 
     changes.sort(key=lambda x: x[1])
 
-    for directory, c in changes:
-        process_it(directory, c, keyring_files, session)
+    # Workers run the expensive checks that only look at the files of an
+    # upload ahead of time; the uploads are still checked against the
+    # archive and installed one by one in the order above.
+    jobs = int(Options["Jobs"] or 1)
+    for directory, c, prechecked in prechecked_uploads(changes, keyring_files, jobs):
+        process_it(directory, c, keyring_files, session, prechecked=prechecked)
 
     session.rollback()
 
@@ -507,12 +564,13 @@ def main():
 
     Arguments = [('a',"automatic","Dinstall::Options::Automatic"),
                  ('h',"help","Dinstall::Options::Help"),
+                 ('j',"jobs","Dinstall::Options::Jobs","HasArg"),
                  ('n',"no-action","Dinstall::Options::No-Action"),
                  ('p',"no-lock", "Dinstall::Options::No-Lock"),
                  ('s',"no-mail", "Dinstall::Options::No-Mail"),
                  ('d',"directory", "Dinstall::Options::Directory", "HasArg")]
 
-    for i in ["automatic", "help", "no-action", "no-lock", "no-mail",
+    for i in ["automatic", "help", "jobs", "no-action", "no-lock", "no-mail",
               "version", "directory"]:
         if not cnf.has_key("Dinstall::Options::%s" % (i)):
             cnf["Dinstall::Options::%s" % (i)] = ""
@@ -49,6 +49,10 @@ class ArchiveTransaction(object):
     def __init__(self):
         self.fs = FilesystemTransaction()
         self.session = DBConn().session()
+        self.digests = upload.DigestCache()
+        """hashes of files already read in this transaction
+        @type: L{daklib.upload.DigestCache}
+        """
 
     def get_file(self, hashed_file, source_name, check_hashes=True):
         """Look for file C{hashed_file} in database
@@ -110,7 +114,9 @@ class ArchiveTransaction(object):
 
             path = os.path.join(archive.path, 'pool', component.component_name, poolname)
             hashed_file_path = os.path.join(directory, hashed_file.filename)
-            self.fs.copy(hashed_file_path, path, link=False, mode=archive.mode)
+            self.fs.copy(hashed_file_path, path, link=False, mode=archive.mode, copy_function=self.digests.copy2)
+            # The copy was hashed while writing it, so this does not read the file again.
+            hashed_file.check(os.path.dirname(path), self.digests)
 
         return poolfile
 
@@ -639,6 +645,7 @@ class ArchiveUpload(object):
         group = cnf.get('Dinstall::UnprivGroup') or None
         self.directory = utils.temp_dirname(parent=cnf.get('Dir::TempPath'),
                                             mode=0o2750, group=group)
+        copy2 = self.transaction.digests.copy2
         with FilesystemTransaction() as fs:
             src = os.path.join(self.original_directory, self.original_changes.filename)
             dst = os.path.join(self.directory, self.original_changes.filename)
@@ -651,7 +658,7 @@ class ArchiveUpload(object):
                 dst = os.path.join(self.directory, f.filename)
                 if not os.path.exists(src):
                     continue
-                fs.copy(src, dst, mode=0o640)
+                fs.copy(src, dst, mode=0o640, copy_function=copy2)
 
             source = None
             try:
@@ -668,7 +675,7 @@ class ArchiveUpload(object):
                         try:
                             db_file = self.transaction.get_file(f, source.dsc['Source'], check_hashes=False)
                             db_archive_file = session.query(ArchiveFile).filter_by(file=db_file).first()
-                            fs.copy(db_archive_file.path, dst, mode=0o640)
+                            fs.copy(db_archive_file.path, dst, mode=0o640, copy_function=copy2)
                         except KeyError:
                             # Ignore if get_file could not find it. Upload will
                             # probably be rejected later.
@@ -886,18 +893,59 @@ class ArchiveUpload(object):
             return None
         return get_mapped_component(binary.component, self.session)
 
-    def check(self, force=False):
+    content_checks = (
+        checks.SourceCheck,
+        checks.BinaryCheck,
+        checks.BinaryTimestampCheck,
+        checks.LintianCheck,
+        )
+    """checks whose result only depends on the files of the upload and the
+    configuration, but not on the state of the archive.  Once the hashes of
+    the files are verified, their result can be taken from an earlier run.
+    """
+
+    def precheck(self):
+        """run the checks that only look at the files of the upload
+
+        This validates the signatures and hashes and runs the checks in
+        C{content_checks}.  It does not depend on the state of the archive,
+        so it can run for many uploads in parallel before they are checked
+        (with C{prechecked=True}) and installed one after another.
+
+        @rtype:  bool
+        @return: C{True} if all checks passed, C{False} otherwise
+        """
+        assert self.changes.valid_signature
+
+        try:
+            checks.SignatureAndHashesCheck().check(self)
+            for chk in self.content_checks:
+                chk().check(self)
+            return True
+        except checks.Reject as e:
+            self.reject_reasons.append(unicode(e))
+        except Exception as e:
+            self.reject_reasons.append("Processing raised an exception: {0}.\n{1}".format(e, traceback.format_exc()))
+        return False
+
+    def check(self, force=False, prechecked=False):
         """run checks against the upload
 
         @type  force: bool
         @param force: ignore failing forcable checks
 
+        @type  prechecked: bool
+        @param prechecked: the checks in C{content_checks} already passed
+                           in C{precheck} for the same files
+
         @rtype:  bool
         @return: C{True} if all checks passed, C{False} otherwise
         """
         # XXX: needs to be better structured.
         assert self.changes.valid_signature
 
+        skip = self.content_checks if prechecked else ()
+
         try:
             # Validate signatures and hashes before we do any real work:
             for chk in (
@@ -910,6 +958,8 @@ class ArchiveUpload(object):
                     checks.BinaryTimestampCheck,
                     checks.SingleDistributionCheck,
                     ):
+                if chk in skip:
+                    continue
                 chk().check(self)
 
             final_suites = self._final_suites()
@@ -925,6 +975,8 @@ class ArchiveUpload(object):
                     checks.NoSourceOnlyCheck,
                     checks.LintianCheck,
                     ):
+                if chk in skip:
+                    continue
                 chk().check(self)
 
             for chk in (
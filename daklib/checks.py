@@ -160,7 +160,7 @@ class SignatureAndHashesCheck(Check):
     def _check_hashes(self, upload, filename, files):
         try:
             for f in files:
-                f.check(upload.directory)
+                f.check(upload.directory, upload.transaction.digests)
         except daklib.upload.FileDoesNotExist as e:
             raise Reject('{0}: {1}\n'
                          'Perhaps you need to include the file in your upload?'
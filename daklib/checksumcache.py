@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Cache of file checksums, keyed on the identity of the file
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import os
+
+__all__ = []
+
+################################################################################
+
+# Release file field -> checksum_cache column
+checksum_fields = (
+    ('MD5Sum', 'md5sum'),
+    ('SHA1', 'sha1sum'),
+    ('SHA256', 'sha256sum'),
+)
+
+__all__.append('checksum_fields')
+
+def stat_identity(path):
+    """
+    Returns the (inode, size, mtime) of path, or None if it does not exist.
+    The mtime is an integer number of microseconds, so it survives the
+    round trip through the database unchanged.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+
+__all__.append('stat_identity')
+
+class ChecksumCache(object):
+    """
+    Checksums of files in the checksum_cache table.
+
+    An entry for a path is valid as long as its stat_path still has the
+    recorded inode, size and mtime. stat_path is the path itself, or for
+    the uncompressed variant of an index that only exists compressed, the
+    compressed file it was written together with.
+
+    Paths are absolute with all symlinks resolved (os.path.realpath), so
+    writers and readers agree on them. Entries below a directory are loaded with one
+    query by load(); changes are only sent to the database on commit().
+    """
+    def __init__(self, session):
+        self._session = session
+        self._entries = dict()
+        self._changed = dict()
+
+    def load(self, directory):
+        """
+        Loads all entries below directory.
+        """
+        sql = """select path, stat_path, inode, stat_size, mtime, size,
+                 md5sum, sha1sum, sha256sum
+                 from checksum_cache where path like :prefix"""
+        prefix = os.path.join(directory, '').replace('%', r'\%').replace('_', r'\_')
+        for row in self._session.execute(sql, {'prefix': prefix + '%'}):
+            self._entries[row[0]] = row[1:]
+
+    def lookup(self, path):
+        """
+        Returns (size, checksums) for path if there is a valid entry,
+        checksums being a dict keyed on the Release file field names,
+        or None.
+        """
+        entry = self._changed.get(path) or self._entries.get(path)
+        if entry is None:
+            return None
+        if stat_identity(entry[0]) != tuple(entry[1:4]):
+            return None
+        checksums = dict([(field, value) for (field, column), value
+                          in zip(checksum_fields, entry[5:8])])
+        return (entry[4], checksums)
+
+    def store(self, path, size, checksums, stat_path=None):
+        """
+        Records the size and checksums of path. The entry stays valid
+        until stat_path (default: path) changes.
+        """
+        if stat_path is None:
+            stat_path = path
+        identity = stat_identity(stat_path)
+        if identity is None:
+            return
+        self._changed[path] = (stat_path, ) + identity + (size, ) + \
+            tuple([checksums[field] for field, column in checksum_fields])
+
+    def expire(self, directory, keep):
+        """
+        Removes all entries below directory whose path is not in keep.
+        """
+        gone = [p for p in self._entries if p.startswith(os.path.join(directory, ''))
+                and p not in keep]
+        for path in gone:
+            self._session.execute("delete from checksum_cache where path = :path",
+                                  {'path': path})
+            del self._entries[path]
+
+    def commit(self):
+        """
+        Writes the changed entries and commits the session.
+        """
+        columns = ['path', 'stat_path', 'inode', 'stat_size', 'mtime', 'size'] + \
+            [column for field, column in checksum_fields]
+        sql = "insert into checksum_cache (%s) values (%s)" % \
+            (", ".join(columns), ", ".join([':' + c for c in columns]))
+        for path, entry in self._changed.items():
+            self._session.execute("delete from checksum_cache where path = :path",
+                                  {'path': path})
+            self._session.execute(sql, dict(zip(columns, (path, ) + entry)))
+            self._entries[path] = entry
+        self._changed = dict()
+        self._session.commit()
+
+__all__.append('ChecksumCache')
+
+# (pid, session) used by record_checksums
+_record_session = (None, None)
+
+def record_checksums(path, size, checksums, stat_path=None):
+    """
+    Stores and commits the checksums of a single file. All calls in a
+    process share one session instead of connecting for every file.
+    """
+    global _record_session
+    pid, session = _record_session
+    if pid != os.getpid():
+        # do not use a session inherited from the parent process
+        from daklib.dbconn import DBConn
+        session = DBConn().session()
+        _record_session = (os.getpid(), session)
+    try:
+        cache = ChecksumCache(session)
+        cache.store(path, size, checksums, stat_path)
+        cache.commit()
+    except:
+        session.rollback()
+        raise
+
+__all__.append('record_checksums')
@@ -27,34 +27,54 @@ Helper code for contents generation.
 
 from daklib.dbconn import *
 from daklib.config import Config
+from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS, worker_session
 from daklib.filewriter import BinaryContentsFileWriter, SourceContentsFileWriter
 
-from multiprocessing import Pool
+from multiprocessing import cpu_count
 from shutil import rmtree
 from tempfile import mkdtemp
 
 import daklib.daksubprocess
+import cPickle
+import heapq
 import os.path
+import time
+
+from itertools import groupby
+from operator import itemgetter
 
 class BinaryContentsWriter(object):
     '''
     BinaryContentsWriter writes the Contents-$arch.gz files.
+
+    In incremental mode the lines are kept in the contents_cache table and
+    only the lines of files belonging to binaries that were added to or
+    removed from the suite (or changed section) since the last run are
+    computed again.
     '''
-    def __init__(self, suite, architecture, overridetype, component):
+    def __init__(self, suite, architecture, overridetype, component, incremental = False, arch_all_file = None):
+        '''
+        arch_all_file is the name of a file written by write_arch_all() for
+        the same suite, override type and component. If given, only the
+        architecture specific binaries are queried and the arch:all lines
+        are merged in from that file.
+        '''
         self.suite = suite
         self.architecture = architecture
         self.overridetype = overridetype
         self.component = component
+        self.incremental = incremental
+        self.arch_all_file = arch_all_file
         self.session = suite.session()
 
-    def query(self):
+    def params(self):
         '''
-        Returns a query object that is doing most of the work.
+        Returns the parameters of the queries.
         '''
         overridesuite = self.suite
         if self.suite.overridesuite is not None:
             overridesuite = get_suite(self.suite.overridesuite, self.session)
-        params = {
+        return {
             'suite':         self.suite.suite_id,
             'overridesuite': overridesuite.suite_id,
             'component':     self.component.component_id,
@@ -64,21 +84,39 @@ class BinaryContentsWriter(object):
             'type':          self.overridetype.overridetype,
         }
 
+    def create_newest_binaries(self, params):
+        '''
+        Creates the temporary table newest_binaries with the newest version
+        of each package in the suite.
+        '''
         sql_create_temp = '''
 create temp table newest_binaries (
     id integer primary key,
-    package text);
+    package text,
+    architecture integer) on commit drop;
 
 create index newest_binaries_by_package on newest_binaries (package);
 
-insert into newest_binaries (id, package)
-    select distinct on (package) id, package from binaries
+insert into newest_binaries (id, package, architecture)
+    select distinct on (package) id, package, architecture from binaries
         where type = :type and
             (architecture = :arch_all or architecture = :arch) and
             id in (select bin from bin_associations where suite = :suite)
         order by package, version desc;'''
         self.session.execute(sql_create_temp, params=params)
 
+    def query(self, arch_only = False):
+        '''
+        Returns a query object that is doing most of the work. The lines
+        are ordered by filename, bytewise. If arch_only is True, binaries
+        whose newest version is arch:all are left out.
+        '''
+        params = self.params()
+        self.create_newest_binaries(params)
+        arch_filter = ''
+        if arch_only:
+            arch_filter = 'and b.architecture = :arch'
+
         sql = '''
 with
 
@@ -88,14 +126,119 @@ unique_override as
         where o.suite = :overridesuite and o.type = :type_id and o.section = s.id and
         o.component = :component)
 
-select bc.file, string_agg(o.section || '/' || b.package, ',' order by b.package) as pkglist
+select bc.file, string_agg(o.section || '/' || b.package, ',' order by b.package collate "C") as pkglist
     from newest_binaries b, bin_contents bc, unique_override o
-    where b.id = bc.binary_id and o.package = b.package
-    group by bc.file'''
+    where b.id = bc.binary_id and o.package = b.package %s
+    group by bc.file
+    order by bc.file collate "C"''' % (arch_filter)
 
         return self.session.query("file", "pkglist").from_statement(sql). \
             params(params)
 
+    def arch_packages(self):
+        '''
+        Returns the set of packages whose newest version in the suite is
+        specific to the architecture. Must be called after query().
+        '''
+        sql = "select package from newest_binaries where architecture = :arch"
+        return set([r[0] for r in self.session.execute(sql, self.params())])
+
+    def write_arch_all(self, filename):
+        '''
+        Writes the (filename, package list) rows of the arch:all binaries to
+        filename, for the BinaryContentsWriter of every architecture of the
+        suite. The writer must have been created for architecture 'all'.
+        '''
+        with open(filename, 'wb') as fh:
+            for row in self.query().yield_per(100):
+                cPickle.dump(tuple(row), fh, cPickle.HIGHEST_PROTOCOL)
+        # end transaction to return connection to pool
+        self.session.rollback()
+
+    def update_cache(self):
+        '''
+        Brings contents_cache up to date for this suite, component,
+        architecture and type, and commits. The binaries the cache was built
+        from are compared with the current ones; only the files of binaries
+        that differ are aggregated again. If a removed binary is gone from
+        the database, its files are unknown and the cache is rebuilt.
+
+        Binaries without bin_contents (not scanned yet) are left out, so
+        they count as added once their contents have been scanned.
+        '''
+        params = self.params()
+        self.create_newest_binaries(params)
+        key = '''suite = :suite and component = :component and
+            architecture = :arch and type = :type_id'''
+
+        self.session.execute('''
+create temp table current_binaries on commit drop as
+    select b.id as binary_id, b.package, s.section
+        from newest_binaries b, override o, section s
+        where o.suite = :overridesuite and o.type = :type_id and o.section = s.id and
+            o.component = :component and o.package = b.package and
+            exists (select 1 from bin_contents bc where bc.binary_id = b.id);
+
+create temp table changed_binaries on commit drop as
+    select binary_id from current_binaries c
+        where not exists (select 1 from contents_cache_binaries cb
+            where %(key)s and cb.binary_id = c.binary_id and
+                cb.package = c.package and cb.section = c.section)
+    union
+    select binary_id from contents_cache_binaries cb
+        where %(key)s and not exists (select 1 from current_binaries c
+            where c.binary_id = cb.binary_id and
+                c.package = cb.package and c.section = cb.section);''' % {'key': key},
+            params)
+
+        gone = self.session.execute('''
+select count(*) from changed_binaries c
+    where not exists (select 1 from binaries b where b.id = c.binary_id)''').scalar()
+        if gone > 0:
+            self.session.execute("delete from contents_cache where " + key, params)
+            self.session.execute("delete from contents_cache_binaries where " + key, params)
+            self.session.execute('''
+insert into changed_binaries (binary_id) select binary_id from current_binaries''')
+
+        self.session.execute('''
+create temp table changed_files on commit drop as
+    select distinct bc.file from bin_contents bc, changed_binaries c
+        where bc.binary_id = c.binary_id;
+
+delete from contents_cache
+    where %(key)s and file in (select file from changed_files);
+
+insert into contents_cache (suite, component, architecture, type, file, pkglist)
+    select :suite, :component, :arch, :type_id, bc.file,
+            string_agg(b.section || '/' || b.package, ',' order by b.package collate "C")
+        from current_binaries b, bin_contents bc
+        where b.binary_id = bc.binary_id and
+            bc.file in (select file from changed_files)
+        group by bc.file;
+
+delete from contents_cache_binaries
+    where %(key)s and binary_id in (select binary_id from changed_binaries);
+
+insert into contents_cache_binaries
+        (suite, component, architecture, type, binary_id, package, section)
+    select :suite, :component, :arch, :type_id, c.binary_id, c.package, c.section
+        from current_binaries c
+        where c.binary_id in (select binary_id from changed_binaries);''' % {'key': key},
+            params)
+        self.session.commit()
+
+    def query_cache(self):
+        '''
+        Returns a query object for the lines in contents_cache.
+        '''
+        sql = '''
+select file, pkglist from contents_cache
+    where suite = :suite and component = :component and
+        architecture = :arch and type = :type_id
+    order by file collate "C"'''
+        return self.session.query("file", "pkglist").from_statement(sql). \
+            params(self.params())
+
     def formatline(self, filename, package_list):
         '''
         Returns a formatted string for the filename argument.
@@ -106,7 +249,16 @@ select bc.file, string_agg(o.section || '/' || b.package, ',' order by b.package
         '''
         Yields a new line of the Contents-$arch.gz file in filename order.
         '''
-        for filename, package_list in self.query().yield_per(100):
+        if self.incremental:
+            self.update_cache()
+            rows = self.query_cache().yield_per(100)
+        elif self.arch_all_file is not None:
+            rows = self.query(arch_only = True).yield_per(100)
+            rows = merge_contents(rows, read_arch_all(self.arch_all_file),
+                                  self.arch_packages())
+        else:
+            rows = self.query().yield_per(100)
+        for filename, package_list in rows:
             yield self.formatline(filename, package_list)
         # end transaction to return connection to pool
         self.session.rollback()
@@ -234,36 +386,97 @@ select sc.file, string_agg(s.source, ',' order by s.source) as pkglist
         writer.close()
 
 
-def binary_helper(suite_id, arch_id, overridetype_id, component_id):
+def read_arch_all(filename):
+    '''
+    Yields the rows written by BinaryContentsWriter.write_arch_all().
+    '''
+    with open(filename, 'rb') as fh:
+        while True:
+            try:
+                yield cPickle.load(fh)
+            except EOFError:
+                return
+
+def merge_contents(arch_rows, all_rows, arch_packages):
+    '''
+    Merges two streams of (filename, package list) rows sorted by filename
+    into one. Packages in the arch:all rows that also are in arch_packages
+    have a newer architecture specific version and are left out. The
+    package lists are sorted bytewise by package name, like the lists
+    aggregated by query().
+    '''
+    def package(item):
+        # the section may contain a '/', the package name never does
+        return item.rsplit('/', 1)[1]
+
+    def filtered(rows):
+        for filename, package_list in rows:
+            items = [i for i in package_list.split(',') if package(i) not in arch_packages]
+            if items:
+                yield (filename, items)
+
+    def split(rows):
+        for filename, package_list in rows:
+            yield (filename, package_list.split(','))
+
+    merged = heapq.merge(split(arch_rows), filtered(all_rows))
+    for filename, group in groupby(merged, itemgetter(0)):
+        items = []
+        for row in group:
+            items.extend(row[1])
+        yield (filename, ','.join(sorted(items, key = package)))
+
+def arch_all_helper(suite_id, overridetype_id, component_id, filename):
     '''
     This function is called in a new subprocess and multiprocessing wants a top
     level function.
     '''
-    session = DBConn().session(work_mem = 1000)
+    start = time.time()
+    session = worker_session(work_mem = 1000)
+    suite = Suite.get(suite_id, session)
+    overridetype = OverrideType.get(overridetype_id, session)
+    component = Component.get(component_id, session)
+    architecture = get_architecture('all', session)
+    contents_writer = BinaryContentsWriter(suite, architecture, overridetype, component)
+    contents_writer.write_arch_all(filename)
+    session.close()
+    return (PROC_STATUS_SUCCESS, [suite.suite_name, 'all', overridetype.overridetype,
+        component.component_name, '%.1fs' % (time.time() - start)])
+
+def binary_helper(suite_id, arch_id, overridetype_id, component_id, incremental = False, arch_all_file = None):
+    '''
+    This function is called in a new subprocess and multiprocessing wants a top
+    level function.
+    '''
+    start = time.time()
+    session = worker_session(work_mem = 1000)
     suite = Suite.get(suite_id, session)
     architecture = Architecture.get(arch_id, session)
     overridetype = OverrideType.get(overridetype_id, session)
     component = Component.get(component_id, session)
     log_message = [suite.suite_name, architecture.arch_string, \
         overridetype.overridetype, component.component_name]
-    contents_writer = BinaryContentsWriter(suite, architecture, overridetype, component)
+    contents_writer = BinaryContentsWriter(suite, architecture, overridetype, component, incremental, arch_all_file)
     contents_writer.write_file()
     session.close()
-    return log_message
+    log_message.append('%.1fs' % (time.time() - start))
+    return (PROC_STATUS_SUCCESS, log_message)
 
 def source_helper(suite_id, component_id):
     '''
     This function is called in a new subprocess and multiprocessing wants a top
     level function.
     '''
-    session = DBConn().session(work_mem = 1000)
+    start = time.time()
+    session = worker_session(work_mem = 1000)
     suite = Suite.get(suite_id, session)
     component = Component.get(component_id, session)
     log_message = [suite.suite_name, 'source', component.component_name]
     contents_writer = SourceContentsWriter(suite, component)
     contents_writer.write_file()
     session.close()
-    return log_message
+    log_message.append('%.1fs' % (time.time() - start))
+    return (PROC_STATUS_SUCCESS, log_message)
 
 class ContentsWriter(object):
     '''
@@ -275,14 +488,19 @@ class ContentsWriter(object):
         '''
         Writes a result message to the logfile.
         '''
-        class_.logger.log(result)
+        status, message = result
+        if status != PROC_STATUS_SUCCESS:
+            message = ['E:', str(message)]
+        class_.logger.log(message)
 
     @classmethod
-    def write_all(class_, logger, archive_names = [], suite_names = [], component_names = [], force = False):
+    def write_all(class_, logger, archive_names = [], suite_names = [], component_names = [], force = False, incremental = False):
         '''
         Writes all Contents files for suites in list suite_names which defaults
         to all 'touchable' suites if not specified explicitely. Untouchable
-        suites will be included if the force argument is set to True.
+        suites will be included if the force argument is set to True. The
+        binary Contents files are generated in incremental mode if the
+        incremental argument is set to True.
         '''
         class_.logger = logger
         session = DBConn().session()
@@ -298,27 +516,79 @@ class ContentsWriter(object):
             suite_query = suite_query.filter(Suite.untouchable == False)
         deb_id = get_override_type('deb', session).overridetype_id
         udeb_id = get_override_type('udeb', session).overridetype_id
-        pool = Pool()
-        for suite in suite_query:
-            suite_id = suite.suite_id
-            for component in component_query:
-                component_id = component.component_id
-                # handle source packages
-                pool.apply_async(source_helper, (suite_id, component_id),
-                    callback = class_.log_result)
-                for architecture in suite.get_architectures(skipsrc = True, skipall = True):
-                    arch_id = architecture.arch_id
-                    # handle 'deb' packages
-                    pool.apply_async(binary_helper, (suite_id, arch_id, deb_id, component_id), \
-                        callback = class_.log_result)
-                    # handle 'udeb' packages
-                    pool.apply_async(binary_helper, (suite_id, arch_id, udeb_id, component_id), \
-                        callback = class_.log_result)
-        pool.close()
-        pool.join()
+        # the jobs mostly wait for the database
+        pool = DakProcessPool(Config().find_i('Contents::DatabaseWorkers', cpu_count()))
+        tmpdir = mkdtemp(prefix = 'contents.', dir = Config()['Dir::TempPath'])
+        try:
+            # Jobs are queued largest first, estimated by the size of the file
+            # they wrote last time, so the biggest ones do not start last.
+            #
+            # The arch:all lines are the same for every architecture, so unless
+            # the incremental cache is used they are computed once per suite,
+            # component and type, and merged into each architecture's file.
+            # The architectures' jobs are queued as soon as their arch:all job
+            # is done, while the other jobs keep running.
+            def queue_architectures(jobs):
+                def callback(result):
+                    class_.log_result(result)
+                    queued = jobs
+                    if result[0] != PROC_STATUS_SUCCESS:
+                        # fall back to querying arch:all for every architecture
+                        queued = [(cost, func, args[:-1] + (None, )) for cost, func, args in jobs]
+                    pool.apply_largest_first(queued, callback = class_.log_result)
+                return callback
+
+            first_jobs = []
+            for suite in suite_query:
+                suite_id = suite.suite_id
+                for component in component_query:
+                    component_id = component.component_id
+                    # handle source packages
+                    writer = SourceContentsWriter(suite, component).writer()
+                    first_jobs.append((output_size(writer), source_helper, (suite_id, component_id)))
+                    for type_id in (deb_id, udeb_id):
+                        key = (suite_id, component_id, type_id)
+                        filename = None
+                        if not incremental:
+                            filename = os.path.join(tmpdir, '%d-%d-%d' % key)
+                        jobs = []
+                        for architecture in suite.get_architectures(skipsrc = True, skipall = True):
+                            writer = BinaryContentsWriter(suite, architecture,
+                                OverrideType.get(type_id, session), component).writer()
+                            jobs.append((output_size(writer), binary_helper,
+                                (suite_id, architecture.arch_id, type_id, component_id, incremental, filename)))
+                        if incremental:
+                            first_jobs.extend(jobs)
+                        else:
+                            largest = max([0] + [job[0] for job in jobs])
+                            first_jobs.append((largest, arch_all_helper, key + (filename, ),
+                                queue_architectures(jobs)))
+
+            results = pool.apply_largest_first(first_jobs, callback = class_.log_result)
+            # The architectures' jobs are queued by the callbacks, which run
+            # before a result is ready; the pool may only be closed after that.
+            for result in results:
+                result.wait()
+
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            rmtree(tmpdir)
         session.close()
 
 
+def output_size(writer):
+    '''
+    Returns the size of the file the writer wrote last time, or 0.
+    '''
+    try:
+        return os.stat(writer.path + '.gz').st_size
+    except OSError:
+        return 0
+
 class BinaryContentsScanner(object):
     '''
     BinaryContentsScanner provides a threadsafe method scan() to scan the
@@ -338,44 +608,109 @@ class BinaryContentsScanner(object):
         is ignored but needed by our threadpool implementation.
         '''
         session = DBConn().session()
+        count = self.load(session)
+        session.commit()
+        session.close()
+        return count
+
+    def load(self, session, fileset = None):
+        '''
+        Loads the paths of the binary into bin_contents with COPY in the
+        transaction of session, in batches of Contents::BatchSize rows.
+        fileset defaults to the result of files(). Returns the number of
+        paths.
+        '''
+        if fileset is None:
+            fileset = self.files(session)
+        batch_size = Config().find_i('Contents::BatchSize', 10000)
+        rows = [(filename, self.binary_id) for filename in sorted(fileset)]
+        return copy_rows(session, 'bin_contents', ('file', 'binary_id'),
+                         rows, batch_size)
+
+    def files(self, session):
+        '''
+        Returns the set of paths in the binary.
+        '''
         binary = session.query(DBBinary).get(self.binary_id)
         fileset = set(binary.scan_contents())
         if len(fileset) == 0:
             fileset.add('EMPTY_PACKAGE')
-        for filename in fileset:
-            binary.contents.append(BinContents(file = filename))
-        session.commit()
-        session.close()
+        return fileset
 
     @classmethod
     def scan_all(class_, limit = None):
         '''
         The class method scan_all() scans all binaries using multiple threads.
         The number of binaries to be scanned can be limited with the limit
-        argument. Returns the number of processed and remaining packages as a
-        dict.
+        argument. Returns the number of processed and remaining packages, the
+        number of loaded paths and the time taken as a dict.
+
+        Every task scans Contents::BinariesPerTask binaries and loads them
+        in a single transaction. The largest packages are scanned first, by
+        Contents::ScanWorkers processes; each round of binaries is dealt
+        round-robin to the tasks, so the biggest ones are spread over all
+        workers instead of all going into the first task.
         '''
         session = DBConn().session()
         query = session.query(DBBinary).filter(DBBinary.contents == None)
         remaining = query.count
+        query = query.join(DBBinary.poolfile).order_by(PoolFile.filesize.desc())
         if limit is not None:
             query = query.limit(limit)
         processed = query.count()
-        pool = Pool()
-        for binary in query.yield_per(100):
-            pool.apply_async(binary_scan_helper, (binary.binary_id, ))
+        per_task = Config().find_i('Contents::BinariesPerTask', 20)
+        workers = Config().find_i('Contents::ScanWorkers', cpu_count())
+
+        def chunks():
+            binary_ids = []
+            for binary in query.yield_per(100):
+                binary_ids.append(binary.binary_id)
+                if len(binary_ids) >= workers * per_task:
+                    for i in range(workers):
+                        yield (binary_ids[i::workers], )
+                    binary_ids = []
+            for i in range(min(workers, len(binary_ids))):
+                yield (binary_ids[i::workers], )
+
+        files = 0
+        start = time.time()
+        pool = DakProcessPool(workers)
+        for status, result in pool.imap_bounded(binary_scan_helper, chunks(), 2 * workers, ordered = False):
+            if status == PROC_STATUS_SUCCESS:
+                files += result
+            else:
+                print "Binary contents scan failed: %s" % (result)
         pool.close()
         pool.join()
+        seconds = time.time() - start
         remaining = remaining()
         session.close()
-        return { 'processed': processed, 'remaining': remaining }
+        return { 'processed': processed, 'remaining': remaining,
+                 'files': files, 'seconds': seconds }
 
-def binary_scan_helper(binary_id):
+def binary_scan_helper(binary_ids):
     '''
-    This function runs in a subprocess.
+    This function runs in a subprocess. Returns the number of loaded paths
+    as message.
     '''
-    scanner = BinaryContentsScanner(binary_id)
-    scanner.scan()
+    session = worker_session()
+    count = 0
+    try:
+        for binary_id in binary_ids:
+            scanner = BinaryContentsScanner(binary_id)
+            try:
+                fileset = scanner.files(session)
+            except Exception as e:
+                print "Cannot scan binary %d: %s" % (binary_id, e)
+                continue
+            count += scanner.load(session, fileset)
+        session.commit()
+    except Exception as e:
+        print "Cannot load contents of binaries %s: %s" % (binary_ids, e)
+        session.rollback()
+        count = 0
+    session.close()
+    return (PROC_STATUS_SUCCESS, count)
 
 class UnpackedSource(object):
     '''
@@ -468,17 +803,22 @@ class SourceContentsScanner(object):
         The class method scan_all() scans all source using multiple processes.
         The number of sources to be scanned can be limited with the limit
         argument. Returns the number of processed and remaining packages as a
-        dict.
+        dict. The largest packages are scanned first, by
+        Contents::ScanWorkers processes.
         '''
         session = DBConn().session()
         query = session.query(DBSource).filter(DBSource.contents == None)
         remaining = query.count
+        query = query.join(DBSource.poolfile).order_by(PoolFile.filesize.desc())
         if limit is not None:
             query = query.limit(limit)
         processed = query.count()
-        pool = Pool()
-        for source in query.yield_per(100):
-            pool.apply_async(source_scan_helper, (source.source_id, ))
+        workers = Config().find_i('Contents::ScanWorkers', cpu_count())
+        pool = DakProcessPool(workers)
+        args = ((source.source_id, ) for source in query.yield_per(100))
+        for status, result in pool.imap_bounded(source_scan_helper, args, 2 * workers, ordered = False):
+            if status != PROC_STATUS_SUCCESS:
+                print "Source contents scan failed: %s" % (result)
         pool.close()
         pool.join()
         remaining = remaining()
@@ -494,3 +834,4 @@ def source_scan_helper(source_id):
         scanner.scan()
     except Exception as e:
         print e
+    return (PROC_STATUS_SUCCESS, None)
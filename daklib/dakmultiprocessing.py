@@ -25,9 +25,14 @@ multiprocessing for DAK
 
 ###############################################################################
 
+from collections import deque
+from multiprocessing import cpu_count
 from multiprocessing.pool import Pool
 from signal import signal, SIGHUP, SIGTERM, SIGPIPE, SIGALRM
 
+import os
+import sys
+import Queue
 import sqlalchemy.orm.session
 
 __all__ = []
@@ -52,6 +57,39 @@ __all__.append('SignalException')
 def signal_handler(signum, info):
     raise SignalException(signum)
 
+_session = None
+_session_pid = None
+
+def worker_session(work_mem=0):
+    """
+    Returns the session of the current process, which is created on first
+    use and kept open. The pool ends its transaction after every task, so
+    tasks get a transaction of their own but no new connection.
+
+    If a work_mem parameter is provided, work_mem is set (in MB) for the
+    current transaction.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        from daklib.dbconn import DBConn
+        _session = DBConn().session()
+        _session_pid = os.getpid()
+    if work_mem > 0:
+        _session.execute("SET LOCAL work_mem TO '%d MB'" % work_mem)
+    return _session
+
+__all__.append('worker_session')
+
+def _worker_init(max_connections, initializer, initargs):
+    """
+    Runs once in every worker process after it was forked.
+    """
+    # only programs using the database have loaded dbconn
+    if 'daklib.dbconn' in sys.modules:
+        sys.modules['daklib.dbconn'].DBConn.setup_worker(max_connections)
+    if initializer is not None:
+        initializer(*initargs)
+
 def _func_wrapper(func, *args, **kwds):
     # We need to handle signals to avoid hanging
     signal(SIGHUP, signal_handler)
@@ -71,20 +109,107 @@ def _func_wrapper(func, *args, **kwds):
     except Exception as e:
         return (PROC_STATUS_EXCEPTION, str(e))
     finally:
-        # Make sure connections are closed. We might die otherwise.
+        # End the task's transactions and hand the connections back to
+        # the pool of this worker, where they stay open for the next task.
         sqlalchemy.orm.session.Session.close_all()
 
 
 class DakProcessPool(Pool):
-    def __init__(self, *args, **kwds):
-        Pool.__init__(self, *args, **kwds)
+    def __init__(self, processes=None, initializer=None, initargs=(),
+                 max_connections=None, **kwds):
+        '''
+        max_connections limits the number of database connections all
+        workers together may open, and defaults to DB::MaxConnections for
+        programs using the database. Every worker gets at least two
+        connections, as a task may open a second session next to the one
+        from worker_session(); fewer workers are started if there are not
+        enough connections for all processes.
+        '''
+        if processes is None:
+            processes = cpu_count()
+        if max_connections is None and 'daklib.dbconn' in sys.modules:
+            from daklib.config import Config
+            max_connections = Config().find_i('DB::MaxConnections', 0)
+        per_worker = None
+        if max_connections:
+            processes = max(1, min(processes, max_connections // 2))
+            per_worker = max(2, max_connections // processes)
+        Pool.__init__(self, processes, _worker_init,
+                      (per_worker, initializer, initargs), **kwds)
         self.results = []
         self.int_results = []
 
     def apply_async(self, func, args=(), kwds={}, callback=None):
         wrapper_args = list(args)
         wrapper_args.insert(0, func)
-        self.int_results.append(Pool.apply_async(self, _func_wrapper, wrapper_args, kwds, callback))
+        result = Pool.apply_async(self, _func_wrapper, wrapper_args, kwds, callback)
+        self.int_results.append(result)
+        return result
+
+    def apply_largest_first(self, jobs, callback=None):
+        '''
+        Queues jobs, a list of (cost, func, args) tuples, in order of
+        decreasing estimated cost. The pool hands out jobs in queue order, so
+        the biggest jobs start first and the small ones fill the gaps,
+        instead of a big job starting last and running alone. Returns the
+        results in the order of jobs.
+
+        A job may also be a (cost, func, args, callback) tuple to use its
+        own callback instead of callback.
+        '''
+        order = sorted(range(len(jobs)), key=lambda i: jobs[i][0], reverse=True)
+        results = [None] * len(jobs)
+        for i in order:
+            job_callback = callback
+            if len(jobs[i]) > 3:
+                job_callback = jobs[i][3]
+            cost, func, args = jobs[i][:3]
+            results[i] = self.apply_async(func, args, callback=job_callback)
+        return results
+
+    def imap_bounded(self, func, argslist, max_pending, ordered=True):
+        '''
+        Runs func(*args) for every args in the iterable argslist and yields
+        the (status, message) results in submission order. At most
+        max_pending tasks are queued or waiting to be consumed at any time,
+        and unlike apply_async the results are not kept by the pool, so the
+        caller's memory use does not grow with the number of tasks.
+
+        If ordered is False, the results are yielded as soon as they are
+        ready, so a slow task does not keep the next tasks from being
+        queued while the other workers go idle.
+        '''
+        if not ordered:
+            for result in self._imap_bounded_unordered(func, argslist, max_pending):
+                yield result
+            return
+        pending = deque()
+        for args in argslist:
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+            wrapper_args = list(args)
+            wrapper_args.insert(0, func)
+            pending.append(Pool.apply_async(self, _func_wrapper, wrapper_args))
+        while pending:
+            yield pending.popleft().get()
+
+    def _imap_bounded_unordered(self, func, argslist, max_pending):
+        '''
+        imap_bounded() yielding the results in completion order.
+        '''
+        done = Queue.Queue()
+        pending = 0
+        for args in argslist:
+            if pending >= max_pending:
+                yield done.get()
+                pending -= 1
+            wrapper_args = list(args)
+            wrapper_args.insert(0, func)
+            Pool.apply_async(self, _func_wrapper, wrapper_args, callback=done.put)
+            pending += 1
+        while pending:
+            yield done.get()
+            pending -= 1
 
     def join(self):
         Pool.join(self)
@@ -34,7 +34,9 @@
 ################################################################################
 
 import apt_pkg
+import cPickle
 import daklib.daksubprocess
+import itertools
 import os
 from os.path import normpath
 import re
@@ -52,7 +54,6 @@ except:
 from datetime import datetime, timedelta
 from errno import ENOENT
 from tempfile import mkstemp, mkdtemp
-from tarfile import TarFile
 
 from inspect import getargspec
 
@@ -172,6 +173,111 @@ __all__.append('session_wrapper')
 
 ################################################################################
 
+def _copy_escape(value):
+    """
+    Formats a single value for PostgreSQL's COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+def copy_rows(session, table, columns, rows, batch_size=10000):
+    """
+    Loads rows into a table with PostgreSQL's COPY ... FROM STDIN, which is
+    much faster than one INSERT per row. The rows are sent in batches of
+    batch_size rows inside the transaction of the given session.
+
+    @type session: SQLAlchemy session
+    @param session: session whose transaction the rows are loaded in
+
+    @type table: string
+    @param table: name of the (possibly temporary) table
+
+    @type columns: list
+    @param columns: names of the columns given in each row
+
+    @type rows: iterable
+    @param rows: tuples of values, in the order of columns
+
+    @rtype: int
+    @return: number of rows loaded
+    """
+    from cStringIO import StringIO
+
+    cursor = session.connection().connection.cursor()
+    statement = "COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))
+    count = 0
+    buf = StringIO()
+    batch = 0
+    try:
+        for row in rows:
+            buf.write("\t".join([_copy_escape(v) for v in row]))
+            buf.write("\n")
+            batch += 1
+            if batch >= batch_size:
+                buf.seek(0)
+                cursor.copy_expert(statement, buf)
+                count += batch
+                buf = StringIO()
+                batch = 0
+        if batch > 0:
+            buf.seek(0)
+            cursor.copy_expert(statement, buf)
+            count += batch
+    finally:
+        cursor.close()
+    return count
+
+__all__.append('copy_rows')
+
+_stream_cursors = itertools.count()
+
+def stream_query(session, sql, params={}, fetch_size=1000):
+    """
+    Runs the query sql on a named (server-side) cursor and yields lists of
+    at most fetch_size rows. Unlike session.execute(), which makes psycopg2
+    buffer the complete result set on the client, only one batch of rows
+    is held in memory at a time.
+
+    @type session: SQLAlchemy session
+    @param session: session whose transaction the query runs in
+
+    @type sql: string
+    @param sql: query text with :name style parameters
+
+    @type params: dict
+    @param params: parameters of the query
+
+    @type fetch_size: int
+    @param fetch_size: number of rows fetched per round trip
+    """
+    connection = session.connection()
+    compiled = sqlalchemy.text(sql).compile(dialect=connection.dialect)
+    name = 'dak_stream_%d_%d' % (os.getpid(), next(_stream_cursors))
+    cursor = connection.connection.cursor(name)
+    try:
+        cursor.execute(str(compiled), compiled.construct_params(params))
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+__all__.append('stream_query')
+
+################################################################################
+
 class ORMObject(object):
     """
     ORMObject is a base class for all ORM classes mapped by SQLalchemy. All
@@ -532,11 +638,9 @@ class DBBinary(ORMObject):
         or iso8859-1 encoding. It yields the string ' <EMPTY PACKAGE>' if the
         package does not contain any regular file.
         '''
+        from daklib.debtar import data_members
         fullpath = self.poolfile.fullpath
-        dpkg_cmd = ('dpkg-deb', '--fsys-tarfile', fullpath)
-        dpkg = daklib.daksubprocess.Popen(dpkg_cmd, stdout=subprocess.PIPE)
-        tar = TarFile.open(fileobj = dpkg.stdout, mode = 'r|')
-        for member in tar.getmembers():
+        for member in data_members(fullpath):
             if not member.isdir():
                 name = normpath(member.name)
                 # enforce proper utf-8 encoding
@@ -545,9 +649,6 @@ class DBBinary(ORMObject):
                 except UnicodeDecodeError:
                     name = name.decode('iso8859-1').encode('utf-8')
                 yield name
-        tar.close()
-        dpkg.stdout.close()
-        dpkg.wait()
 
     def read_control(self):
         '''
@@ -575,8 +676,7 @@ class DBBinary(ORMObject):
     @property
     def proxy(self):
         session = object_session(self)
-        query = session.query(BinaryMetadata).filter_by(binary=self)
-        return MetadataProxy(session, query)
+        return MetadataProxy(session, self.binary_id)
 
 __all__.append('DBBinary')
 
@@ -910,16 +1010,15 @@ def insert_content_paths(binary_id, fullpaths, session=None):
 
     try:
         # Insert paths
-        def generate_path_dicts():
+        def generate_path_rows():
             for fullpath in fullpaths:
                 if fullpath.startswith( './' ):
                     fullpath = fullpath[2:]
 
-                yield {'filename':fullpath, 'id': binary_id }
+                yield (fullpath, binary_id)
 
-        for d in generate_path_dicts():
-            session.execute( "INSERT INTO bin_contents ( file, binary_id ) VALUES ( :filename, :id )",
-                         d )
+        copy_rows(session, 'bin_contents', ('file', 'binary_id'),
+                  generate_path_rows())
 
         session.commit()
         if privatetrans:
@@ -1973,13 +2072,23 @@ class DBSource(ORMObject):
         '''
         Returns a set of names for non directories. The path names are
         normalized after converting them from either utf-8 or iso8859-1
-        encoding.
+        encoding. The names are read from the tarballs and patches without
+        unpacking the source. If that fails (e.g. for formats unknown to
+        daklib.srcformats or patches it cannot follow), the source is
+        unpacked with dpkg-source instead.
         '''
         fullpath = self.poolfile.fullpath
-        from daklib.contents import UnpackedSource
-        unpacked = UnpackedSource(fullpath)
+        from daklib.srccontents import SourceFileList
+        try:
+            names = set(SourceFileList.from_dsc(fullpath).get_all_filenames())
+        except Exception as e:
+            from daklib.contents import UnpackedSource
+            from daklib.utils import warn
+            warn("%s: cannot list contents without unpacking (%s: %s), using dpkg-source" %
+                 (fullpath, e.__class__.__name__, e))
+            names = UnpackedSource(fullpath).get_all_filenames()
         fileset = set()
-        for name in unpacked.get_all_filenames():
+        for name in names:
             # enforce proper utf-8 encoding
             try:
                 name.decode('utf-8')
@@ -1991,8 +2100,7 @@ class DBSource(ORMObject):
     @property
     def proxy(self):
         session = object_session(self)
-        query = session.query(SourceMetadata).filter_by(source=self)
-        return MetadataProxy(session, query)
+        return MetadataProxy(session, self.source_id, source=True)
 
 __all__.append('DBSource')
 
@@ -2136,9 +2244,11 @@ __all__.append('get_source_in_suite')
 def import_metadata_into_db(obj, session=None):
     """
     This routine works on either DBBinary or DBSource objects and imports
-    their metadata into the database
+    their metadata into the database. All fields are written with a single
+    INSERT statement; only keys not seen before need extra queries.
     """
     fields = obj.read_control_fields()
+    values = dict()
     for k in fields.keys():
         try:
             # Try raw ASCII
@@ -2153,8 +2263,42 @@ def import_metadata_into_db(obj, session=None):
                 # Otherwise we allow the exception to percolate up and we cause
                 # a reject as someone is playing silly buggers
 
-        obj.metadata[get_or_set_metadatakey(k, session)] = val
+        values[k] = val
 
+    if isinstance(obj, DBSource):
+        table, id_column, object_id = 'source_metadata', 'src_id', obj.source_id
+    else:
+        table, id_column, object_id = 'binaries_metadata', 'bin_id', obj.binary_id
+
+    key_ids = _metadata_key_ids(session)
+    for k in values:
+        if k not in key_ids:
+            get_or_set_metadatakey(k, session)
+
+    def insert(keys):
+        # the key ids are looked up by name, so a stale cache cannot
+        # produce rows referring to the wrong key
+        return session.execute("""
+            INSERT INTO %s (%s, key_id, value)
+                SELECT :id, k.key_id, f.value
+                  FROM (SELECT unnest(CAST(:keys AS text[])) AS key,
+                               unnest(CAST(:values AS text[])) AS value) f
+                  JOIN metadata_keys k ON k.key = f.key""" % (table, id_column),
+            { 'id': object_id, 'keys': keys,
+              'values': [values[k] for k in keys] }).rowcount
+
+    keys = values.keys()
+    if insert(keys) != len(keys):
+        # keys cached from a rolled back transaction
+        missing = set(keys)
+        missing.difference_update([k for k, in session.execute("""
+            SELECT k.key FROM %s m JOIN metadata_keys k ON k.key_id = m.key_id
+             WHERE m.%s = :id""" % (table, id_column), { 'id': object_id })])
+        for k in missing:
+            get_or_set_metadatakey(k, session)
+        insert(list(missing))
+
+    session.expire(obj, ['key'])
     session.commit_or_flush()
 
 __all__.append('import_metadata_into_db')
@@ -2441,6 +2585,12 @@ def get_or_set_metadatakey(keyname, session=None):
     @return: the metadatakey object for the given keyname
     """
 
+    key_id = _metadata_key_ids(session).get(keyname)
+    if key_id is not None:
+        ret = session.query(MetadataKey).get(key_id)
+        if ret is not None and ret.key == keyname:
+            return ret
+
     q = session.query(MetadataKey).filter_by(key=keyname)
 
     try:
@@ -2450,10 +2600,73 @@ def get_or_set_metadatakey(keyname, session=None):
         session.add(ret)
         session.commit_or_flush()
 
+    _metadata_key_cache[keyname] = ret.key_id
     return ret
 
 __all__.append('get_or_set_metadatakey')
 
+# key name -> key_id for the whole process; metadata keys are never deleted
+_metadata_key_cache = dict()
+
+def _metadata_key_ids(session):
+    """
+    Returns the process-wide dict mapping metadata key names to their ids.
+    It is loaded with a single query on first use and extended by
+    get_or_set_metadatakey. An id may belong to a key created in a
+    transaction that was rolled back later, so users must cope with ids
+    that no longer exist.
+    """
+    if not _metadata_key_cache:
+        for key_id, key in session.query(MetadataKey.key_id, MetadataKey.key):
+            _metadata_key_cache[key] = key_id
+    return _metadata_key_cache
+
+@session_wrapper
+def get_metadata(ids, keys=None, source=False, session=None):
+    """
+    Fetches metadata fields of many binaries or sources with one query per
+    10000 ids.
+
+    @type ids: list
+    @param ids: binary ids, or source ids if source is True
+
+    @type keys: list
+    @param keys: names of the wanted fields, or None for all fields
+
+    @type source: bool
+    @param source: True to read source metadata
+
+    @type session: SQLAlchemy
+    @param session: Optional SQL session object (a temporary one will be
+    generated if not supplied).
+
+    @rtype: dict
+    @return: maps every id with at least one of the fields to a dict of
+             field name -> value
+    """
+    if source:
+        table, id_column = 'source_metadata', 'src_id'
+    else:
+        table, id_column = 'binaries_metadata', 'bin_id'
+    query = """
+        SELECT m.%s, k.key, m.value
+          FROM %s m JOIN metadata_keys k ON k.key_id = m.key_id
+         WHERE m.%s = ANY(:ids)""" % (id_column, table, id_column)
+    params = dict()
+    if keys is not None:
+        query += " AND k.key = ANY(:keys)"
+        params['keys'] = list(keys)
+
+    result = dict()
+    ids = list(ids)
+    for start in xrange(0, len(ids), 10000):
+        params['ids'] = ids[start:start + 10000]
+        for object_id, key, value in session.execute(query, params):
+            result.setdefault(object_id, dict())[key] = value
+    return result
+
+__all__.append('get_metadata')
+
 ################################################################################
 
 class BinaryMetadata(ORMObject):
@@ -2489,16 +2702,21 @@ __all__.append('SourceMetadata')
 ################################################################################
 
 class MetadataProxy(object):
-    def __init__(self, session, query):
+    """
+    Read-only access to the metadata of a binary or source. All fields are
+    fetched with a single query on first access.
+    """
+    def __init__(self, session, object_id, source=False):
         self.session = session
-        self.query = query
+        self.object_id = object_id
+        self.source = source
+        self._fields = None
 
     def _get(self, key):
-        metadata_key = self.session.query(MetadataKey).filter_by(key=key).first()
-        if metadata_key is None:
-            return None
-        metadata = self.query.filter_by(key=metadata_key).first()
-        return metadata
+        if self._fields is None:
+            self._fields = get_metadata([self.object_id], source=self.source,
+                session=self.session).get(self.object_id, dict())
+        return self._fields.get(key)
 
     def __contains__(self, key):
         if self._get(key) is not None:
@@ -2506,10 +2724,10 @@ class MetadataProxy(object):
         return False
 
     def __getitem__(self, key):
-        metadata = self._get(key)
-        if metadata is None:
+        value = self._get(key)
+        if value is None:
             raise KeyError
-        return metadata.value
+        return value
 
     def get(self, key, default=None):
         try:
@@ -2562,6 +2780,17 @@ class DBConn(object):
             self.debug = kwargs.has_key('debug')
             self.__createconn()
 
+    @classmethod
+    def setup_worker(cls, max_connections=None):
+        """
+        Prepares DBConn for a freshly forked worker process: connections
+        are limited to max_connections (if given), and if the parent had
+        connected already, the worker gets an engine of its own.
+        """
+        cls.__shared_state['max_connections'] = max_connections
+        if cls.__shared_state.get('initialised', False):
+            DBConn().__createconn()
+
     def __setuptables(self):
         tables = (
             'acl',
@@ -2637,14 +2866,69 @@ class DBConn(object):
             'suite_arch_by_name',
         )
 
+        # reflecting the schema takes many round trips; use the snapshot of
+        # an earlier run if it was taken from the same schema revision
+        key = self.__schemakey(tables, views)
+        meta = self.__loadschema(key)
+        if meta is not None:
+            self.db_meta = meta
+            self.db_meta.bind = self.db_pg
+        else:
+            for table_name in tables:
+                Table(table_name, self.db_meta, autoload=True, useexisting=True)
+            for view_name in views:
+                Table(view_name, self.db_meta, autoload=True)
+            self.__saveschema(key)
+
         for table_name in tables:
-            table = Table(table_name, self.db_meta, \
-                autoload=True, useexisting=True)
-            setattr(self, 'tbl_%s' % table_name, table)
+            setattr(self, 'tbl_%s' % table_name, self.db_meta.tables[table_name])
 
         for view_name in views:
-            view = Table(view_name, self.db_meta, autoload=True)
-            setattr(self, 'view_%s' % view_name, view)
+            setattr(self, 'view_%s' % view_name, self.db_meta.tables[view_name])
+
+    def __schemakey(self, tables, views):
+        """
+        Returns what a schema snapshot has to match to be used: the
+        db_revision, the SQLAlchemy version and the reflected relations.
+        """
+        revision = self.db_pg.execute(
+            "SELECT value FROM config WHERE name = 'db_revision'").scalar()
+        return (revision, sqlalchemy.__version__, tables, views)
+
+    def __loadschema(self, key):
+        """
+        Returns the MetaData of the schema snapshot in DB::SchemaCache if
+        it matches key, None otherwise.
+        """
+        from config import Config
+        filename = Config().find("DB::SchemaCache")
+        if not filename:
+            return None
+        try:
+            with open(filename, 'rb') as fh:
+                cached_key, meta = cPickle.load(fh)
+        except Exception:
+            return None
+        if cached_key != key:
+            return None
+        return meta
+
+    def __saveschema(self, key):
+        """
+        Writes the reflected schema to DB::SchemaCache, if set.
+        """
+        from config import Config
+        filename = Config().find("DB::SchemaCache")
+        if not filename:
+            return
+        try:
+            fd, tempname = mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+            with os.fdopen(fd, 'wb') as fh:
+                cPickle.dump((key, self.db_meta), fh, cPickle.HIGHEST_PROTOCOL)
+            os.chmod(tempname, 0o644)
+            os.rename(tempname, filename)
+        except (IOError, OSError) as e:
+            print "Cannot write schema cache %s: %s" % (filename, e)
 
     def __setupmappers(self):
         mapper(Architecture, self.tbl_architecture,
@@ -2928,6 +3212,9 @@ class DBConn(object):
             engine_args['pool_size'] = int(cnf['DB::PoolSize'])
         if cnf.has_key('DB::MaxOverflow'):
             engine_args['max_overflow'] = int(cnf['DB::MaxOverflow'])
+        if getattr(self, 'max_connections', None):
+            engine_args['pool_size'] = self.max_connections
+            engine_args['max_overflow'] = 0
         if sa_major_version != '0.5' and cnf.has_key('DB::Unicode') and \
             cnf['DB::Unicode'] == 'false':
             engine_args['use_native_unicode'] = False
@@ -2946,16 +3233,27 @@ class DBConn(object):
 
         sqlalchemy.dialects.postgresql.base.dialect = PGDialect_psycopg2_dak
 
+        # The connections of an engine inherited from the parent process
+        # belong to the parent: closing them here would terminate them
+        # for the parent as well, so they are kept referenced and unused.
+        if getattr(self, 'db_pg', None) is not None:
+            self.__dict__.setdefault('inherited_engines', []).append(self.db_pg)
+
         try:
             self.db_pg   = create_engine(connstr, **engine_args)
-            self.db_meta = MetaData()
-            self.db_meta.bind = self.db_pg
             self.db_smaker = sessionmaker(bind=self.db_pg,
                                           autoflush=True,
                                           autocommit=False)
 
-            self.__setuptables()
-            self.__setupmappers()
+            # tables and mappers do not depend on the engine, so a forked
+            # process only needs a new engine of its own
+            if getattr(self, 'db_meta', None) is None:
+                self.db_meta = MetaData()
+                self.db_meta.bind = self.db_pg
+                self.__setuptables()
+                self.__setupmappers()
+            else:
+                self.db_meta.bind = self.db_pg
 
         except OperationalError as e:
             import utils
@@ -2970,9 +3268,8 @@ class DBConn(object):
         transaction. The work_mem parameter is measured in MB. A default value
         will be used if the parameter is not set.
         '''
-        # reinitialize DBConn in new processes
+        # new processes need their own connections
         if self.pid != os.getpid():
-            clear_mappers()
             self.__createconn()
         session = self.db_smaker()
         if work_mem > 0:
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""
+Streaming access to the data.tar member of .deb files and to source tarballs
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import subprocess
+import tarfile
+import threading
+
+import daklib.daksubprocess
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+__all__ = []
+
+AR_MAGIC = '!<arch>\n'
+AR_HEADER_SIZE = 60
+
+class DebFormatError(Exception):
+    pass
+
+__all__.append('DebFormatError')
+
+################################################################################
+
+class MemberFile(object):
+    """
+    Read-only file object for the data of one member of an ar archive.
+    """
+    def __init__(self, fh, size):
+        self.fh = fh
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fh.read(size)
+        self.remaining -= len(data)
+        return data
+
+class DecompressFile(object):
+    """
+    Read-only file object decompressing the data read from fh with a
+    decompressor object (with a decompress() method).
+
+    If the decompressor can limit its output (it has needs_input and eof,
+    like LZMADecompressor in Python 3.5), at most chunk_size bytes are
+    decompressed at a time. Data is handed out by moving an offset into
+    the buffer, which is only copied when it runs low.
+    """
+    def __init__(self, fh, decompressor, chunk_size=65536):
+        self.fh = fh
+        self.decompressor = decompressor
+        self.chunk_size = chunk_size
+        self.bounded = hasattr(decompressor, 'needs_input') and hasattr(decompressor, 'eof')
+        self.buffer = ''
+        self.offset = 0
+
+    def _decompress(self):
+        """
+        Returns the next piece of decompressed data, which may be empty, or
+        None at the end of the stream.
+        """
+        if self.bounded:
+            if self.decompressor.eof:
+                return None
+            chunk = ''
+            if self.decompressor.needs_input:
+                chunk = self.fh.read(self.chunk_size)
+                if not chunk:
+                    return None
+            return self.decompressor.decompress(chunk, self.chunk_size)
+        chunk = self.fh.read(self.chunk_size)
+        if not chunk:
+            return None
+        return self.decompressor.decompress(chunk)
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.offset < size:
+            data = self._decompress()
+            if data is None:
+                break
+            if not data:
+                continue
+            # only the small rest of the buffer is copied here
+            self.buffer = self.buffer[self.offset:] + data
+            self.offset = 0
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        if self.offset == len(self.buffer):
+            self.buffer = ''
+            self.offset = 0
+        return data
+
+class PipeFile(object):
+    """
+    Read-only file object with the output of cmd fed with the data of fh.
+    A thread copies the input, so neither side of the pipe can block the
+    other.
+    """
+    def __init__(self, fh, cmd):
+        self.cmd = cmd
+        self.process = daklib.daksubprocess.Popen(cmd, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, close_fds=True)
+        self.feeder = threading.Thread(target=self._feed, args=(fh, ))
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def _feed(self, fh):
+        try:
+            while True:
+                chunk = fh.read(65536)
+                if not chunk:
+                    break
+                self.process.stdin.write(chunk)
+        except IOError:
+            # the decompressor exited early; close() reports it
+            pass
+        finally:
+            self.process.stdin.close()
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        self.process.stdout.close()
+        self.feeder.join()
+        if self.process.wait() != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.cmd)
+
+################################################################################
+
+def ar_members(fh):
+    """
+    Yields (name, size) for the members of the ar archive fh. fh is
+    positioned at the start of the member's data when the tuple is yielded
+    and must not be moved past its end.
+    """
+    if fh.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise DebFormatError("not an ar archive")
+    offset = len(AR_MAGIC)
+    while True:
+        header = fh.read(AR_HEADER_SIZE)
+        if not header:
+            return
+        if len(header) != AR_HEADER_SIZE or header[58:60] != '`\n':
+            raise DebFormatError("invalid ar member header")
+        name = header[0:16].rstrip(' ').rstrip('/')
+        size = int(header[48:58])
+        offset += AR_HEADER_SIZE
+        yield (name, size)
+        # members are aligned to even offsets
+        offset += size + (size % 2)
+        fh.seek(offset)
+
+__all__.append('ar_members')
+
+def open_tar(fileobj, name):
+    """
+    Returns a tarfile.TarFile in stream mode reading the tarball name from
+    fileobj, and a file object to close when done (or None). The
+    compression is chosen by the suffix of name.
+    """
+    if name.endswith('.tar'):
+        return tarfile.open(fileobj=fileobj, mode='r|'), None
+    if name.endswith('.tar.gz'):
+        return tarfile.open(fileobj=fileobj, mode='r|gz'), None
+    if name.endswith('.tar.bz2'):
+        return tarfile.open(fileobj=fileobj, mode='r|bz2'), None
+    if name.endswith('.tar.xz') and lzma is not None:
+        data = DecompressFile(fileobj, lzma.LZMADecompressor())
+        return tarfile.open(fileobj=data, mode='r|'), None
+    if name.endswith('.tar.xz'):
+        data = PipeFile(fileobj, ['xz', '-dc'])
+        return tarfile.open(fileobj=data, mode='r|'), data
+    if name.endswith('.tar.zst'):
+        data = PipeFile(fileobj, ['zstd', '-dc'])
+        return tarfile.open(fileobj=data, mode='r|'), data
+    raise DebFormatError("unsupported tarball %s" % (name))
+
+__all__.append('open_tar')
+
+def open_data_tar(fh):
+    """
+    Returns a tarfile.TarFile in stream mode for the data.tar member of the
+    .deb opened as fh, and a file object to close when done (or None).
+    """
+    for name, size in ar_members(fh):
+        if name.startswith('data.tar'):
+            return open_tar(MemberFile(fh, size), name)
+    raise DebFormatError("no data.tar member found")
+
+__all__.append('open_data_tar')
+
+def stream_members(tar, pipe):
+    """
+    Yields the TarInfo objects of tar and closes tar and pipe (if not None)
+    when done. Only the current member is kept in memory.
+    """
+    try:
+        for member in tar:
+            yield member
+            # TarFile remembers every member it has seen
+            tar.members = []
+    finally:
+        tar.close()
+        if pipe is not None:
+            pipe.close()
+
+def data_members(filename):
+    """
+    Yields the TarInfo objects of the data.tar member of the .deb filename,
+    reading the archive as a stream. Only the current member is kept in
+    memory.
+    """
+    with open(filename, 'rb') as fh:
+        tar, pipe = open_data_tar(fh)
+        for member in stream_members(tar, pipe):
+            yield member
+
+__all__.append('data_members')
+
+def deb_tar_members(filename, tarballs=('control.tar', 'data.tar')):
+    """
+    Yields (tarball, member) for the members of the tarballs (ar member
+    name prefixes) of the .deb filename, reading it as a stream. member is
+    a TarInfo object.
+    """
+    with open(filename, 'rb') as fh:
+        for name, size in ar_members(fh):
+            if not name.startswith(tarballs):
+                continue
+            tar, pipe = open_tar(MemberFile(fh, size), name)
+            for member in stream_members(tar, pipe):
+                yield name, member
+
+__all__.append('deb_tar_members')
+
+def tar_members(filename):
+    """
+    Yields (member, data) for the members of the (compressed) tarball
+    filename, reading it as a stream. member is a TarInfo object and data a
+    file object for regular files (None otherwise) which can only be read
+    before the next member is requested.
+    """
+    with open(filename, 'rb') as fh:
+        tar, pipe = open_tar(fh, filename)
+        for member in stream_members(tar, pipe):
+            data = tar.extractfile(member) if member.isfile() else None
+            yield member, data
+
+__all__.append('tar_members')
@@ -27,13 +27,83 @@ Helper code for file writing with optional compression.
 
 from daklib.config import Config
 
-from daklib.daksubprocess import check_call
+from daklib.daksubprocess import Popen
+from daklib.checksumcache import checksum_fields, record_checksums
 
+import hashlib
 import os, os.path
+import subprocess
+
+class MultiFile(object):
+    '''
+    Write-only file object passing everything written to it on to several
+    file objects. If writing to one of them fails, e.g. because a
+    compressor died, on_error is called before the exception is passed on.
+    '''
+    def __init__(self, files, on_error=None):
+        self.files = files
+        self.on_error = on_error
+
+    def write(self, data):
+        try:
+            for f in self.files:
+                f.write(data)
+        except:
+            self._failed()
+            raise
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        try:
+            for f in self.files:
+                f.flush()
+        except:
+            self._failed()
+            raise
+
+    # internal helper function
+    def _failed(self):
+        if self.on_error is not None:
+            self.on_error()
+
+class ChecksumFile(object):
+    '''
+    Write-only file object computing the size and checksums of the data
+    written to it.
+    '''
+    def __init__(self):
+        self.size = 0
+        self.hashes = dict([(field, hashlib.new(column[:-3]))
+                            for field, column in checksum_fields])
+
+    def write(self, data):
+        self.size += len(data)
+        for h in self.hashes.values():
+            h.update(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def checksums(self):
+        '''
+        Returns the checksums keyed on the Release file field names.
+        '''
+        return dict([(field, h.hexdigest()) for field, h in self.hashes.items()])
 
 class BaseFileWriter(object):
     '''
     Base class for compressed and uncompressed file writing.
+
+    The data is compressed while it is written: every configured compressor
+    runs as its own process and is fed through a pipe, so they work
+    concurrently and no uncompressed copy is written unless 'none' is
+    among the requested compressions.
     '''
     def __init__(self, template, **keywords):
         '''
@@ -41,15 +111,42 @@ class BaseFileWriter(object):
         "dists/%(suite)s/%(component)s/Contents-%(architecture)s.gz" that
         should be relative to the archive's root directory. The keywords
         include strings for suite, component, architecture and booleans
-        uncompressed, gzip, bzip2.
+        uncompressed, gzip, bzip2. The number of threads used by xz can be
+        given as xz_threads and defaults to Dinstall::XzThreads (1).
+        If record_checksums (default: Dinstall::RecordChecksums) is true,
+        the checksums of the uncompressed data are stored in the checksum
+        cache, so generate-releases does not have to decompress the file.
         '''
         compression = keywords.get('compression', ['none'])
         self.uncompressed = 'none' in compression
         self.gzip = 'gzip' in compression
         self.bzip2 = 'bzip2' in compression
         self.xz = 'xz' in compression
+        self.xz_threads = keywords.get('xz_threads')
+        self.record_checksums = keywords.get('record_checksums')
+        if self.record_checksums is None:
+            self.record_checksums = Config().find_b('Dinstall::RecordChecksums', False)
         self.path = template % keywords
 
+    def commands(self):
+        '''
+        Returns a list of (command, suffix) for the configured compressors.
+        '''
+        commands = []
+        if self.gzip:
+            commands.append((['gzip', '-9cn', '--rsyncable'], 'gz'))
+        if self.bzip2:
+            commands.append((['bzip2', '-9'], 'bz2'))
+        if self.xz:
+            threads = self.xz_threads
+            if threads is None:
+                threads = Config().find_i('Dinstall::XzThreads', 1)
+            cmd = ['xz', '-c']
+            if threads != 1:
+                cmd.append('-T%d' % (threads))
+            commands.append((cmd, 'xz'))
+        return commands
+
     def open(self):
         '''
         Returns a file object for writing.
@@ -59,7 +156,28 @@ class BaseFileWriter(object):
             os.makedirs(os.path.dirname(self.path))
         except:
             pass
-        self.file = open(self.path + '.new', 'w')
+        self.processes = []
+        # every handle is added as soon as it is open, so abort can close it
+        self.outputs = []
+        try:
+            for cmd, suffix in self.commands():
+                with open("{0}.{1}.new".format(self.path, suffix), 'w') as out_fh:
+                    # close_fds, or the compressors would hold each other's
+                    # pipes open and never see the end of their input
+                    process = Popen(cmd, stdin=subprocess.PIPE, stdout=out_fh,
+                                    bufsize=65536, close_fds=True)
+                self.processes.append((process, cmd, suffix))
+                self.outputs.append(process.stdin)
+            if self.uncompressed:
+                self.outputs.append(open(self.path + '.new', 'w'))
+            self.checksum_file = None
+            if self.record_checksums:
+                self.checksum_file = ChecksumFile()
+                self.outputs.append(self.checksum_file)
+        except:
+            self.abort()
+            raise
+        self.file = MultiFile(self.outputs, on_error=self.abort)
         return self.file
 
     # internal helper function
@@ -68,29 +186,59 @@ class BaseFileWriter(object):
         os.chmod(tempfilename, 0o644)
         os.rename(tempfilename, filename)
 
-    # internal helper function to compress output
-    def compress(self, cmd, suffix, path):
-        in_filename = "{0}.new".format(path)
-        out_filename = "{0}.{1}.new".format(path, suffix)
-        with open(in_filename, 'r') as in_fh, open(out_filename, 'w') as out_fh:
-            check_call(cmd, stdin=in_fh, stdout=out_fh)
-        self.rename("{0}.{1}".format(path, suffix))
+    def abort(self):
+        '''
+        Closes all open handles, stops the compressors and removes the
+        temporary files.
+        '''
+        for f in self.outputs:
+            try:
+                f.close()
+            except (IOError, OSError):
+                # e.g. EPIPE when flushing to a compressor that died
+                pass
+        for process, cmd, suffix in self.processes:
+            process.wait()
+        for cmd, suffix in self.commands():
+            self.unlink("{0}.{1}.new".format(self.path, suffix))
+        self.unlink(self.path + '.new')
+
+    # internal helper function
+    def unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
 
     def close(self):
         '''
-        Closes the file object and does the compression and rename work.
+        Closes the file object, waits for the compressors and renames the
+        files into place.
         '''
-        self.file.close()
-        if self.gzip:
-            self.compress(['gzip', '-9cn', '--rsyncable'], 'gz', self.path)
-        if self.bzip2:
-            self.compress(['bzip2', '-9'], 'bz2', self.path)
-        if self.xz:
-            self.compress(['xz', '-c'], 'xz', self.path)
+        try:
+            for f in self.outputs:
+                f.close()
+        except:
+            self.abort()
+            raise
+        failed = None
+        for process, cmd, suffix in self.processes:
+            if process.wait() != 0 and failed is None:
+                failed = subprocess.CalledProcessError(process.returncode, cmd)
+        if failed is not None:
+            self.abort()
+            raise failed
+        stat_path = None
+        for process, cmd, suffix in self.processes:
+            stat_path = "{0}.{1}".format(self.path, suffix)
+            self.rename(stat_path)
         if self.uncompressed:
+            stat_path = self.path
             self.rename(self.path)
-        else:
-            os.unlink(self.path + '.new')
+        if self.checksum_file is not None and stat_path is not None:
+            record_checksums(os.path.realpath(self.path), self.checksum_file.size,
+                             self.checksum_file.checksums(),
+                             os.path.realpath(stat_path))
 
 class BinaryContentsFileWriter(BaseFileWriter):
     def __init__(self, **keywords):
@@ -34,7 +34,7 @@ class _FilesystemAction(object):
             pass
 
 class _FilesystemCopyAction(_FilesystemAction):
-    def __init__(self, source, destination, link=True, symlink=False, mode=None):
+    def __init__(self, source, destination, link=True, symlink=False, mode=None, copy_function=shutil.copy2):
         self.destination = destination
         self.need_cleanup = False
 
@@ -57,9 +57,9 @@ class _FilesystemCopyAction(_FilesystemAction):
             try:
                 os.link(source, self.destination)
             except OSError:
-                shutil.copy2(source, self.destination)
+                copy_function(source, self.destination)
         else:
-            shutil.copy2(source, self.destination)
+            copy_function(source, self.destination)
 
         self.need_cleanup = True
         if mode is not None:
@@ -122,7 +122,7 @@ class FilesystemTransaction(object):
     def __init__(self):
         self.actions = []
 
-    def copy(self, source, destination, link=False, symlink=False, mode=None):
+    def copy(self, source, destination, link=False, symlink=False, mode=None, copy_function=shutil.copy2):
         """copy C{source} to C{destination}
 
         @type  source: str
@@ -139,11 +139,15 @@ class FilesystemTransaction(object):
 
         @type  mode: int
         @param mode: permissions to change C{destination} to
+
+        @type  copy_function: callable
+        @param copy_function: function called as C{copy_function(source, destination)}
+                              to copy the file, taking the place of C{shutil.copy2}
         """
         if isinstance(mode, str) or isinstance(mode, unicode):
             mode = int(mode, 8)
 
-        self.actions.append(_FilesystemCopyAction(source, destination, link=link, symlink=symlink, mode=mode))
+        self.actions.append(_FilesystemCopyAction(source, destination, link=link, symlink=symlink, mode=mode, copy_function=copy_function))
 
     def move(self, source, destination, mode=None):
         """move C{source} to C{destination}
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Comparison of the files in an archive's pool with the database
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import os
+
+from daklib.debtar import deb_tar_members
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+__all__ = []
+
+################################################################################
+
+def _entries(directory):
+    """
+    Returns (name, is_dir, is_symlink) for the entries of directory.
+    is_dir follows symlinks like os.walk does.
+    """
+    if scandir is not None:
+        return [(e.name, e.is_dir(), e.is_symlink()) for e in scandir(directory)]
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        entries.append((name, os.path.isdir(path), os.path.islink(path)))
+    return entries
+
+def sorted_files(top, prefix=''):
+    """
+    Yields the paths (relative to top) of all non-directories below top in
+    byte-wise sorted order, which is the order of ORDER BY ... COLLATE "C".
+    Like os.walk, symlinks to directories are neither listed nor followed.
+
+    Directories are sorted by their name with a '/' appended, so the
+    depth-first walk produces the same order as sorting all full paths.
+    """
+    def key(entry):
+        name, is_dir, is_symlink = entry
+        return name + '/' if is_dir else name
+    for name, is_dir, is_symlink in sorted(_entries(top), key=key):
+        if is_dir:
+            if not is_symlink:
+                for path in sorted_files(os.path.join(top, name), prefix + name + '/'):
+                    yield path
+        else:
+            yield prefix + name
+
+__all__.append('sorted_files')
+
+def merge_join(expected, found):
+    """
+    Compares two iterables of tuples sorted by their first element (the
+    key) and yields (key, expected tuple or None, found tuple or None) in
+    key order. Only the current tuple of each side is held in memory.
+    """
+    expected = iter(expected)
+    found = iter(found)
+    e = next(expected, None)
+    f = next(found, None)
+    while e is not None or f is not None:
+        if f is None or (e is not None and e[0] < f[0]):
+            yield (e[0], e, None)
+            e = next(expected, None)
+        elif e is None or f[0] < e[0]:
+            yield (f[0], None, f)
+            f = next(found, None)
+        else:
+            yield (e[0], e, f)
+            e = next(expected, None)
+            f = next(found, None)
+
+__all__.append('merge_join')
+
+def future_timestamps(filename, now):
+    """
+    Returns (tarball, member name, mtime) for every member of the control
+    and data tarballs of the .deb filename with a modification time after
+    now; common from hardware (e.g. alpha) with far-future default dates.
+    """
+    return [(tarball, member.name, member.mtime)
+            for tarball, member in deb_tar_members(filename)
+            if member.mtime > now]
+
+__all__.append('future_timestamps')
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Verification of the size and checksums of pool files
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import hashlib
+import os
+import time
+import zlib
+
+__all__ = []
+
+################################################################################
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the number of bytes per second read by the
+    process using it. A rate of 0 disables the limit.
+    """
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+
+    def consume(self, size):
+        """
+        Takes size bytes from the bucket, sleeping until enough bytes have
+        accumulated.
+        """
+        if not self.rate:
+            return
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+        self.tokens -= size
+        if self.tokens < 0:
+            self._sleep(-self.tokens / float(self.rate))
+
+__all__.append('RateLimiter')
+
+def hash_file(path, limiter=None, chunk_size=1024 * 1024):
+    """
+    Reads path once and computes all its checksums.
+
+    @rtype: tuple
+    @return: (size, md5sum, sha1sum, sha256sum)
+    """
+    md5, sha1, sha256 = hashlib.md5(), hashlib.sha1(), hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            if limiter is not None:
+                limiter.consume(len(chunk))
+            size += len(chunk)
+            md5.update(chunk)
+            sha1.update(chunk)
+            sha256.update(chunk)
+    return (size, md5.hexdigest(), sha1.hexdigest(), sha256.hexdigest())
+
+__all__.append('hash_file')
+
+def verify_files(files, rate=0):
+    """
+    Checks the size and checksums of files, a list of (file_id, path,
+    size, md5sum, sha1sum, sha256sum) tuples, reading at most rate bytes
+    per second (0: no limit).
+
+    @rtype: tuple
+    @return: (file ids checked, list of problem descriptions, bytes read)
+    """
+    limiter = RateLimiter(rate)
+    problems = []
+    done = []
+    total = 0
+    for entry in files:
+        file_id, path = entry[0:2]
+        expected = entry[2:6]
+        try:
+            actual = hash_file(path, limiter)
+        except (IOError, OSError) as e:
+            problems.append("can't read '%s': %s" % (path, e))
+            done.append(file_id)
+            continue
+        total += actual[0]
+        for name, value, wanted in zip(('size', 'md5sum', 'sha1sum', 'sha256sum'),
+                                       actual, expected):
+            if wanted is not None and value != wanted:
+                problems.append("**WARNING** %s mismatch for '%s' ('%s' [current] vs. '%s' [db])."
+                                % (name, path, value, wanted))
+        done.append(file_id)
+    return (done, problems, total)
+
+__all__.append('verify_files')
+
+################################################################################
+
+def shard_of(filename, shards):
+    """
+    Returns the shard (0 <= shard < shards) of a pool filename. All files of
+    a pool directory end up in the same shard, and the assignment does not
+    depend on the files present.
+    """
+    return (zlib.crc32(os.path.dirname(filename)) & 0xffffffff) % shards
+
+__all__.append('shard_of')
+
+def parse_shard(text):
+    """
+    Parses a shard specification 'N/M' into (N, M), with 0 <= N < M.
+    """
+    try:
+        shard, shards = [int(v) for v in text.split('/')]
+    except ValueError:
+        raise ValueError("invalid shard '%s', expected N/M" % (text))
+    if not 0 <= shard < shards:
+        raise ValueError("invalid shard '%s', N must be between 0 and M-1" % (text))
+    return (shard, shards)
+
+__all__.append('parse_shard')
+
+class Checkpoint(object):
+    """
+    Records the ids of the files already verified in a file, so an
+    interrupted run can resume where it stopped.
+
+    The file only ever grows by appending complete lines, so a crash
+    loses at most the last batch.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = None
+
+    def load(self):
+        """
+        Returns the set of file ids recorded so far.
+        """
+        done = set()
+        try:
+            with open(self.filename) as fh:
+                for line in fh:
+                    if line.endswith('\n'):
+                        done.add(int(line))
+        except IOError:
+            pass
+        return done
+
+    def record(self, file_ids):
+        """
+        Appends file_ids and makes sure they are on disk.
+        """
+        if self._fh is None:
+            self._fh = open(self.filename, 'a+')
+            # drop a line cut off by a crash
+            self._fh.seek(0)
+            data = self._fh.read()
+            if not data.endswith('\n'):
+                self._fh.truncate(data.rfind('\n') + 1)
+        self._fh.write(''.join(['%d\n' % i for i in file_ids]))
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def remove(self):
+        """
+        Deletes the checkpoint after a complete run.
+        """
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+__all__.append('Checkpoint')
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Reverse dependency index of a suite
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import apt_pkg
+
+from daklib.regexes import re_build_dep_arch
+
+__all__ = []
+
+################################################################################
+
+class ArchitectureDependencies(object):
+    """
+    Depends and Provides of the binaries of one architecture of a suite,
+    with the Depends already parsed and indexed by the names they mention.
+    """
+    def __init__(self):
+        # package -> (source, component)
+        self.packages = dict()
+        # package -> parsed Depends
+        self.depends = dict()
+        # virtual package -> set of packages providing it
+        self.providers = dict()
+        # package name -> set of packages mentioning it in their Depends
+        self.rdepends = dict()
+
+    def add(self, package, source, component, depends, provides):
+        """
+        Adds a binary package with its Depends and Provides fields (or None).
+        """
+        self.packages[package] = (source, component)
+        if depends is not None:
+            try:
+                parsed = apt_pkg.parse_depends(depends)
+            except ValueError as e:
+                print "Error for package %s: %s" % (package, e)
+                parsed = []
+            self.depends[package] = parsed
+            for dep in parsed:
+                for dep_package, _, _ in dep:
+                    self.rdepends.setdefault(dep_package, set()).add(package)
+        if provides is not None:
+            for virtual_pkg in provides.split(","):
+                virtual_pkg = virtual_pkg.strip()
+                if virtual_pkg == package:
+                    continue
+                self.providers.setdefault(virtual_pkg, set()).add(package)
+
+    def removed_virtuals(self, removals):
+        """
+        Returns the virtual packages only provided by packages in removals.
+        """
+        return [virtual_pkg for virtual_pkg, providers in self.providers.iteritems()
+                if providers.issubset(removals)]
+
+    def broken(self, removals):
+        """
+        Yields the packages not in removals which have a dependency only
+        satisfied by packages in removals. Only the packages depending on
+        something in removals are looked at.
+        """
+        candidates = set()
+        for package in removals:
+            candidates.update(self.rdepends.get(package, ()))
+        for package in candidates:
+            if package in removals:
+                continue
+            for dep in self.depends[package]:
+                # Check for partial breakage.  If a package has a ORed
+                # dependency, there is only a dependency problem if all
+                # packages in the ORed depends will be removed.
+                if all([dep_package in removals for dep_package, _, _ in dep]):
+                    yield package
+                    break
+
+__all__.append('ArchitectureDependencies')
+
+class ReverseDependencies(object):
+    """
+    Reverse dependency index of a suite: the Depends and Provides of its
+    binaries per architecture and the Build-Depends(-Indep) of its sources.
+    It answers which packages would break by removing a set of packages
+    without going back to the database.
+    """
+    def __init__(self, suite, session):
+        self.suite_id = suite.suite_id
+        self.architectures = dict()
+        # list of (source, parsed Build-Depends)
+        self.sources = []
+        # package name -> set of indexes into self.sources
+        self.build_rdepends = dict()
+        self._load_binaries(session)
+        self._load_sources(session)
+
+    def _load_binaries(self, session):
+        """
+        Loads Depends and Provides of all binaries of the suite with a
+        single query.
+        """
+        statement = '''
+            SELECT a.arch_string, b.package, s.source, c.name,
+                   bmd.value AS depends, bmp.value AS provides
+              FROM binaries b
+              JOIN bin_associations ba ON b.id = ba.bin AND ba.suite = :suite_id
+              JOIN architecture a ON b.architecture = a.id
+              JOIN source s ON b.source = s.id
+              JOIN files_archive_map af ON b.file = af.file_id
+              JOIN component c ON af.component_id = c.id
+              LEFT JOIN binaries_metadata bmd ON bmd.bin_id = b.id
+                   AND bmd.key_id = (SELECT key_id FROM metadata_keys WHERE key = 'Depends')
+              LEFT JOIN binaries_metadata bmp ON bmp.bin_id = b.id
+                   AND bmp.key_id = (SELECT key_id FROM metadata_keys WHERE key = 'Provides')'''
+        for arch, package, source, component, depends, provides in \
+                session.execute(statement, {'suite_id': self.suite_id}):
+            if arch not in self.architectures:
+                self.architectures[arch] = ArchitectureDependencies()
+            self.architectures[arch].add(package, source, component, depends, provides)
+
+    def _load_sources(self, session):
+        """
+        Loads the Build-Depends and Build-Depends-Indep of all sources of
+        the suite with a single query.
+        """
+        statement = '''
+            SELECT s.source, string_agg(sm.value, ', ') AS build_dep
+               FROM source s
+               JOIN source_metadata sm ON s.id = sm.src_id
+               JOIN metadata_keys mk ON sm.key_id = mk.key_id
+               WHERE s.id IN
+                   (SELECT source FROM src_associations
+                       WHERE suite = :suite_id)
+                   AND mk.key IN ('Build-Depends', 'Build-Depends-Indep')
+               GROUP BY s.id, s.source'''
+        for source, build_dep in session.execute(statement, {'suite_id': self.suite_id}):
+            parsed = []
+            if build_dep is not None:
+                # Remove [arch] information since we want to see breakage on all arches
+                build_dep = re_build_dep_arch.sub("", build_dep)
+                try:
+                    parsed = apt_pkg.parse_depends(build_dep)
+                except ValueError as e:
+                    print "Error for source %s: %s" % (source, e)
+            index = len(self.sources)
+            self.sources.append((source, parsed))
+            for dep in parsed:
+                for dep_package, _, _ in dep:
+                    self.build_rdepends.setdefault(dep_package, set()).add(index)
+
+    def architecture(self, arch):
+        """
+        Returns the ArchitectureDependencies of arch (empty if the suite has
+        no binaries for it).
+        """
+        return self.architectures.get(arch, ArchitectureDependencies())
+
+    def broken_sources(self, removals):
+        """
+        Yields (source, dep) for every Build-Depends or Build-Depends-Indep
+        alternative list of a source not in removals that is only
+        satisfied by packages in removals.
+        """
+        candidates = set()
+        for package in removals:
+            candidates.update(self.build_rdepends.get(package, ()))
+        for index in sorted(candidates):
+            source, parsed = self.sources[index]
+            if source in removals:
+                continue
+            for dep in parsed:
+                if all([dep_package in removals for dep_package, _, _ in dep]):
+                    yield (source, dep)
+
+__all__.append('ReverseDependencies')
+
+# suite_id -> ReverseDependencies, built at most once per process
+_indexes = dict()
+
+def get_reverse_dependencies(suite, session):
+    """
+    Returns the ReverseDependencies of the Suite object suite. The index is
+    built on first use and kept for the lifetime of the process, so it
+    does not see changes to the suite made afterwards.
+    """
+    if suite.suite_id not in _indexes:
+        _indexes[suite.suite_id] = ReverseDependencies(suite, session)
+    return _indexes[suite.suite_id]
+
+__all__.append('get_reverse_dependencies')
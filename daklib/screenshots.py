@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Concurrent, cached fetching and thumbnailing of screenshots
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib2
+import urlparse
+
+from collections import deque
+
+__all__ = []
+
+################################################################################
+
+class MediaCache(object):
+    """
+    Cache of downloaded media files, keyed on their URL.
+
+    Each URL gets a directory holding the file as 'source', derived files
+    such as thumbnails, and a 'meta.json' with the ETag and Last-Modified
+    headers of the last response. Entries older than max_age seconds are
+    revalidated with a conditional request instead of downloaded again.
+    """
+    def __init__(self, directory, max_age=86400, max_size=10 * 1024 * 1024):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_size = max_size
+
+    def entry_dir(self, url):
+        """
+        Returns the directory of the cache entry for url.
+        """
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.directory, key[0:2], key)
+
+    def read_meta(self, url):
+        """
+        Returns the metadata dict of the cache entry for url, or None.
+        """
+        try:
+            with open(os.path.join(self.entry_dir(url), 'meta.json')) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return None
+
+    def write_meta(self, url, meta):
+        """
+        Atomically replaces the metadata of the cache entry for url.
+        """
+        filename = os.path.join(self.entry_dir(url), 'meta.json')
+        with open(filename + '.new', 'w') as fh:
+            json.dump(meta, fh)
+        os.rename(filename + '.new', filename)
+
+    def fetch(self, url, timeout=30):
+        """
+        Makes sure the cache holds a current copy of url.
+
+        @rtype: tuple
+        @return: (directory, meta, changed) where changed is True if the
+                 file was (re)downloaded.
+        """
+        directory = self.entry_dir(url)
+        source = os.path.join(directory, 'source')
+        meta = self.read_meta(url)
+        if meta is None or not os.path.exists(source):
+            meta = None
+        elif time.time() - meta.get('checked', 0) < self.max_age:
+            return (directory, meta, False)
+
+        request = urllib2.Request(url)
+        if meta is not None:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and meta is not None:
+                meta['checked'] = time.time()
+                self.write_meta(url, meta)
+                return (directory, meta, False)
+            raise
+
+        try:
+            data = response.read(self.max_size + 1)
+            headers = response.info()
+        finally:
+            response.close()
+        if len(data) > self.max_size:
+            raise IOError("%s is larger than %d bytes" % (url, self.max_size))
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(source + '.new', 'wb') as fh:
+            fh.write(data)
+        os.rename(source + '.new', source)
+
+        meta = {
+            'url': url,
+            'etag': headers.getheader('ETag'),
+            'last_modified': headers.getheader('Last-Modified'),
+            'checked': time.time(),
+        }
+        self.write_meta(url, meta)
+        return (directory, meta, True)
+
+__all__.append('MediaCache')
+
+################################################################################
+
+def make_thumbnails(source, directory, sizes):
+    """
+    Decodes the image source once and writes a scaled copy for each
+    'WIDTHxHEIGHT' string in sizes to directory/WIDTHxHEIGHT.png.
+
+    @rtype: tuple
+    @return: (width, height) of the source image
+    """
+    from PIL import Image
+
+    img = Image.open(source)
+    img.load()
+    for size in sizes:
+        width, height = [int(v) for v in size.split('x')]
+        filename = os.path.join(directory, '%s.png' % (size))
+        img.resize((width, height), Image.ANTIALIAS).save(filename + '.new', 'PNG')
+        os.rename(filename + '.new', filename)
+    return img.size
+
+__all__.append('make_thumbnails')
+
+################################################################################
+
+class ScreenshotFetcher(object):
+    """
+    Fetches screenshots into a MediaCache and thumbnails them, using a pool
+    of threads.
+
+    At most per_host requests run against the same host at any time, and
+    threads only pick up URLs of hosts that have a free slot, so a slow or
+    hanging host only ever ties up per_host threads. Each URL is processed
+    only once, however often it is submitted while in flight.
+    """
+    def __init__(self, cache, sizes, threads=8, per_host=2, timeout=30):
+        self._cache = cache
+        self._sizes = sizes
+        self._per_host = per_host
+        self._timeout = timeout
+        self._cond = threading.Condition()
+        # url -> list of callbacks
+        self._jobs = dict()
+        # host -> deque of urls not started yet
+        self._pending = dict()
+        # host -> number of running requests
+        self._active = dict()
+        self._callbacks_running = 0
+        self._closed = False
+        self._threads = list()
+        for i in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, url, callback):
+        """
+        Queues url. callback(url, result, error) is called from a worker
+        thread when done, result being a dict with the keys 'source',
+        'width', 'height' and 'thumbnails' (a list of (size, filename)).
+        On failure result is None and error the exception.
+        """
+        host = urlparse.urlparse(url).netloc
+        with self._cond:
+            if url in self._jobs:
+                self._jobs[url].append(callback)
+                return
+            self._jobs[url] = [callback]
+            self._pending.setdefault(host, deque()).append(url)
+            self._cond.notify_all()
+
+    def _next(self):
+        """
+        Waits for an URL of a host with a free slot. Returns (host, url),
+        or None once the fetcher is closed. Must hold self._cond.
+        """
+        while True:
+            for host, urls in self._pending.items():
+                if urls and self._active.get(host, 0) < self._per_host:
+                    self._active[host] = self._active.get(host, 0) + 1
+                    return (host, urls.popleft())
+            if self._closed:
+                return None
+            self._cond.wait()
+
+    def _work(self):
+        """
+        Main loop of the worker threads.
+        """
+        while True:
+            with self._cond:
+                job = self._next()
+            if job is None:
+                return
+            host, url = job
+            result, error = None, None
+            try:
+                result = self._process(url)
+            except Exception as e:
+                error = e
+            with self._cond:
+                self._active[host] -= 1
+                callbacks = self._jobs.pop(url)
+                self._callbacks_running += 1
+                self._cond.notify_all()
+            try:
+                for callback in callbacks:
+                    try:
+                        callback(url, result, error)
+                    except Exception as e:
+                        # daklib.utils needs the database modules, only
+                        # load them when something went wrong
+                        from daklib.utils import warn
+                        warn("Error in screenshot callback for %s: %s" % (url, e))
+            finally:
+                with self._cond:
+                    self._callbacks_running -= 1
+                    self._cond.notify_all()
+
+    def _process(self, url):
+        """
+        Fetches a single screenshot and makes sure its thumbnails exist.
+        """
+        directory, meta, changed = self._cache.fetch(url, self._timeout)
+        source = os.path.join(directory, 'source')
+        thumbnails = [(size, os.path.join(directory, '%s.png' % (size)))
+                      for size in self._sizes]
+        if self._sizes and (changed or 'width' not in meta or \
+                not all([os.path.exists(t[1]) for t in thumbnails])):
+            meta['width'], meta['height'] = make_thumbnails(source, directory, self._sizes)
+            self._cache.write_meta(url, meta)
+        return {
+            'source': source,
+            'width': meta.get('width'),
+            'height': meta.get('height'),
+            'thumbnails': thumbnails,
+        }
+
+    def wait(self):
+        """
+        Blocks until all submitted URLs are processed and their callbacks
+        have returned.
+        """
+        with self._cond:
+            while self._jobs or self._callbacks_running:
+                self._cond.wait()
+
+    def close(self):
+        """
+        Processes the remaining URLs and stops the worker threads.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+__all__.append('ScreenshotFetcher')
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+List the files of a source package without unpacking it
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import gzip
+import os.path
+import re
+
+from daklib.debtar import tar_members
+from daklib.srcformats import get_format_from_string, FormatOne, FormatThree, \
+    FormatThreeQuilt
+
+__all__ = []
+
+re_orig_tar = re.compile(r'\.orig(?:-(?P<component>[a-zA-Z0-9][a-zA-Z0-9-]*))?\.tar\.[a-z0-9]+$')
+re_debian_tar = re.compile(r'\.debian\.tar\.[a-z0-9]+$')
+re_native_tar = re.compile(r'\.tar\.[a-z0-9]+$')
+re_diff = re.compile(r'\.diff\.gz$')
+re_diff_hunk = re.compile(r'^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+# files dpkg-source creates when applying the patches of 3.0 (quilt) sources
+QUILT_FILES = ('.pc/.quilt_patches', '.pc/.quilt_series', '.pc/.version',
+    '.pc/applied-patches')
+
+################################################################################
+
+def diff_path(text, strip):
+    '''
+    Returns the file name of a '---' or '+++' diff header (without the
+    marker) with strip leading components removed, or None for /dev/null.
+    '''
+    name = text.rstrip('\r\n').split('\t')[0]
+    if name == '/dev/null':
+        return None
+    name = '/'.join(name.split('/')[strip:])
+    return os.path.normpath(name)
+
+def patched_files(lines, strip=1):
+    '''
+    Yields (filename, removed) for every file touched by the unified diff
+    given as an iterable of lines. strip leading path components are
+    removed from the file names. removed is True if the patch deletes the
+    file, either with a /dev/null target or by emptying it.
+
+    The hunks are skipped by their line counts, so removed lines looking
+    like a '---' header are not mistaken for one.
+    '''
+    lines = iter(lines)
+    line = next(lines, None)
+    while line is not None:
+        if not line.startswith('--- '):
+            line = next(lines, None)
+            continue
+        header = next(lines, None)
+        if header is None or not header.startswith('+++ '):
+            line = header
+            continue
+        old_name = diff_path(line[4:], strip)
+        new_name = diff_path(header[4:], strip)
+        emptied = False
+        line = next(lines, None)
+        while line is not None:
+            match = re_diff_hunk.match(line)
+            if match is None:
+                break
+            old_count = int(match.group(1) or 1)
+            new_count = int(match.group(3) or 1)
+            # '+0,0' is the range of a file left empty, which patch removes
+            if match.group(2) == '0' and new_count == 0:
+                emptied = True
+            while old_count > 0 or new_count > 0:
+                line = next(lines, None)
+                if line is None:
+                    break
+                if line.startswith('-'):
+                    old_count -= 1
+                elif line.startswith('+'):
+                    new_count -= 1
+                elif not line.startswith('\\'):
+                    old_count -= 1
+                    new_count -= 1
+            line = next(lines, None)
+        if new_name is None:
+            yield (old_name, True)
+        else:
+            yield (new_name, emptied)
+
+__all__.append('patched_files')
+
+################################################################################
+
+class SourceFileList(object):
+    '''
+    SourceFileList lists the files of a source package as they would be
+    found after 'dpkg-source -x', without extracting anything. The names
+    are read from the tarballs as streams and the files added, removed or
+    backed up (below .pc/) by the debian diff or the quilt patch series are
+    taken from the patch headers.
+
+    Only the formats known to daklib.srcformats are supported, others raise
+    UnknownFormatError.
+    '''
+    def __init__(self, directory, format, filenames):
+        '''
+        directory is the location of the source files, format the Format
+        field of the .dsc and filenames the names of its files.
+        '''
+        self.directory = directory
+        self.format = get_format_from_string(format)
+        self.filenames = filenames
+        # path -> link target for symlinks, None for other non directories
+        self.entries = dict()
+        self.directories = set()
+        self.patches = dict()
+
+        if self.format is FormatThreeQuilt:
+            self.add_orig()
+            self.remove('debian')
+            self.add_tarball(self.find(re_debian_tar), strip=False,
+                keep='debian/patches/')
+            self.apply_series()
+        elif self.format is FormatThree:
+            self.add_tarball(self.find(re_native_tar))
+        elif self.format is FormatOne:
+            diff = self.find(re_diff, required=False)
+            if diff is None:
+                self.add_tarball(self.find(re_native_tar))
+            else:
+                self.add_orig()
+                with gzip.open(os.path.join(self.directory, diff)) as fh:
+                    for name, removed in patched_files(fh):
+                        if not removed:
+                            self.entries[name] = None
+
+    @classmethod
+    def from_dsc(class_, dscfilename):
+        '''
+        Returns the SourceFileList for the .dsc file dscfilename.
+        '''
+        import daklib.utils
+        dsc = daklib.utils.parse_changes(dscfilename, signing_rules=-1, dsc_file=1)
+        files = daklib.utils.build_file_list(dsc, is_a_dsc=1)
+        return class_(os.path.dirname(dscfilename), dsc['format'], files.keys())
+
+    def find(self, regex, required=True):
+        '''
+        Returns the only file of the source matching regex.
+        '''
+        matches = [f for f in self.filenames if regex.search(f)]
+        if len(matches) == 1:
+            return matches[0]
+        if not matches and not required:
+            return None
+        raise ValueError("expected one file matching %s, found %s" %
+            (regex.pattern, matches))
+
+    def add_orig(self):
+        '''
+        Adds the contents of the .orig.tar and the .orig-component.tar
+        files, which replace any directory named like their component.
+        '''
+        components = []
+        for filename in self.filenames:
+            match = re_orig_tar.search(filename)
+            if match is None:
+                continue
+            if match.group('component') is None:
+                components.insert(0, (filename, None))
+            else:
+                components.append((filename, match.group('component')))
+        if not components or components[0][1] is not None:
+            raise ValueError("no .orig.tar file found")
+        for filename, component in components:
+            if component is not None:
+                self.remove(component)
+            self.add_tarball(filename, prefix=component)
+
+    def add_tarball(self, filename, prefix=None, strip=True, keep=None):
+        '''
+        Adds the contents of the tarball filename below prefix. If strip is
+        True and the tarball holds a single top-level directory, only its
+        contents are added like dpkg-source does. The data of the regular
+        files starting with keep is stored in self.patches.
+        '''
+        members = []
+        for member, data in tar_members(os.path.join(self.directory, filename)):
+            name = os.path.normpath(member.name).lstrip('/')
+            if name == '.':
+                continue
+            if member.isdir():
+                members.append((name, True, None))
+            else:
+                members.append((name, False, member.linkname if member.issym() else None))
+            if keep is not None and data is not None and name.startswith(keep):
+                self.patches[name] = data.read()
+
+        if strip:
+            tops = set([name.split('/', 1)[0] for name, isdir, target in members])
+            strip = len(tops) == 1 and \
+                any([isdir or '/' in name for name, isdir, target in members])
+        for name, isdir, target in members:
+            if strip:
+                if '/' not in name:
+                    continue
+                name = name.split('/', 1)[1]
+            if prefix is not None:
+                name = os.path.join(prefix, name)
+            if isdir:
+                self.directories.add(name)
+            else:
+                self.entries[name] = target
+
+    def remove(self, directory):
+        '''
+        Removes directory and everything below it.
+        '''
+        below = directory + '/'
+        for name in self.entries.keys():
+            if name.startswith(below):
+                del self.entries[name]
+        for name in list(self.directories):
+            if name == directory or name.startswith(below):
+                self.directories.remove(name)
+
+    def apply_series(self):
+        '''
+        Applies the quilt series of a 3.0 (quilt) source. Every file touched
+        by a patch gets a backup below .pc/<patch>/.
+        '''
+        series = self.patches.get('debian/patches/debian.series',
+            self.patches.get('debian/patches/series', ''))
+        for line in series.splitlines():
+            line = re.sub(r'(^|\s+)#.*$', '', line).strip()
+            if not line:
+                continue
+            fields = line.split()
+            strip = 1
+            for option in fields[1:]:
+                if re.match(r'^-p\d+$', option):
+                    strip = int(option[2:])
+            patch = fields[0]
+            data = self.patches.get(os.path.normpath('debian/patches/' + patch))
+            if data is None:
+                raise ValueError("patch %s is missing" % (patch))
+            for name, removed in patched_files(data.splitlines(True), strip):
+                self.entries[os.path.join('.pc', patch, name)] = None
+                if removed:
+                    self.entries.pop(name, None)
+                else:
+                    self.entries[name] = None
+        for name in QUILT_FILES:
+            self.entries[name] = None
+
+    def get_all_filenames(self):
+        '''
+        Returns an iterator over all filenames like
+        UnpackedSource.get_all_filenames() does: symlinks are included
+        unless they point to a directory of the source.
+        '''
+        directories = set(self.directories)
+        for name in self.entries:
+            while '/' in name:
+                name = os.path.dirname(name)
+                directories.add(name)
+        for name, target in self.entries.iteritems():
+            if target is not None and not target.startswith('/'):
+                resolved = os.path.normpath(os.path.join(os.path.dirname(name), target))
+                if resolved in directories:
+                    continue
+            yield name
+
+__all__.append('SourceFileList')
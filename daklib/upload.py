@@ -24,8 +24,10 @@ It provides methods to access the included binary and source packages.
 import apt_inst
 import apt_pkg
 import errno
+import hashlib
 import os
 import re
+import shutil
 
 from daklib.gpg import SignedFile
 from daklib.regexes import *
@@ -70,6 +72,82 @@ class FileDoesNotExist(UploadException):
     def __str__(self):
         return "Refers to non-existing file '{0}'".format(self.filename)
 
+class DigestCache(object):
+    """cache of file sizes and hashes
+
+    Remembers the size and hashes of every file hashed or copied through it,
+    keyed by device, inode, size and modification time.  As long as a file
+    is not modified (or replaced), later checks reuse the recorded values
+    instead of reading it again.  Hardlinks share the entry of their inode.
+
+    The cache is meant to live as long as a single upload is processed.
+    """
+    def __init__(self, chunk_size=1024 * 1024):
+        self.chunk_size = chunk_size
+        self._digests = {}
+
+    @staticmethod
+    def _key(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def hash(self, path):
+        """get size and hashes of a file
+
+        Reads the file only if it is not in the cache yet.
+
+        @type  path: str
+        @param path: file to hash
+
+        @raise IOError: file cannot be read
+
+        @rtype:  tuple
+        @return: tuple (size, md5sum, sha1sum, sha256sum)
+        """
+        with open(path, 'r') as fh:
+            key = self._key(os.fstat(fh.fileno()))
+            digests = self._digests.get(key)
+            if digests is None:
+                hashes = apt_pkg.Hashes(fh)
+                digests = self._digests[key] = (key[2], hashes.md5, hashes.sha1, hashes.sha256)
+        return digests
+
+    def copy2(self, source, destination):
+        """copy a file and hash it while copying
+
+        Drop-in replacement for C{shutil.copy2} that records the hashes
+        for both C{source} and C{destination}, so copying and verifying
+        a file is a single pass over its data.
+
+        @type  source: str
+        @param source: source file
+
+        @type  destination: str
+        @param destination: destination file
+        """
+        md5 = hashlib.md5()
+        sha1 = hashlib.sha1()
+        sha256 = hashlib.sha256()
+        with open(source, 'r') as src:
+            source_key = self._key(os.fstat(src.fileno()))
+            with open(destination, 'w') as dst:
+                while True:
+                    data = src.read(self.chunk_size)
+                    if not data:
+                        break
+                    md5.update(data)
+                    sha1.update(data)
+                    sha256.update(data)
+                    dst.write(data)
+            size = src.tell()
+        shutil.copystat(source, destination)
+        digests = (size, md5.hexdigest(), sha1.hexdigest(), sha256.hexdigest())
+        # The source might have changed while we read it.
+        if self._key(os.stat(source)) == source_key and source_key[2] == size:
+            self._digests[source_key] = digests
+        destination_key = self._key(os.stat(destination))
+        if destination_key[2] == size:
+            self._digests[destination_key] = digests
+
 class HashedFile(object):
     """file with checksums
     """
@@ -136,7 +214,7 @@ class HashedFile(object):
             hashes = apt_pkg.Hashes(fh)
         return cls(filename, size, hashes.md5, hashes.sha1, hashes.sha256, section, priority)
 
-    def check(self, directory):
+    def check(self, directory, digests=None):
         """Validate hashes
 
         Check if size and hashes match the expected value.
@@ -144,14 +222,21 @@ class HashedFile(object):
         @type  directory: str
         @param directory: directory the file is located in
 
+        @type  digests: L{DigestCache} or C{None}
+        @param digests: optional cache to take already known hashes from
+
         @raise InvalidHashException: hash mismatch
         """
         path = os.path.join(directory, self.filename)
 
         try:
-            with open(path) as fh:
-                size = os.fstat(fh.fileno()).st_size
-                hashes = apt_pkg.Hashes(fh)
+            if digests is not None:
+                size, md5sum, sha1sum, sha256sum = digests.hash(path)
+            else:
+                with open(path) as fh:
+                    size = os.fstat(fh.fileno()).st_size
+                    hashes = apt_pkg.Hashes(fh)
+                md5sum, sha1sum, sha256sum = hashes.md5, hashes.sha1, hashes.sha256
         except IOError as e:
             if e.errno == errno.ENOENT:
                 raise FileDoesNotExist(self.filename)
@@ -160,14 +245,14 @@ class HashedFile(object):
         if size != self.size:
             raise InvalidHashException(self.filename, 'size', self.size, size)
 
-        if hashes.md5 != self.md5sum:
-            raise InvalidHashException(self.filename, 'md5sum', self.md5sum, hashes.md5)
+        if md5sum != self.md5sum:
+            raise InvalidHashException(self.filename, 'md5sum', self.md5sum, md5sum)
 
-        if hashes.sha1 != self.sha1sum:
-            raise InvalidHashException(self.filename, 'sha1sum', self.sha1sum, hashes.sha1)
+        if sha1sum != self.sha1sum:
+            raise InvalidHashException(self.filename, 'sha1sum', self.sha1sum, sha1sum)
 
-        if hashes.sha256 != self.sha256sum:
-            raise InvalidHashException(self.filename, 'sha256sum', self.sha256sum, hashes.sha256)
+        if sha256sum != self.sha256sum:
+            raise InvalidHashException(self.filename, 'sha256sum', self.sha256sum, sha256sum)
 
 def parse_file_list(control, has_priority_and_section):
     """Parse Files and Checksums-* fields
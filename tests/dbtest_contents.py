@@ -4,13 +4,64 @@ from db_test import DBDakTestCase, fixture
 
 from daklib.dbconn import *
 from daklib.contents import BinaryContentsWriter, BinaryContentsScanner, \
-    UnpackedSource, SourceContentsScanner, SourceContentsWriter
+    UnpackedSource, SourceContentsScanner, SourceContentsWriter, merge_contents
+from daklib.srccontents import SourceFileList
 
 from os.path import normpath
+from shutil import rmtree
 from sqlalchemy.exc import FlushError, IntegrityError
-from subprocess import CalledProcessError
+from subprocess import CalledProcessError, check_call
+from tempfile import mkdtemp
+import os
+import tarfile
 import unittest
 
+def build_source(directory, version, format):
+    '''
+    Builds the source package foo in directory with dpkg-source and
+    returns the name of its .dsc file. Non-native versions get an orig
+    tarball without the debian directory, 1.0 adds a file in its diff and
+    3.0 (quilt) gets a patch.
+    '''
+    upstream = version.split('-')[0]
+    tree = os.path.join(directory, 'foo-' + upstream)
+    files = {
+        'README': 'hello\n',
+        'src/main.c': 'int main() { return 0; }\n',
+        'debian/changelog': 'foo (%s) unstable; urgency=low\n\n  * Test.\n\n'
+            ' -- A B <a@example.com>  Mon, 01 Jan 2001 00:00:00 +0000\n' % (version),
+        'debian/control': 'Source: foo\nMaintainer: A B <a@example.com>\n\n'
+            'Package: foo\nArchitecture: all\nDescription: test\n test\n',
+        'debian/rules': '',
+        'debian/source/format': format + '\n',
+    }
+    for name, data in files.items():
+        path = os.path.join(tree, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(data)
+    if '-' in version:
+        tar = tarfile.open(os.path.join(directory, 'foo_%s.orig.tar.gz' % (upstream)), 'w:gz')
+        tar.add(os.path.join(tree, 'README'), 'foo-%s/README' % (upstream))
+        tar.add(os.path.join(tree, 'src'), 'foo-%s/src' % (upstream))
+        tar.close()
+    if format == '1.0':
+        # changes outside debian/ end up in the .diff.gz
+        with open(os.path.join(tree, 'src', 'new.c'), 'w') as fh:
+            fh.write('new\n')
+    if format == '3.0 (quilt)':
+        os.makedirs(os.path.join(tree, 'debian', 'patches'))
+        with open(os.path.join(tree, 'debian', 'patches', 'series'), 'w') as fh:
+            fh.write('add.patch\n')
+        with open(os.path.join(tree, 'debian', 'patches', 'add.patch'), 'w') as fh:
+            fh.write('--- /dev/null\n+++ b/added/file.txt\n@@ -0,0 +1 @@\n+added\n')
+    with open(os.devnull, 'w') as devnull:
+        check_call(['dpkg-source', '-b', os.path.basename(tree)], cwd = directory,
+                   stdout = devnull, stderr = devnull)
+    rmtree(tree)
+    return os.path.join(directory, 'foo_%s.dsc' % (version))
+
 class ContentsTestCase(DBDakTestCase):
     """
     This TestCase checks the behaviour of contents generation.
@@ -156,6 +207,59 @@ class ContentsTestCase(DBDakTestCase):
         self.session.delete(self.binary['hello_2.2-1_i386'])
         self.session.commit()
 
+    def test_binarycontentswriter_incremental(self):
+        '''
+        Test the incremental mode of the BinaryContentsWriter class.
+        '''
+        self.setup_suites()
+        self.setup_architectures()
+        self.setup_overridetypes()
+        self.setup_binaries()
+        self.setup_overrides()
+        self.binary['hello_2.2-1_i386'].contents.append(BinContents(file = '/usr/bin/hello'))
+        self.session.commit()
+        cw = BinaryContentsWriter(self.suite['squeeze'], self.arch['i386'], \
+            self.otype['deb'], self.comp['main'], incremental = True)
+        expected = ['/usr/bin/hello                                          python/hello\n']
+        self.assertEqual(expected, cw.get_list())
+        # nothing changed, the cached lines are returned
+        self.assertEqual(expected, cw.get_list())
+        # the binary leaves the suite
+        self.binary['hello_2.2-1_i386'].suites.remove(self.suite['squeeze'])
+        self.session.commit()
+        self.assertEqual([], cw.get_list())
+
+    def test_binarycontentswriter_incremental_late_scan(self):
+        '''
+        Tests that a binary scanned after an incremental run is picked up.
+        '''
+        self.setup_suites()
+        self.setup_architectures()
+        self.setup_overridetypes()
+        self.setup_binaries()
+        self.setup_overrides()
+        cw = BinaryContentsWriter(self.suite['squeeze'], self.arch['i386'], \
+            self.otype['deb'], self.comp['main'], incremental = True)
+        # the binary is in the suite, but its contents are not scanned yet
+        self.assertEqual([], cw.get_list())
+        self.binary['hello_2.2-1_i386'].contents.append(BinContents(file = '/usr/bin/hello'))
+        self.session.commit()
+        self.assertEqual(['/usr/bin/hello                                          python/hello\n'],
+            cw.get_list())
+
+    def test_merge_contents(self):
+        '''
+        Tests merging the arch:all lines into an architecture's lines.
+        '''
+        arch_rows = [('usr/bin/a', 'utils/a'), ('usr/bin/c', 'net/c')]
+        all_rows = [('usr/bin/a', 'doc/a-doc,doc/z'), ('usr/bin/b', 'contrib/misc/a,doc/w')]
+        # the arch:all version of package a is shadowed by a newer one for
+        # the architecture
+        self.assertEqual([('usr/bin/a', 'utils/a,doc/a-doc,doc/z'),
+                          ('usr/bin/b', 'doc/w'),
+                          ('usr/bin/c', 'net/c')],
+            list(merge_contents(arch_rows, all_rows, set(['a']))))
+
     def test_binary_scan_contents(self):
         '''
         Tests the BinaryContentsScanner.
@@ -195,6 +299,27 @@ class ContentsTestCase(DBDakTestCase):
         SourceContentsScanner(source.source_id).scan()
         self.assertTrue(source.contents.count() > 0)
 
+    def test_source_file_list(self):
+        '''
+        Tests that SourceFileList lists the same files dpkg-source unpacks.
+        '''
+        directory = mkdtemp()
+        try:
+            dscfilenames = [fixture('ftp/pool/main/h/hello/hello_2.2-1.dsc')]
+            for version, format in (('1.0-1', '1.0'), ('2.0-1', '3.0 (quilt)'),
+                                    ('3', '3.0 (native)')):
+                subdirectory = os.path.join(directory, version)
+                os.mkdir(subdirectory)
+                dscfilenames.append(build_source(subdirectory, version, format))
+            for dscfilename in dscfilenames:
+                unpacked = UnpackedSource(dscfilename)
+                self.assertEqual(set(unpacked.get_all_filenames()),
+                    set(SourceFileList.from_dsc(dscfilename).get_all_filenames()),
+                    dscfilename)
+                unpacked.cleanup()
+        finally:
+            rmtree(directory)
+
     def test_sourcecontentswriter(self):
         '''
         Test the SourceContentsWriter class.
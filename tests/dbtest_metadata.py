@@ -2,7 +2,8 @@
 
 from db_test import DBDakTestCase
 
-from daklib.dbconn import DBConn, MetadataKey, BinaryMetadata, SourceMetadata
+from daklib.dbconn import DBConn, MetadataKey, BinaryMetadata, SourceMetadata, \
+    get_metadata
 
 import unittest
 
@@ -76,6 +77,25 @@ class MetadataTestCase(DBDakTestCase):
         self.assertEqual('http://debian.org', self.src_hello.metadata[self.homepage])
         self.assertTrue(self.depends not in self.src_hello.metadata)
 
+    def test_bulk(self):
+        '''
+        Tests get_metadata() and the MetadataProxy.
+        '''
+        self.setup_metadata()
+        bin_id = self.bin_hello.binary_id
+        self.assertEqual({ bin_id: { 'Depends': 'foobar (>= 1.0)', 'Recommends': 'goodbye' } },
+            get_metadata([bin_id], session=self.session))
+        self.assertEqual({ bin_id: { 'Recommends': 'goodbye' } },
+            get_metadata([bin_id], ['Recommends', 'Essential'], session=self.session))
+        self.assertEqual({}, get_metadata([bin_id], ['Essential'], session=self.session))
+        src_id = self.src_hello.source_id
+        self.assertEqual({ src_id: { 'Homepage': 'http://debian.org' } },
+            get_metadata([src_id], ['Homepage'], source=True, session=self.session))
+        # proxies
+        self.assertEqual('goodbye', self.bin_hello.proxy['Recommends'])
+        self.assertTrue('Essential' not in self.bin_hello.proxy)
+        self.assertEqual('foobar-dev', self.src_hello.proxy.get('Build-Depends'))
+
     def test_delete(self):
         '''
         Tests the delete / cascading behaviour.
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+from daklib.checksumcache import ChecksumCache, stat_identity
+
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import os
+import unittest
+
+class ChecksumCacheTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'Packages')
+        with open(self.path, 'w') as fh:
+            fh.write('Package: hello\n')
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_stat_identity(self):
+        os.utime(self.path, (0, 1234567890.123456))
+        inode, size, mtime = stat_identity(self.path)
+        self.assertEqual(15, size)
+        # integer microseconds compare exactly after a database round trip
+        self.assertTrue(isinstance(mtime, (int, long)))
+        self.assertTrue(abs(mtime - 1234567890123456) <= 1)
+        self.assertEqual(None, stat_identity(self.path + '.gz'))
+
+    def test_lookup(self):
+        cache = ChecksumCache(None)
+        checksums = {'MD5Sum': 'md5', 'SHA1': 'sha1', 'SHA256': 'sha256'}
+        self.assertEqual(None, cache.lookup(self.path))
+        cache.store(self.path, 15, checksums)
+        self.assertEqual((15, checksums), cache.lookup(self.path))
+        # the entry is invalid once the file changes
+        with open(self.path, 'a') as fh:
+            fh.write('Version: 1\n')
+        self.assertEqual(None, cache.lookup(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
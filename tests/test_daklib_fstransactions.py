@@ -88,6 +88,20 @@ class FilesystemTransactionTestCase(DakTestCase):
             self.assert_(os.path.exists(t.filename('a')))
             self.assert_(not os.path.exists(t.filename('b')))
 
+    def test_copy_function(self):
+        with TemporaryDirectory() as t:
+            self._write_to_a(t)
+            copied = []
+            def copy_function(source, destination):
+                copied.append((source, destination))
+                shutil.copy2(source, destination)
+
+            with FilesystemTransaction() as fs:
+                self._copy_a_b(t, fs, copy_function=copy_function)
+
+            self.assertEqual([(t.filename('a'), t.filename('b'))], copied)
+            self.assert_(os.path.exists(t.filename('b')))
+
     def test_unlink_and_commit(self):
         with TemporaryDirectory() as t:
             self._write_to_a(t)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase, fixture
+
+from daklib.debtar import data_members, DebFormatError, DecompressFile
+
+from cStringIO import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import os
+import subprocess
+import tarfile
+import unittest
+
+def ar_member(name, data):
+    header = '%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (name, 0, 0, 0, '100644', len(data))
+    if len(data) % 2:
+        data += '\n'
+    return header + data
+
+class CopyDecompressor(object):
+    '''
+    Decompressor returning its input twice, without an output limit.
+    '''
+    def decompress(self, data):
+        return data + data
+
+class BoundedCopyDecompressor(object):
+    '''
+    Decompressor returning its input twice, with the output limit of
+    LZMADecompressor in Python 3.5.
+    '''
+    def __init__(self):
+        self.pending = ''
+        self.needs_input = True
+        self.eof = False
+        self.limits = []
+
+    def decompress(self, data, max_length=-1):
+        self.limits.append(max_length)
+        self.pending += data + data
+        if max_length < 0:
+            max_length = len(self.pending)
+        data, self.pending = self.pending[:max_length], self.pending[max_length:]
+        self.needs_input = not self.pending
+        return data
+
+class DebTarTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def make_deb(self, compression):
+        buf = StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w')
+        for name in ('./usr/', './usr/bin/', './usr/bin/odd', './usr/share/f\xf6\xf6'):
+            info = tarfile.TarInfo(name)
+            if name.endswith('/'):
+                info.type = tarfile.DIRTYPE
+            else:
+                info.size = 3
+            tar.addfile(info, StringIO('abc'))
+        tar.close()
+        data = buf.getvalue()
+        if compression:
+            process = subprocess.Popen([compression, '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            data = process.communicate(data)[0]
+        suffix = {None: '', 'gzip': '.gz', 'bzip2': '.bz2', 'xz': '.xz'}[compression]
+        filename = os.path.join(self.directory, 'test.deb')
+        with open(filename, 'w') as fh:
+            fh.write('!<arch>\n')
+            fh.write(ar_member('debian-binary', '2.0\n'))
+            fh.write(ar_member('control.tar.gz', 'not read'))
+            fh.write(ar_member('data.tar' + suffix, data))
+        return filename
+
+    def test_fixture(self):
+        deb = fixture('ftp/pool/main/h/hello/hello_2.2-1_i386.deb')
+        names = [m.name for m in data_members(deb) if not m.isdir()]
+        self.assertEqual(['./usr/bin/hello', './usr/share/doc/hello/copyright'], names)
+
+    def test_compressions(self):
+        for compression in (None, 'gzip', 'bzip2', 'xz'):
+            deb = self.make_deb(compression)
+            names = [m.name for m in data_members(deb)]
+            self.assertEqual(['./usr', './usr/bin', './usr/bin/odd', './usr/share/f\xf6\xf6'], names)
+
+    def test_decompress_file(self):
+        data = ''.join([chr(i % 251) for i in range(100000)])
+        for decompressor in (CopyDecompressor(), BoundedCopyDecompressor()):
+            fh = DecompressFile(StringIO(data), decompressor, chunk_size=1000)
+            pieces = []
+            for size in (1, 512, 10240, 3, 0, 70000):
+                pieces.append(fh.read(size))
+                self.assertEqual(size, len(pieces[-1]))
+            pieces.append(fh.read())
+            self.assertEqual('', fh.read(512))
+            self.assertEqual(''.join([data[i:i + 1000] * 2 for i in range(0, len(data), 1000)]),
+                             ''.join(pieces))
+        self.assertEqual(set([1000]), set(decompressor.limits))
+
+    def test_not_a_deb(self):
+        filename = os.path.join(self.directory, 'junk.deb')
+        with open(filename, 'w') as fh:
+            fh.write('junk')
+        self.assertRaises(DebFormatError, lambda: list(data_members(filename)))
+
+if __name__ == '__main__':
+    unittest.main()
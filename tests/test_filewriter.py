@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+from daklib.filewriter import BaseFileWriter, ChecksumFile
+
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import bz2
+import gzip
+import hashlib
+import os
+import subprocess
+import unittest
+
+class FileWriterTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.data = ''.join(['line %d\n' % i for i in range(100000)])
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def write(self, compression):
+        writer = BaseFileWriter(os.path.join(self.directory, '%(name)s'),
+            name='Packages', compression=compression, xz_threads=1,
+            record_checksums=False)
+        output = writer.open()
+        output.write(self.data[:1000])
+        output.write(self.data[1000:])
+        writer.close()
+        return os.path.join(self.directory, 'Packages')
+
+    def test_compressed(self):
+        path = self.write(['gzip', 'bzip2', 'xz'])
+        self.assertEqual(self.data, gzip.open(path + '.gz').read())
+        self.assertEqual(self.data, bz2.BZ2File(path + '.bz2').read())
+        self.assertEqual(self.data, subprocess.check_output(['xz', '-dc', path + '.xz']))
+        # no uncompressed file or leftovers
+        self.assertEqual(['Packages.bz2', 'Packages.gz', 'Packages.xz'],
+                         sorted(os.listdir(self.directory)))
+
+    def test_uncompressed(self):
+        path = self.write(['none', 'gzip'])
+        with open(path) as fh:
+            self.assertEqual(self.data, fh.read())
+        self.assertEqual(self.data, gzip.open(path + '.gz').read())
+
+    def broken_writer(self, commands):
+        writer = BaseFileWriter(os.path.join(self.directory, '%(name)s'),
+            name='Packages', compression=['none'], record_checksums=True)
+        writer.commands = lambda: commands
+        return writer
+
+    def test_compressor_dies(self):
+        writer = self.broken_writer([(['gzip', '-9cn'], 'gz'), (['false'], 'xz')])
+        output = writer.open()
+        with self.assertRaises(IOError):
+            output.write(self.data)
+            output.write(self.data)
+        self.assertTrue(all(f.closed for f in writer.outputs if isinstance(f, file)))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_open_fails(self):
+        writer = self.broken_writer([(['gzip', '-9cn'], 'gz'), (['/nonexistent/xz'], 'xz')])
+        self.assertRaises(OSError, writer.open)
+        self.assertTrue(all(f.closed for f in writer.outputs))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_checksums(self):
+        checksum_file = ChecksumFile()
+        checksum_file.write(self.data[:10])
+        checksum_file.write(self.data[10:])
+        self.assertEqual(len(self.data), checksum_file.size)
+        checksums = checksum_file.checksums()
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), checksums['MD5Sum'])
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(), checksums['SHA256'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,6 +22,12 @@ def test_function(num, num2):
 
     return (PROC_STATUS_SUCCESS, 'blah, %d, %d' % (num, num2))
 
+def sleep_function(seconds, num):
+    from time import sleep
+
+    sleep(seconds)
+    return (PROC_STATUS_SUCCESS, num)
+
 class DakProcessPoolTestCase(DakTestCase):
     def testPool(self):
         def alarm_handler(signum, frame):
@@ -59,3 +65,75 @@ class DakProcessPoolTestCase(DakTestCase):
 
         for r in range(len(p.results)):
             self.assertEqual(p.results[r], expected[r])
+
+    def testImapBounded(self):
+        p = DakProcessPool()
+        args = [(s, j) for s in (0, 2) for j in range(3)]
+        results = list(p.imap_bounded(test_function, iter(args), 2))
+        p.close()
+        p.join()
+
+        expected = [(PROC_STATUS_SUCCESS,      'blah, 0, 0'),
+                    (PROC_STATUS_MISCFAILURE,  'Test custom error return'),
+                    (PROC_STATUS_SUCCESS,      'blah, 0, 2'),
+                    (PROC_STATUS_SUCCESS,      'blah, 2, 0'),
+                    (PROC_STATUS_SUCCESS,      'blah, 2, 1'),
+                    (PROC_STATUS_SUCCESS,      'blah, 2, 2')]
+
+        self.assertEqual(results, expected)
+        # results handed out by imap_bounded are not kept
+        self.assertEqual(p.results, [])
+
+    def testImapBoundedUnordered(self):
+        # the slow first task does not hold up the others
+        p = DakProcessPool(processes=2)
+        args = [(1, 0)] + [(0, n) for n in range(1, 5)]
+        results = list(p.imap_bounded(sleep_function, iter(args), 2, ordered=False))
+        p.close()
+        p.join()
+
+        self.assertEqual([(PROC_STATUS_SUCCESS, n) for n in range(5)], sorted(results))
+        self.assertEqual((PROC_STATUS_SUCCESS, 0), results[-1])
+
+    def testMaxConnections(self):
+        # every worker gets two connections
+        p = DakProcessPool(processes=4, max_connections=4)
+        results = list(p.imap_bounded(test_function, [(0, 0), (2, 2)], 2))
+        p.close()
+        p.join()
+
+        self.assertEqual(2, len(p._pool))
+        self.assertEqual([(PROC_STATUS_SUCCESS, 'blah, 0, 0'),
+                          (PROC_STATUS_SUCCESS, 'blah, 2, 2')], results)
+
+    def testLargestFirst(self):
+        # a single worker runs the jobs in the order they are queued
+        p = DakProcessPool(processes=1)
+        order = []
+        jobs = [(cost, test_function, (2, cost)) for cost in (0, 2, 1)]
+        results = p.apply_largest_first(jobs, callback=order.append)
+        p.close()
+        p.join()
+
+        self.assertEqual([(PROC_STATUS_SUCCESS, 'blah, 2, %d' % cost) for cost in (0, 2, 1)],
+                         [r.get() for r in results])
+        self.assertEqual([(PROC_STATUS_SUCCESS, 'blah, 2, %d' % cost) for cost in (2, 1, 0)],
+                         order)
+
+    def testLargestFirstFollowUp(self):
+        # a job's own callback queues follow-up jobs
+        p = DakProcessPool(processes=2)
+        done = []
+        def queue_more(result):
+            done.append(result)
+            p.apply_largest_first([(n, test_function, (2, n)) for n in (0, 1)], callback=done.append)
+        results = p.apply_largest_first([(5, test_function, (0, 0), queue_more),
+                                         (1, test_function, (2, 2))], callback=done.append)
+        for result in results:
+            result.wait()
+        p.close()
+        p.join()
+
+        self.assertEqual(sorted([(PROC_STATUS_SUCCESS, 'blah, 0, 0')] +
+                                [(PROC_STATUS_SUCCESS, 'blah, 2, %d' % n) for n in (0, 1, 2)]),
+                         sorted(done))
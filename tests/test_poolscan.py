@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+from daklib.poolscan import sorted_files, merge_join, future_timestamps
+
+from cStringIO import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import os
+import tarfile
+import unittest
+
+def ar_member(name, data):
+    header = '%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (name, 0, 0, 0, '100644', len(data))
+    if len(data) % 2:
+        data += '\n'
+    return header + data
+
+def make_tar(members):
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w:gz')
+    for name, mtime in members:
+        info = tarfile.TarInfo(name)
+        info.mtime = mtime
+        tar.addfile(info, StringIO(''))
+    tar.close()
+    return buf.getvalue()
+
+class PoolScanTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def touch(self, path):
+        path = os.path.join(self.directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    def test_sorted_files(self):
+        paths = ['main/a/a/a_1.dsc', 'main/a/a-b/a-b_1.dsc', 'main/a/a0/a0_1.dsc',
+                 'main/a/a.b', 'main/b/b/b_1.deb', 'contrib/c/c/c_1.deb']
+        for path in paths:
+            self.touch(path)
+        os.symlink('a', os.path.join(self.directory, 'main/a/link-dir'))
+        os.symlink('a.b', os.path.join(self.directory, 'main/a/link-file'))
+        expected = sorted(paths + ['main/a/link-file'])
+        self.assertEqual(expected, list(sorted_files(self.directory)))
+
+    def test_merge_join(self):
+        expected = [('a', 1), ('c', 2), ('d', 3)]
+        found = [('b', ), ('c', ), ('e', )]
+        self.assertEqual([
+            ('a', ('a', 1), None),
+            ('b', None, ('b', )),
+            ('c', ('c', 2), ('c', )),
+            ('d', ('d', 3), None),
+            ('e', None, ('e', )),
+            ], list(merge_join(expected, found)))
+        self.assertEqual([], list(merge_join([], [])))
+
+    def test_future_timestamps(self):
+        filename = os.path.join(self.directory, 'test.deb')
+        with open(filename, 'w') as fh:
+            fh.write('!<arch>\n')
+            fh.write(ar_member('debian-binary', '2.0\n'))
+            fh.write(ar_member('control.tar.gz', make_tar([('./control', 2000)])))
+            fh.write(ar_member('data.tar.gz', make_tar([('./usr/a', 1000), ('./usr/b', 3000)])))
+        self.assertEqual([('control.tar.gz', './control', 2000), ('data.tar.gz', './usr/b', 3000)],
+                         future_timestamps(filename, 1500))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+from daklib.poolverify import RateLimiter, hash_file, verify_files, \
+    shard_of, parse_shard, Checkpoint
+
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import hashlib
+import os
+import unittest
+
+class PoolVerifyTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'file')
+        with open(self.path, 'w') as fh:
+            fh.write('hello world\n' * 1000)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_hash_file(self):
+        data = 'hello world\n' * 1000
+        self.assertEqual((len(data), hashlib.md5(data).hexdigest(),
+            hashlib.sha1(data).hexdigest(), hashlib.sha256(data).hexdigest()),
+            hash_file(self.path, chunk_size=100))
+
+    def test_verify_files(self):
+        size, md5, sha1, sha256 = hash_file(self.path)
+        missing = os.path.join(self.directory, 'missing')
+        done, problems, total = verify_files([
+            (1, self.path, size, md5, sha1, sha256),
+            (2, self.path, size, md5, 'bad', sha256),
+            (3, missing, 1, md5, sha1, sha256)])
+        self.assertEqual([1, 2, 3], done)
+        self.assertEqual(2 * size, total)
+        self.assertEqual(2, len(problems))
+        self.assertTrue('sha1sum mismatch' in problems[0])
+        self.assertTrue(missing in problems[1])
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        limiter = RateLimiter(100, clock=lambda: now[0], sleep=sleep)
+        limiter.consume(100)
+        self.assertEqual([], sleeps)
+        limiter.consume(50)
+        self.assertEqual([0.5], sleeps)
+        now[0] += 10
+        limiter.consume(100)
+        self.assertEqual([0.5], sleeps)
+        # no limit
+        RateLimiter(0, sleep=sleep).consume(10 ** 9)
+        self.assertEqual([0.5], sleeps)
+
+    def test_shards(self):
+        self.assertEqual((1, 4), parse_shard('1/4'))
+        self.assertRaises(ValueError, parse_shard, '4/4')
+        self.assertRaises(ValueError, parse_shard, 'x')
+        self.assertEqual(shard_of('h/hello/hello_1.dsc', 7),
+                         shard_of('h/hello/hello_2.dsc', 7))
+
+    def test_checkpoint(self):
+        filename = os.path.join(self.directory, 'checkpoint')
+        checkpoint = Checkpoint(filename)
+        self.assertEqual(set(), checkpoint.load())
+        checkpoint.record([1, 2])
+        checkpoint.record([5])
+        # an incomplete last line is ignored
+        with open(filename, 'a') as fh:
+            fh.write('7')
+        self.assertEqual(set([1, 2, 5]), Checkpoint(filename).load())
+        resumed = Checkpoint(filename)
+        resumed.record([8])
+        self.assertEqual(set([1, 2, 5, 8]), resumed.load())
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(filename))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+from daklib.archive import ArchiveUpload
+from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS, PROC_STATUS_EXCEPTION
+import daklib.checks as checks
+import dak.process_upload as process_upload
+
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import hashlib
+import os
+import unittest
+
+all_checks = (
+    checks.SignatureAndHashesCheck,
+    checks.SignatureTimestampCheck,
+    checks.ChangesCheck,
+    checks.ExternalHashesCheck,
+    checks.SourceCheck,
+    checks.BinaryCheck,
+    checks.BinaryTimestampCheck,
+    checks.SingleDistributionCheck,
+    checks.TransitionCheck,
+    checks.ACLCheck,
+    checks.NoSourceOnlyCheck,
+    checks.LintianCheck,
+    checks.SourceFormatCheck,
+    checks.SuiteArchitectureCheck,
+    checks.VersionCheck,
+    )
+
+class FakeChanges(object):
+    def __init__(self, directory, filename, keyrings=None):
+        self.directory = directory
+        self.filename = filename
+        self.path = os.path.join(directory, filename)
+        self.valid_signature = True
+        with open(self.path) as fh:
+            self.sha1 = hashlib.sha1(fh.read()).hexdigest()
+
+    def contents_sha1(self):
+        return self.sha1
+
+class SignedChanges(object):
+    valid_signature = True
+
+class StubbedChecksTestCase(DakTestCase):
+    '''
+    Replaces check and per_suite_check of all checks by stubs recording
+    their calls in self.calls.
+    '''
+    def setUp(self):
+        self.calls = []
+        self.failing = set()
+        self.originals = []
+        for cls in all_checks:
+            for method in ('check', 'per_suite_check'):
+                self.originals.append((cls, method, cls.__dict__.get(method)))
+                setattr(cls, method, self.stub(cls, method))
+
+    def tearDown(self):
+        for cls, method, original in reversed(self.originals):
+            if original is None:
+                delattr(cls, method)
+            else:
+                setattr(cls, method, original)
+
+    def stub(self, cls, method):
+        def run(chk, upload, *args):
+            self.calls.append((cls, method) + args)
+            if cls in self.failing:
+                raise checks.Reject('{0} failed'.format(cls.__name__))
+        return run
+
+    def upload(self):
+        upload = ArchiveUpload.__new__(ArchiveUpload)
+        upload.changes = SignedChanges()
+        upload.reject_reasons = []
+        upload.warnings = []
+        upload._final_suites = lambda: ['unstable', 'experimental']
+        return upload
+
+    def called(self, method='check'):
+        return [c[0] for c in self.calls if c[1] == method]
+
+class ArchiveUploadCheckTestCase(StubbedChecksTestCase):
+    def test_full_check(self):
+        self.assertTrue(self.upload().check())
+        for chk in ArchiveUpload.content_checks:
+            self.assertIn(chk, self.called())
+
+    def test_prechecked(self):
+        self.assertTrue(self.upload().check())
+        full = self.called()
+        self.calls = []
+        self.assertTrue(self.upload().check(prechecked=True))
+        # exactly the content checks are skipped
+        self.assertEqual([chk for chk in full if chk not in ArchiveUpload.content_checks],
+                         self.called())
+        self.assertIn(checks.SignatureAndHashesCheck, self.called())
+        # per-suite checks still run for every suite
+        self.assertEqual([
+            (checks.ACLCheck, 'per_suite_check', 'unstable'),
+            (checks.ACLCheck, 'per_suite_check', 'experimental'),
+            (checks.SourceFormatCheck, 'per_suite_check', 'unstable'),
+            (checks.SourceFormatCheck, 'per_suite_check', 'experimental'),
+            (checks.SuiteArchitectureCheck, 'per_suite_check', 'unstable'),
+            (checks.SuiteArchitectureCheck, 'per_suite_check', 'experimental'),
+            (checks.VersionCheck, 'per_suite_check', 'unstable'),
+            (checks.VersionCheck, 'per_suite_check', 'experimental'),
+            ], [c for c in self.calls if c[1] == 'per_suite_check'])
+
+    def test_prechecked_hashes_fail(self):
+        self.failing.add(checks.SignatureAndHashesCheck)
+        upload = self.upload()
+        self.assertFalse(upload.check(prechecked=True))
+        self.assertEqual(['SignatureAndHashesCheck failed'], upload.reject_reasons)
+
+    def test_precheck(self):
+        self.assertTrue(self.upload().precheck())
+        self.assertEqual([checks.SignatureAndHashesCheck] + list(ArchiveUpload.content_checks),
+                         self.called())
+        self.assertEqual([], self.called('per_suite_check'))
+
+    def test_precheck_fails(self):
+        self.failing.add(checks.LintianCheck)
+        upload = self.upload()
+        self.assertFalse(upload.precheck())
+        self.assertEqual(['LintianCheck failed'], upload.reject_reasons)
+
+class FakeArchiveUpload(object):
+    result = True
+
+    def __init__(self, directory, changes, keyrings):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def precheck(self):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+class FakePool(object):
+    '''
+    Runs the jobs in this process, optionally as if some of them raised.
+    '''
+    failing = set()
+
+    def __init__(self, processes):
+        pass
+
+    def imap_bounded(self, func, argslist, max_pending):
+        for args in argslist:
+            if args[1] in self.failing:
+                yield (PROC_STATUS_EXCEPTION, 'worker died')
+            else:
+                yield func(*args)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+class PrecheckItTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.warnings = []
+        # dak/daklib is a symlink, so process_upload has modules of its own
+        self.saved = [(process_upload.daklib.upload, 'Changes', FakeChanges),
+                      (process_upload.daklib.archive, 'ArchiveUpload', FakeArchiveUpload),
+                      (process_upload.utils, 'warn', self.warnings.append),
+                      (process_upload, 'DakProcessPool', FakePool)]
+        for i, (module, name, value) in enumerate(self.saved):
+            self.saved[i] = (module, name, getattr(module, name))
+            setattr(module, name, value)
+        FakeArchiveUpload.result = True
+        FakePool.failing = set()
+        self.changes = []
+        for name in ('a_1_source.changes', 'b_1_source.changes', 'c_1_source.changes'):
+            with open(os.path.join(self.directory, name), 'w') as fh:
+                fh.write(name)
+            self.changes.append([self.directory, FakeChanges(self.directory, name)])
+
+    def tearDown(self):
+        for module, name, value in self.saved:
+            setattr(module, name, value)
+        rmtree(self.directory)
+
+    def precheck(self, name, sha1=None):
+        if sha1 is None:
+            sha1 = hashlib.sha1(name).hexdigest()
+        return process_upload.precheck_it(self.directory, name, [], sha1)
+
+    def test_passed(self):
+        self.assertEqual((PROC_STATUS_SUCCESS, True), self.precheck('a_1_source.changes'))
+
+    def test_failed(self):
+        FakeArchiveUpload.result = False
+        self.assertEqual((PROC_STATUS_SUCCESS, False), self.precheck('a_1_source.changes'))
+
+    def test_changes_modified(self):
+        self.assertEqual((PROC_STATUS_SUCCESS, False), self.precheck('a_1_source.changes', 'x' * 40))
+
+    def test_exception_warns(self):
+        FakeArchiveUpload.result = RuntimeError('no database')
+        self.assertEqual((PROC_STATUS_SUCCESS, False), self.precheck('a_1_source.changes'))
+        self.assertEqual(1, len(self.warnings))
+        self.assertIn('no database', self.warnings[0])
+
+    def prechecked(self, jobs):
+        return [(c.filename, prechecked) for directory, c, prechecked
+                in process_upload.prechecked_uploads(self.changes, [], jobs)]
+
+    def test_serial(self):
+        self.assertEqual([('a_1_source.changes', False), ('b_1_source.changes', False),
+                          ('c_1_source.changes', False)], self.prechecked(1))
+
+    def test_parallel(self):
+        FakePool.failing = set(['b_1_source.changes'])
+        # c was modified after the main process loaded it
+        with open(os.path.join(self.directory, 'c_1_source.changes'), 'a') as fh:
+            fh.write('modified')
+        self.assertEqual([('a_1_source.changes', True), ('b_1_source.changes', False),
+                          ('c_1_source.changes', False)], self.prechecked(2))
+        # the worker failure is reported
+        self.assertEqual(1, len(self.warnings))
+
+if __name__ == '__main__':
+    unittest.main()
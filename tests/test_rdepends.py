@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+from daklib.rdepends import ArchitectureDependencies
+
+import unittest
+
+class ArchitectureDependenciesTestCase(DakTestCase):
+    def setUp(self):
+        self.deps = ArchitectureDependencies()
+        self.deps.add('app', 'app-src', 'main', 'libfoo1, mta | postfix', None)
+        self.deps.add('tool', 'tool-src', 'contrib', 'libfoo1 (>= 1.0) | libbar1', None)
+        self.deps.add('libfoo1', 'foo', 'main', None, None)
+        self.deps.add('exim4', 'exim4', 'main', None, 'mta, exim4')
+        self.deps.add('sendmail', 'sendmail', 'main', None, 'mta')
+
+    def test_broken(self):
+        self.assertEqual(['app'], list(self.deps.broken(set(['libfoo1']))))
+        self.assertEqual([], list(self.deps.broken(set(['libbar1']))))
+        self.assertEqual(['tool'], sorted(self.deps.broken(set(['libfoo1', 'libbar1', 'app']))))
+        self.assertEqual([], list(self.deps.broken(set(['unrelated']))))
+
+    def test_virtuals(self):
+        self.assertEqual([], self.deps.removed_virtuals(set(['exim4'])))
+        self.assertEqual(['mta'], self.deps.removed_virtuals(set(['exim4', 'sendmail'])))
+        # mta is only gone with all its providers
+        self.assertEqual([], list(self.deps.broken(set(['exim4', 'postfix']))))
+        self.assertEqual(['app'], list(self.deps.broken(set(['mta', 'postfix']))))
+
+if __name__ == '__main__':
+    unittest.main()
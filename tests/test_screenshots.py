@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+from daklib.screenshots import MediaCache, ScreenshotFetcher
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import os
+import threading
+import time
+import unittest
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    Serves /image with an ETag, and /slow after a delay.
+    '''
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append((self.path, self.headers.getheader('If-None-Match')))
+        if self.path == '/slow':
+            time.sleep(2)
+        if self.headers.getheader('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write('image data for %s' % self.path)
+
+    def log_message(self, *args):
+        pass
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ScreenshotsTestCase(DakTestCase):
+    def setUp(self):
+        Handler.requests = []
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.directory)
+
+    def test_cache(self):
+        cache = MediaCache(self.directory, max_age=0)
+        url = self.base + '/image'
+        directory, meta, changed = cache.fetch(url)
+        self.assertTrue(changed)
+        self.assertEqual('"v1"', meta['etag'])
+        with open(os.path.join(directory, 'source')) as fh:
+            self.assertEqual('image data for /image', fh.read())
+        # revalidated with the ETag, not downloaded again
+        directory, meta, changed = cache.fetch(url)
+        self.assertFalse(changed)
+        self.assertEqual(('/image', '"v1"'), Handler.requests[-1])
+        # fresh entries are not even revalidated
+        cache.max_age = 3600
+        cache.fetch(url)
+        self.assertEqual(2, len(Handler.requests))
+
+    def test_fetcher(self):
+        cache = MediaCache(self.directory)
+        fetcher = ScreenshotFetcher(cache, [], threads=4, per_host=1, timeout=10)
+        results = {}
+        def callback(url, result, error):
+            results.setdefault(url, []).append((result, error))
+        for path in ('/image', '/image', '/missing'):
+            fetcher.submit(self.base + path, callback)
+        fetcher.wait()
+        fetcher.close()
+
+        # the same URL is only fetched once
+        self.assertEqual(1, len([r for r in Handler.requests if r[0] == '/image']))
+        self.assertEqual(2, len(results[self.base + '/image']))
+        result, error = results[self.base + '/image'][0]
+        self.assertEqual(None, error)
+        self.assertTrue(os.path.exists(result['source']))
+        result, error = results[self.base + '/missing'][0]
+        self.assertEqual(None, result)
+        self.assertNotEqual(None, error)
+
+    def test_timeout(self):
+        cache = MediaCache(self.directory)
+        fetcher = ScreenshotFetcher(cache, [], threads=2, per_host=1, timeout=0.5)
+        errors = []
+        fetcher.submit(self.base + '/slow', lambda url, result, error: errors.append(error))
+        fetcher.wait()
+        fetcher.close()
+        self.assertNotEqual(None, errors[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+from daklib.srccontents import SourceFileList, patched_files
+from daklib.dak_exceptions import UnknownFormatError
+
+from cStringIO import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import gzip
+import os
+import tarfile
+import unittest
+
+PATCH = '''Description: some patch
+--- a/README
++++ b/README
+@@ -1,2 +1,2 @@
+--- not a header
++b
+ c
+--- /dev/null
++++ b/NEW/file
+@@ -0,0 +1 @@
++new
+--- a/OLD
++++ /dev/null
+@@ -1 +0,0 @@
+-old
+--- a/EMPTIED
++++ b/EMPTIED
+@@ -1 +0,0 @@
+-gone
+'''
+
+class SourceFileListTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def make_tar(self, filename, files):
+        '''
+        Writes the tarball filename with the given files, a dict of
+        name -> data. Names ending with '/' are directories, data starting
+        with '->' makes a symlink.
+        '''
+        tar = tarfile.open(os.path.join(self.directory, filename), 'w:gz')
+        for name, data in sorted(files.items()):
+            info = tarfile.TarInfo(name.rstrip('/'))
+            if name.endswith('/'):
+                info.type = tarfile.DIRTYPE
+            elif data.startswith('->'):
+                info.type = tarfile.SYMTYPE
+                info.linkname = data[2:]
+            else:
+                info.size = len(data)
+            tar.addfile(info, StringIO(data))
+        tar.close()
+        return filename
+
+    def test_patched_files(self):
+        self.assertEqual([('README', False), ('NEW/file', False),
+            ('OLD', True), ('EMPTIED', True)],
+            list(patched_files(StringIO(PATCH))))
+        self.assertEqual([('b/README', False)],
+            list(patched_files(['--- x/a/b/README\n', '+++ y/a/b/README\n'], 2)))
+
+    def test_quilt(self):
+        files = [
+            self.make_tar('foo_1.0.orig.tar.gz', {
+                'foo-1.0/': '', 'foo-1.0/README': 'a\nc\n', 'foo-1.0/OLD': 'old\n',
+                'foo-1.0/EMPTIED': 'gone\n', 'foo-1.0/debian/junk': '',
+                'foo-1.0/docs': '->sub', 'foo-1.0/sub/keep': '',
+                'foo-1.0/comp/replaced': ''}),
+            self.make_tar('foo_1.0.orig-comp.tar.gz', {'comp-1.0/file': ''}),
+            self.make_tar('foo_1.0-1.debian.tar.gz', {
+                'debian/rules': '', 'debian/patches/series': '# comment\np1.diff -p1\n',
+                'debian/patches/p1.diff': PATCH}),
+        ]
+        filelist = SourceFileList(self.directory, '3.0 (quilt)', files)
+        self.assertEqual(set(['.pc/.quilt_patches', '.pc/.quilt_series',
+            '.pc/.version', '.pc/applied-patches', '.pc/p1.diff/README',
+            '.pc/p1.diff/NEW/file', '.pc/p1.diff/OLD', '.pc/p1.diff/EMPTIED',
+            'README', 'NEW/file', 'sub/keep', 'comp/file', 'debian/rules',
+            'debian/patches/series', 'debian/patches/p1.diff']),
+            set(filelist.get_all_filenames()))
+
+    def test_one(self):
+        files = [self.make_tar('bar_1.0.orig.tar.gz', {'README': '', 'Makefile': ''})]
+        with gzip.open(os.path.join(self.directory, 'bar_1.0-1.diff.gz'), 'w') as fh:
+            fh.write('--- bar-1.0.orig/README\n+++ bar-1.0/README\n@@ -0,0 +1 @@\n+x\n'
+                '--- bar-1.0.orig/debian/rules\n+++ bar-1.0/debian/rules\n@@ -0,0 +1 @@\n+x\n')
+        files.append('bar_1.0-1.diff.gz')
+        filelist = SourceFileList(self.directory, '1.0', files)
+        # without a single top-level directory nothing is stripped
+        self.assertEqual(set(['README', 'Makefile', 'debian/rules']),
+            set(filelist.get_all_filenames()))
+
+    def test_native(self):
+        files = [self.make_tar('baz_1.0.tar.gz', {'./baz/': '', './baz/debian/rules': ''})]
+        for format in ('1.0', '3.0 (native)'):
+            filelist = SourceFileList(self.directory, format, files)
+            self.assertEqual(['debian/rules'], list(filelist.get_all_filenames()))
+        self.assertRaises(UnknownFormatError,
+            lambda: SourceFileList(self.directory, '3.0 (git)', files))
+
+if __name__ == '__main__':
+    unittest.main()
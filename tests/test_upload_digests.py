@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+from base_test import DakTestCase
+
+from daklib.upload import DigestCache, HashedFile, InvalidHashException
+
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import hashlib
+import os
+import unittest
+
+class DigestCacheTestCase(DakTestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.data = 'hello world\n' * 1000
+        with open(os.path.join(self.directory, 'a'), 'w') as fh:
+            fh.write(self.data)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_copy2(self):
+        digests = DigestCache(chunk_size=100)
+        digests.copy2(self.path('a'), self.path('b'))
+        with open(self.path('b')) as fh:
+            self.assertEqual(self.data, fh.read())
+        expected = (len(self.data), hashlib.md5(self.data).hexdigest(),
+                    hashlib.sha1(self.data).hexdigest(), hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(expected, digests.hash(self.path('a')))
+        self.assertEqual(expected, digests.hash(self.path('b')))
+
+        hashed_file = HashedFile('b', *expected)
+        hashed_file.check(self.directory, digests)
+        HashedFile('a', *expected).check(self.directory, digests)
+        bad = HashedFile('b', expected[0], expected[1], 'bad', expected[3])
+        self.assertRaises(InvalidHashException, bad.check, self.directory, digests)
+
+    def test_modified(self):
+        digests = DigestCache()
+        digests.copy2(self.path('a'), self.path('b'))
+        old = digests.hash(self.path('b'))
+        with open(self.path('b'), 'a') as fh:
+            fh.write('more')
+        new = digests.hash(self.path('b'))
+        self.assertNotEqual(old, new)
+        self.assertEqual(len(self.data) + 4, new[0])
+
+if __name__ == '__main__':
+    unittest.main()
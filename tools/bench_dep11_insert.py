@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# Free software licensed under the GPL version 2 or later
+
+"""
+Compares the per-row INSERT path into bin_dep11 with the COPY based bulk
+path and the set-based replace path on synthetic data.
+
+Nothing is written to bin_dep11 itself: all rows go to a temporary copy of
+the table which is dropped when the transaction is rolled back.
+
+Usage: bench_dep11_insert.py [number-of-components]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from daklib.dbconn import DBConn
+from dak.generate_metadata import DEP11Metadata
+
+TEMPLATE = """---
+ID: bench-%(n)d.desktop
+Type: desktop-app
+Packages:
+- bench-%(n)d
+Name:
+  C: Benchmark application %(n)d
+Summary:
+  C: A synthetic component used to benchmark bin_dep11 insertion
+Description:
+  C: <p>%(text)s</p>
+Categories:
+- Utility
+Icon:
+  cached: bench-%(n)d_bench.png
+"""
+
+def synthetic_rows(count):
+    '''
+    Yields (binid, yamldoc, ignore) tuples for count fake components.
+    '''
+    text = "lorem ipsum dolor sit amet " * 20
+    for n in xrange(count):
+        yield (n, TEMPLATE % {'n': n, 'text': text}, n % 10 == 0)
+
+def timed(label, count, fn):
+    '''
+    Runs fn and prints its wall clock time and throughput.
+    '''
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print "%-12s %8.2fs %10.0f rows/s" % (label, elapsed, count / elapsed)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    session = DBConn().session()
+    # no id column: a default would draw from the live bin_dep11 sequence
+    session.execute("""create temp table bin_dep11_bench
+        (binary_id integer not null, metadata text not null, ignore boolean not null)""")
+    dep11 = DEP11Metadata(session, table='bin_dep11_bench')
+    print "Loading %d synthetic components" % (count)
+
+    def per_row():
+        for binid, doc, ignore in synthetic_rows(count):
+            dep11.insertdata(binid, doc, ignore)
+    timed('insertdata', count, per_row)
+
+    session.execute("truncate bin_dep11_bench")
+    timed('insertmany', count, lambda: dep11.insertmany(synthetic_rows(count)))
+
+    # replace every row loaded by the previous step
+    timed('replacemany', count, lambda: dep11.replacemany(synthetic_rows(count)))
+
+    session.rollback()
+    session.close()
+
+if __name__ == '__main__':
+    main()